@@ -3,6 +3,7 @@
 import appdirs
 import argparse
 import asyncio
+import bisect
 import datetime
 import logging
 import os
@@ -139,7 +140,7 @@ class ConversationPickerWidget(urwid.WidgetWrap):
         # Build buttons for selecting conversations ordered by most recently
         # modified first.
         convs = sorted(conversation_list.get_all(), reverse=True,
-                       key=lambda c: c.last_modified)
+                       key=lambda c: c.last_modified_us)
         on_press = lambda button, conv_id: on_select(conv_id)
         buttons = [urwid.Button(get_conv_name(conv), on_press=on_press,
                                 user_data=conv.id_)
@@ -208,11 +209,11 @@ class MessageWidget(urwid.WidgetWrap):
 
     """Widget for displaying a single message in a conversation."""
 
-    def __init__(self, timestamp, text, user=None):
-        # Save the timestamp as an attribute for sorting.
-        self.timestamp = timestamp
+    def __init__(self, timestamp_us, text, user=None):
+        # Save the microsecond timestamp as an attribute for sorting.
+        self.timestamp_us = timestamp_us
         text = [
-            ('msg_date', '(' + self._get_date_str(timestamp) + ') '),
+            ('msg_date', '(' + self._get_date_str(timestamp_us) + ') '),
             ('msg_text', text)
         ]
         if user is not None:
@@ -221,12 +222,13 @@ class MessageWidget(urwid.WidgetWrap):
         super().__init__(self._widget)
 
     @staticmethod
-    def _get_date_str(timestamp):
-        """Convert UTC datetime into user interface string."""
-        return timestamp.astimezone(tz=None).strftime('%I:%M:%S %p')
+    def _get_date_str(timestamp_us):
+        """Convert microsecond timestamp into user interface string."""
+        return (hangups.parsers.from_timestamp(timestamp_us)
+                .astimezone(tz=None).strftime('%I:%M:%S %p'))
 
     def __lt__(self, other):
-        return self.timestamp < other.timestamp
+        return self.timestamp_us < other.timestamp_us
 
 
 class ConversationWidget(urwid.WidgetWrap):
@@ -243,6 +245,9 @@ class ConversationWidget(urwid.WidgetWrap):
         self._conversation.on_event.add_observer(self._on_event)
 
         self._num_unread = 0
+        # Newest ConversationEvent displayed when the widget was created, until
+        # the next event arrives:
+        self._initial_event = None
         self._set_title_cb = set_title_cb
         self._set_title()
 
@@ -261,6 +266,7 @@ class ConversationWidget(urwid.WidgetWrap):
         # conversation.
         for event in self._conversation.events:
             self._on_event(event)
+            self._initial_event = event
         self._num_unread = 0
         self._set_title()
 
@@ -310,8 +316,7 @@ class ConversationWidget(urwid.WidgetWrap):
                               len(self._list_walker) - 1)
         except IndexError:
             bottom_visible = True  # ListBox is empty
-        self._list_walker.append(message_widget)
-        self._list_walker.sort()
+        bisect.insort(self._list_walker, message_widget)
         if bottom_visible:
             # set_focus_valign is necessary so the last message is always shown
             # completely.
@@ -320,19 +325,24 @@ class ConversationWidget(urwid.WidgetWrap):
 
     def _show_info_message(self, text):
         """Display an informational message with timestamp."""
-        timestamp = datetime.datetime.now(tz=datetime.timezone.utc)
-        self._add_message_widget(MessageWidget(timestamp, text, None))
+        timestamp_us = hangups.parsers.to_timestamp(
+            datetime.datetime.now(tz=datetime.timezone.utc)
+        )
+        self._add_message_widget(MessageWidget(timestamp_us, text, None))
 
     def _on_event(self, conv_event):
         """Display a new conversation message."""
+        # If the ConversationWidget is created by a ConversationEvent, the
+        # event is displayed with the old events, and then fired again next.
+        is_initial_event = conv_event is self._initial_event
+        self._initial_event = None
+        if is_initial_event:
+            return
         user = self._conversation.get_user(conv_event.user_id)
 
-        # XXX: If the ConversationWidget is created by a ConversationEvent, the
-        # ConversationEvent will be duplicated in the list of messages.
-
         if isinstance(conv_event, hangups.ChatMessageEvent):
             self._add_message_widget(MessageWidget(
-                conv_event.timestamp, conv_event.text, user
+                conv_event.timestamp_us, conv_event.text, user
             ))
             # Update the count of unread messages.
             if not user.is_self:
@@ -345,7 +355,8 @@ class ConversationWidget(urwid.WidgetWrap):
             else:
                 text = ('{} renamed the conversation to {}'
                         .format(user.first_name, conv_event.new_name))
-            self._add_message_widget(MessageWidget(conv_event.timestamp, text))
+            self._add_message_widget(MessageWidget(conv_event.timestamp_us,
+                                                   text))
 
         elif isinstance(conv_event, hangups.MembershipChangeEvent):
             event_users = [self._conversation.get_user(user_id) for user_id
@@ -356,7 +367,8 @@ class ConversationWidget(urwid.WidgetWrap):
                         .format(user.first_name, names))
             else:  # LEAVE
                 text = ('{} left the conversation'.format(names))
-            self._add_message_widget(MessageWidget(conv_event.timestamp, text))
+            self._add_message_widget(MessageWidget(conv_event.timestamp_us,
+                                                   text))
 
         # Update the title in case unread count or conversation name changed.
         self._set_title()
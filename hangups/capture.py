@@ -0,0 +1,309 @@
+"""Recording and replaying raw traffic.
+
+A capture is an append-only log of the raw data received from the push channel
+and the bodies of API responses. Replaying a capture runs the data through the
+same parsers as the client, without a network connection, which makes it
+possible to reproduce problems and benchmark the parsers deterministically.
+
+A capture file starts with MAGIC, followed by records. Each record has a
+header of a timestamp (seconds since the epoch, as a double), the kind of
+record, a stream ID and the length of the data, followed by the data. All
+values are little-endian. Stream IDs distinguish separate long-polling
+requests and API responses.
+
+The data of a RESPONSE record is the URL of the request, a newline, and the
+response body.
+"""
+
+import asyncio
+import collections
+import logging
+import mmap
+import struct
+import time
+
+from hangups import (channel, client, conversation, event, javascript,
+                     parsers, user)
+
+logger = logging.getLogger(__name__)
+MAGIC = b'HGCAP\x00\x00\x01'
+_RECORD_HEADER = struct.Struct('<dBII')
+DEFAULT_FLUSH_INTERVAL = 1.0
+# Number of bytes of records to buffer before writing them immediately:
+MAX_BUFFER_SIZE = 1024 * 1024
+
+# Kinds of records:
+CHANNEL_DATA = 1  # a chunk of data received from the push channel
+RESPONSE = 2  # the body of an API response
+
+Record = collections.namedtuple('Record', [
+    'timestamp',  # float
+    'kind',  # CHANNEL_DATA or RESPONSE
+    'stream_id',  # int
+    'data',  # memoryview
+])
+
+
+class CaptureWriter(object):
+
+    """Appends records to a capture file.
+
+    Records are buffered in memory rather than written as they're received,
+    so capturing doesn't add a write to the file for every chunk of channel
+    data.
+    """
+
+    def __init__(self, path, flush_interval=DEFAULT_FLUSH_INTERVAL):
+        """Open a capture file for appending, creating it if necessary.
+
+        Buffered records are written flush_interval seconds after the first
+        of them, once MAX_BUFFER_SIZE bytes are buffered, and on close.
+        Stream IDs continue from the largest in an existing file, so streams
+        appended by separate writers are kept apart.
+
+        Raises ValueError if an existing file isn't a capture.
+        """
+        self._flush_interval = flush_interval
+        self._buf = bytearray()  # records which haven't been written yet
+        self._flush_handle = None  # asyncio.Handle of the scheduled flush
+        self._file = open(path, 'ab+')
+        self._file.seek(0)
+        magic = self._file.read(len(MAGIC))
+        self._stream_id = 0  # the largest stream ID in the file
+        if not magic:
+            self._file.write(MAGIC)
+            self._file.flush()
+        elif magic != MAGIC:
+            self._file.close()
+            raise ValueError('Not a capture file: {}'.format(path))
+        else:
+            self._stream_id = self._read_max_stream_id()
+
+    def new_stream(self):
+        """Return an ID for a new stream."""
+        self._stream_id += 1
+        return self._stream_id
+
+    def write_channel_data(self, stream_id, data):
+        """Append a chunk of data received from the push channel."""
+        self._write(CHANNEL_DATA, stream_id, data)
+
+    def write_response(self, stream_id, url, body):
+        """Append the body of an API response."""
+        self._write(RESPONSE, stream_id, url.encode() + b'\n' + body)
+
+    def flush(self):
+        """Write the buffered records to the file."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._buf:
+            self._file.write(self._buf)
+            self._file.flush()
+            del self._buf[:]
+
+    def close(self):
+        """Write the buffered records and close the capture file."""
+        self.flush()
+        self._file.close()
+
+    def _read_max_stream_id(self):
+        """Return the largest stream ID in the file, by reading only the
+        record headers.
+        """
+        max_stream_id = 0
+        while True:
+            header = self._file.read(_RECORD_HEADER.size)
+            if len(header) < _RECORD_HEADER.size:
+                break
+            _, _, stream_id, length = _RECORD_HEADER.unpack(header)
+            max_stream_id = max(max_stream_id, stream_id)
+            self._file.seek(length, 1)
+        return max_stream_id
+
+    def _write(self, kind, stream_id, data):
+        """Buffer a record, scheduling a flush if none is scheduled."""
+        self._buf.extend(_RECORD_HEADER.pack(time.time(), kind, stream_id,
+                                             len(data)))
+        self._buf.extend(data)
+        if len(self._buf) >= MAX_BUFFER_SIZE:
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_later(
+                self._flush_interval, self.flush
+            )
+
+
+def read_capture(path):
+    """Yield the Records of a capture file.
+
+    The file is memory-mapped rather than read, so captures don't need to fit
+    in memory. The data of each record is a memoryview of the file. A
+    truncated record at the end of the file, for example if the writer was
+    interrupted, is ignored.
+
+    Raises ValueError if the file isn't a capture.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('Not a capture file: {}'.format(path))
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(buf)
+    try:
+        pos = len(MAGIC)
+        while pos + _RECORD_HEADER.size <= len(buf):
+            timestamp, kind, stream_id, length = (
+                _RECORD_HEADER.unpack_from(buf, pos)
+            )
+            pos += _RECORD_HEADER.size
+            if pos + length > len(buf):
+                logger.warning('Ignoring truncated capture record')
+                break
+            yield Record(timestamp, kind, stream_id, view[pos:pos + length])
+            pos += length
+    finally:
+        view.release()
+        try:
+            buf.close()
+        except BufferError:
+            # Records are still referenced, so leave closing the map to the
+            # garbage collector.
+            pass
+
+
+class ReplayClient(object):
+
+    """Stand-in for Client which replays a capture instead of connecting.
+
+    Channel data is run through PushDataParser and parsers.parse_submission,
+    and the state updates are fired to a ConversationList, which is created
+    from the recorded chat initialization response. Recorded syncallnewevents
+    responses are synced into the ConversationList too.
+    """
+
+    def __init__(self):
+        # Events observed by ConversationList:
+        self.on_connect = event.Event('ReplayClient.on_connect')
+        self.on_reconnect = event.Event('ReplayClient.on_reconnect')
+        self.on_state_update = event.Event('ReplayClient.on_state_update')
+
+        # UserList and ConversationList created from the chat initialization
+        # response:
+        self.user_list = None
+        self.conv_list = None
+        # Number of records and ClientStateUpdates replayed:
+        self.num_records = 0
+        self.num_state_updates = 0
+        # Projection of ClientStateUpdates, like Client.projection:
+        self.projection = None
+
+        self._stream_id = None
+        self._push_parser = None
+        self._submission_parser = None
+        # Response returned by the next call to syncallnewevents:
+        self._sync_response = None
+
+    @asyncio.coroutine
+    def replay(self, path, speed=None):
+        """Replay a capture file.
+
+        If speed is None, records are replayed as fast as possible, otherwise
+        the delays between records are divided by speed, so 1 replays at the
+        recorded speed.
+
+        Raises ValueError if the file isn't a capture.
+        """
+        start = None
+        for record in read_capture(path):
+            if speed is not None:
+                if start is None:
+                    start = (time.monotonic(), record.timestamp)
+                delay = ((record.timestamp - start[1]) / speed -
+                         (time.monotonic() - start[0]))
+                if delay > 0:
+                    yield from asyncio.sleep(delay)
+            yield from self.replay_record(record)
+
+    @asyncio.coroutine
+    def replay_record(self, record):
+        """Replay a Record."""
+        self.num_records += 1
+        if record.kind == CHANNEL_DATA:
+            self._replay_channel_data(record)
+        elif record.kind == RESPONSE:
+            yield from self._replay_response(record)
+        else:
+            logger.warning('Unknown capture record kind: {}'
+                           .format(record.kind))
+
+    @asyncio.coroutine
+    def syncallnewevents(self, timestamp, projection=None):
+        """Return the recorded syncallnewevents response being replayed.
+
+        The response is parsed without the projection.
+        """
+        return self._sync_response
+
+    def _replay_channel_data(self, record):
+        """Parse channel data like Channel and Client.
+
+        Like live traffic, invalid submissions are skipped, and exceptions
+        raised by observers are logged, so the rest of the capture is still
+        replayed.
+        """
+        if record.stream_id != self._stream_id:
+            # Each long-polling request starts with a new parser.
+            self._stream_id = record.stream_id
+            self._push_parser = channel.PushDataParser()
+            self._submission_parser = javascript.IncrementalParser(raw=True)
+        parts = self._push_parser.get_submission_parts(record.data)
+        for text, is_last in parts:
+            items = []
+            if self._submission_parser is not None:
+                try:
+                    items = self._submission_parser.feed(text)
+                    if is_last:
+                        items.extend(self._submission_parser.close())
+                except ValueError as e:
+                    logger.warning('Failed to parse submission: {}'.format(e))
+                    self._submission_parser = None
+            if is_last:
+                self._submission_parser = javascript.IncrementalParser(
+                    raw=True
+                )
+            for state_update in parsers.parse_submission(
+                    items, projection=self.projection
+            ):
+                self.num_state_updates += 1
+                try:
+                    self.on_state_update.fire(state_update)
+                except Exception:
+                    logger.exception('Replaying ClientStateUpdate failed')
+
+    @asyncio.coroutine
+    def _replay_response(self, record):
+        """Parse a response body like Client."""
+        url, body = bytes(record.data).split(b'\n', 1)
+        url = url.decode()
+        if url.endswith(client.CHAT_INIT_PATH):
+            _, initial_data = client._parse_chat_init(body)
+            if self.conv_list is not None:
+                # Stop updating the lists from the previous response.
+                self.on_state_update.remove_observer(
+                    self.user_list._on_state_update
+                )
+                self.on_state_update.remove_observer(
+                    self.conv_list._on_state_update
+                )
+            self.user_list = user.UserList(
+                self, initial_data.self_entity, initial_data.entities,
+                initial_data.conversation_participants
+            )
+            self.conv_list = conversation.ConversationList(
+                self, initial_data.conversation_states, self.user_list,
+                initial_data.sync_timestamp
+            )
+        elif url.endswith('conversations/syncallnewevents'):
+            self._sync_response = client._parse_sync_all_new_events(body)
+            if self.conv_list is not None:
+                yield from self.conv_list._sync()
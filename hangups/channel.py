@@ -6,18 +6,30 @@ Engine Channel.
 
 import aiohttp
 import asyncio
+import codecs
 import logging
 import re
+import time
 
-from hangups import javascript, http_utils, event, exceptions
+from hangups import javascript, http_utils, event, exceptions, parsers
 
 logger = logging.getLogger(__name__)
-LEN_REGEX = re.compile(r'([0-9]+)\n', re.MULTILINE)
+_LEN_BYTES_REGEX = re.compile(br'([0-9]+)\n')
 CONNECT_TIMEOUT = 30
 # Long-polling requests send heartbeats every 15 seconds, so if we miss two in
 # a row, consider the connection dead.
 PUSH_TIMEOUT = 30
 MAX_READ_BYTES = 1024 * 1024
+TALKGADGET_URL = 'https://talkgadget.google.com'
+# Maximum number of submission items waiting to be dispatched to observers:
+DISPATCH_QUEUE_SIZE = 1000
+
+# Policies for items that arrive while the dispatch queue is full:
+BLOCK = 'block'  # stop reading until there is space in the queue
+DROP_HEARTBEATS = 'drop_heartbeats'  # discard heartbeats, otherwise block
+# Replace a queued typing notification from the same user in the same
+# conversation, and discard heartbeats, otherwise block:
+COALESCE_TYPING = 'coalesce_typing'
 
 
 class UnknownSIDError(exceptions.HangupsError):
@@ -27,26 +39,61 @@ class UnknownSIDError(exceptions.HangupsError):
     pass
 
 
-def _best_effort_decode(data_bytes):
-    """Decode data_bytes into a string using UTF-8.
+# UTF-8 bytes which continue a character, and bytes which start a character
+# outside the BMP, which is 2 code units long in UTF-16:
+_CONTINUATION_BYTES = bytes(range(0x80, 0xc0))
+_FOUR_BYTE_LEAD_BYTES = bytes(range(0xf0, 0xf8))
+
+
+def _utf8_char_length(lead_byte):
+    """Return the length of a UTF-8 character from its first byte."""
+    if lead_byte < 0xe0:
+        return 2 if lead_byte >= 0xc0 else 1
+    return 3 if lead_byte < 0xf0 else 4
+
+
+def _utf8_complete_length(data):
+    """Return the length of data without an incomplete trailing character."""
+    for i in range(len(data) - 1, max(len(data) - 4, -1), -1):
+        if data[i] < 0x80:
+            break
+        elif data[i] >= 0xc0:
+            if i + _utf8_char_length(data[i]) > len(data):
+                return i
+            break
+    return len(data)
+
+
+def _utf16_length(data):
+    """Return the length of UTF-8 bytes in UTF-16 code units.
 
-    If data_bytes cannot be decoded, pop the last byte until it can be or
-    return an empty string.
+    This is the length of the text as reported by JavaScript, and is counted
+    without decoding the bytes: each character is one code unit, except for
+    characters outside the BMP, which are two.
     """
-    for end in reversed(range(1, len(data_bytes) + 1)):
-        try:
-            return data_bytes[0:end].decode()
-        except UnicodeDecodeError:
-            pass
-    return ''
+    return (len(data.translate(None, _CONTINUATION_BYTES)) +
+            len(data) - len(data.translate(None, _FOUR_BYTE_LEAD_BYTES)))
 
 
 class PushDataParser(object):
-    """Parse data from the long-polling endpoint."""
+    """Parse data from the long-polling endpoint.
+
+    Each instance should be used with either get_submissions or
+    get_submission_parts, but not both.
+    """
 
     def __init__(self):
         # Buffer for bytes containing utf-8 text:
-        self._buf = b''
+        self._buf = bytearray()
+        # Decoder for the bytes of submissions. Submissions are only split
+        # between characters, but the length of a submission may split a
+        # character in two if it is malformed.
+        self._decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        # Text of the current submission received by get_submissions so far:
+        self._submission = []
+        # Number of UTF-16 code units left in the current submission, or None
+        # if the next submission length hasn't been read yet:
+        self._remaining = None
 
     def get_submissions(self, new_data_bytes):
         """Yield submissions generated from received data.
@@ -54,44 +101,137 @@ class PushDataParser(object):
         Responses from the push endpoint consist of a sequence of submissions.
         Each submission is prefixed with its length followed by a newline.
 
-        The buffer may not be decodable as UTF-8 if there's a split multi-byte
-        character at the end. To handle this, do a "best effort" decode of the
-        buffer to decode as much of it as possible.
-
         The length is actually the length of the string as reported by
         JavaScript. JavaScript's string length function returns the number of
-        code units in the string, represented in UTF-16. We can emulate this by
-        encoding everything in UTF-16 and multipling the reported length by 2.
+        code units in the string, represented in UTF-16, which is counted from
+        the UTF-8 bytes as they are received.
+        """
+        for data, is_last in self._get_submission_bytes(new_data_bytes):
+            self._submission.append(self._decoder.decode(data))
+            if is_last:
+                yield ''.join(self._submission)
+                self._submission = []
+
+    def get_submission_parts(self, new_data_bytes):
+        """Yield (text, is_last) parts of submissions from received data.
+
+        Rather than waiting for a whole submission to arrive like
+        get_submissions, this yields as much of the current submission as has
+        been received, so it can be parsed while the rest arrives. is_last is
+        True for the final part of each submission.
+        """
+        for data, is_last in self._get_submission_bytes(new_data_bytes):
+            yield self._decoder.decode(data), is_last
+
+    def _get_submission_bytes(self, new_data_bytes):
+        """Yield (bytes, is_last) parts of submissions from received data.
 
-        Note that when encoding a string in UTF-16, Python will prepend a
-        byte-order character, so we need to remove the first two bytes.
+        Each byte is only looked at a constant number of times, and parts are
+        only split between UTF-8 characters.
         """
-        self._buf += new_data_bytes
+        buf = self._buf
+        buf.extend(new_data_bytes)
+        pos = 0
+        parts = []  # parts of the current submission to yield together
+        try:
+            while True:
+                if self._remaining is None:
+                    match = _LEN_BYTES_REGEX.search(buf, pos)
+                    if match is None:
+                        break
+                    self._remaining = int(match.group(1))
+                    pos = match.end()
+                # Every code unit is at least one byte long, so this can't
+                # contain more code units than are left in the submission.
+                data = buf[pos:pos + self._remaining]
+                length = _utf8_complete_length(data)
+                if length == 0 and data:
+                    # The next character is longer than the number of code
+                    # units left, so it has to be read on its own.
+                    length = _utf8_char_length(data[0])
+                    if pos + length > len(buf):
+                        break
+                    data = buf[pos:pos + length]
+                elif length < len(data):
+                    data = data[:length]
+                elif not data and self._remaining > 0:
+                    break
+                pos += len(data)
+                self._remaining = max(self._remaining - _utf16_length(data),
+                                      0)
+                parts.append(data)
+                if self._remaining == 0:
+                    self._remaining = None
+                    yield b''.join(parts), True
+                    parts = []
+            if parts:
+                yield b''.join(parts), False
+        finally:
+            # Deleting the start of a bytearray doesn't copy the rest of it.
+            del buf[:pos]
+
+
+class DispatchQueue(asyncio.Queue):
+
+    """Bounded queue of submission items waiting to be dispatched.
+
+    policy decides what happens to items that arrive while the queue is full,
+    and is one of BLOCK, DROP_HEARTBEATS or COALESCE_TYPING. Items must be
+    added using put_item.
+    """
 
-        while True:
+    def __init__(self, maxsize=DISPATCH_QUEUE_SIZE, policy=BLOCK):
+        """Create a new queue.
 
-            buf_decoded = _best_effort_decode(self._buf)
-            buf_utf16 = buf_decoded.encode('utf-16')[2:]
+        Raises ValueError if the policy is unknown.
+        """
+        if policy not in (BLOCK, DROP_HEARTBEATS, COALESCE_TYPING):
+            raise ValueError('Unknown dispatch policy: {}'.format(policy))
+        super().__init__(maxsize)
+        self._policy = policy
+        # Number of items discarded or coalesced because the queue was full:
+        self.dropped = 0
 
-            lengths = LEN_REGEX.findall(buf_decoded)
-            if len(lengths) == 0:
-                break
-            else:
-                # Both lengths are in number of bytes in UTF-16 encoding.
-                # The length of the submission:
-                length = int(lengths[0]) * 2
-                # The length of the submission length and newline:
-                length_length = len((lengths[0] + '\n').encode('utf-16')[2:])
-                if len(buf_utf16) - length_length < length:
-                    break
+    @property
+    def lag(self):
+        """Seconds the oldest queued item has been waiting for."""
+        if self.empty():
+            return 0.0
+        return time.monotonic() - self._queue[0][0]
+
+    @asyncio.coroutine
+    def put_item(self, item):
+        """Add a submission item to the queue, applying the policy if full."""
+        if self.full() and self._policy != BLOCK:
+            if parsers.is_heartbeat(item) or (
+                    self._policy == COALESCE_TYPING and self._coalesce(item)
+            ):
+                self.dropped += 1
+                return
+        # Entries are [time queued, item, typing key or _UNKNOWN].
+        yield from self.put([time.monotonic(), item, _UNKNOWN])
+
+    def _coalesce(self, item):
+        """Replace a queued typing notification with the same key as item.
+
+        Returns True if an item was replaced.
+        """
+        key = parsers.get_typing_key(item)
+        if key is None:
+            return False
+        for entry in self._queue:
+            if entry[2] is _UNKNOWN:
+                entry[2] = parsers.get_typing_key(entry[1])
+            if entry[2] == key:
+                entry[1] = item
+                return True
+        return False
+
+    def _get(self):
+        return self._queue.popleft()[1]
 
-                submission = buf_utf16[length_length:length_length + length]
-                yield submission.decode('utf-16')
-                # Drop the length and the submission itself from the beginning
-                # of the buffer.
-                drop_length = (len((lengths[0] + '\n').encode()) +
-                               len(submission.decode('utf-16').encode()))
-                self._buf = self._buf[drop_length:]
+
+_UNKNOWN = object()
 
 
 def _parse_sid_response(res):
@@ -127,8 +267,22 @@ class Channel(object):
     # Public methods
     ##########################################################################
 
-    def __init__(self, cookies, path, clid, ec, prop, connector):
-        """Create a new channel."""
+    def __init__(self, cookies, path, clid, ec, prop, connector,
+                 dispatch_queue_size=DISPATCH_QUEUE_SIZE,
+                 dispatch_policy=BLOCK, capture=None,
+                 base_url=TALKGADGET_URL):
+        """Create a new channel.
+
+        Received submission items are dispatched to on_message observers from
+        a queue of at most dispatch_queue_size items, so slow observers don't
+        stop the channel from reading. dispatch_policy decides what happens
+        when the queue is full (see DispatchQueue).
+
+        If capture is a hangups.capture.CaptureWriter, received data and
+        response bodies are appended to it.
+
+        base_url is the URL of the talkgadget server to connect to.
+        """
 
         # Event fired when channel connects with arguments ():
         self.on_connect = event.Event('Channel.on_connect')
@@ -136,8 +290,9 @@ class Channel(object):
         self.on_reconnect = event.Event('Channel.on_reconnect')
         # Event fired when channel disconnects with arguments ():
         self.on_disconnect = event.Event('Channel.on_disconnect')
-        # Event fired when a channel submission is received with arguments
-        # (submission):
+        # Event fired for each dispatched submission item with arguments
+        # (submission), a list of the item as JavaScript source text (see
+        # parsers.parse_submission):
         self.on_message = event.Event('Channel.on_message')
 
         # True if the channel is currently connected:
@@ -148,8 +303,20 @@ class Channel(object):
         self._cookies = cookies
         # Parser for assembling messages:
         self._push_parser = None
+        # Parser for the submission currently being received, or None if the
+        # rest of the submission is being discarded:
+        self._submission_parser = None
+        # Queue of submission items waiting to be dispatched, and the task
+        # dispatching them while listening:
+        self._dispatch_queue = DispatchQueue(dispatch_queue_size,
+                                             dispatch_policy)
+        self._dispatch_task = None
         # aiohttp connector for keep-alive:
         self._connector = connector
+        # CaptureWriter for received data, or None:
+        self._capture = capture
+        # URL of the talkgadget server:
+        self._base_url = base_url
 
         # Static channel parameters:
         # '/u/0/talkgadget/_/channel/'
@@ -180,13 +347,39 @@ class Channel(object):
     def is_connected(self):
        return self._is_connected
 
+    @property
+    def dispatch_queue_depth(self):
+        """Number of submission items waiting to be dispatched."""
+        return self._dispatch_queue.qsize()
+
+    @property
+    def dispatch_lag(self):
+        """Seconds the oldest undispatched submission item has waited for."""
+        return self._dispatch_queue.lag
+
     @asyncio.coroutine
     def listen(self):
         """Listen for messages on the channel.
 
         This method only returns when the connection has been closed due to an
-        error.
+        error. Submission items which are still queued by then are dispatched
+        before it returns.
         """
+        self._dispatch_task = asyncio.async(self._dispatch())
+        try:
+            yield from self._listen()
+        finally:
+            self._dispatch_task.cancel()
+            while not self._dispatch_queue.empty():
+                self._dispatch_item(self._dispatch_queue.get_nowait())
+
+    ##########################################################################
+    # Private methods
+    ##########################################################################
+
+    @asyncio.coroutine
+    def _listen(self):
+        """Make long-polling requests until running out of retries."""
         MAX_RETRIES = 5  # maximum number of times to retry after a failure
         retries = MAX_RETRIES # number of remaining retries
         need_new_sid = True  # whether a new SID is needed
@@ -209,6 +402,7 @@ class Channel(object):
             # Clear any previous push data, since if there was an error it
             # could contain garbage.
             self._push_parser = PushDataParser()
+            self._submission_parser = javascript.IncrementalParser(raw=True)
             try:
                 yield from self._longpoll_request()
             except (UnknownSIDError, exceptions.NetworkError) as e:
@@ -229,9 +423,26 @@ class Channel(object):
 
         logger.error('Ran out of retries for long-polling request')
 
-    ##########################################################################
-    # Private methods
-    ##########################################################################
+    @asyncio.coroutine
+    def _dispatch(self):
+        """Dispatch submission items from the dispatch queue."""
+        while True:
+            self._dispatch_item((yield from self._dispatch_queue.get()))
+            while not self._dispatch_queue.empty():
+                self._dispatch_item(self._dispatch_queue.get_nowait())
+            # Let the channel read while observers are busy.
+            yield from asyncio.sleep(0)
+
+    def _dispatch_item(self, item):
+        """Fire on_message with a submission item.
+
+        Exceptions raised by observers are logged, so they don't stop the
+        other items from being dispatched.
+        """
+        try:
+            self.on_message.fire([item])
+        except Exception:
+            logger.exception('Dispatching submission item failed')
 
     @asyncio.coroutine
     def _fetch_channel_sid(self):
@@ -240,7 +451,7 @@ class Channel(object):
         Raises hangups.NetworkError.
         """
         logger.info('Requesting new session...')
-        url = 'https://talkgadget.google.com{}bind'.format(self._channel_path)
+        url = '{}{}bind'.format(self._base_url, self._channel_path)
         params = {
             'VER': 8,
             'clid': self._clid_param,
@@ -252,7 +463,8 @@ class Channel(object):
         try:
             res = yield from http_utils.fetch(
                 'post', url, cookies=self._cookies, params=params,
-                data='count=0', connector=self._connector
+                data='count=0', connector=self._connector,
+                capture=self._capture
             )
         except exceptions.NetworkError as e:
             raise exceptions.HangupsError('Failed to request SID: {}'.format(e))
@@ -288,7 +500,7 @@ class Channel(object):
             'SID': self._sid_param,
             'CI': 0,
         }
-        URL = 'https://talkgadget.google.com/u/0/talkgadget/_/channel/bind'
+        URL = '{}/u/0/talkgadget/_/channel/bind'.format(self._base_url)
         logger.info('Opening new long-polling request')
         try:
             res = yield from asyncio.wait_for(aiohttp.request(
@@ -307,6 +519,8 @@ class Channel(object):
                 'Request return unexpected status: {}: {}'
                 .format(res.status, res.reason)
             )
+        if self._capture is not None:
+            stream_id = self._capture.new_stream()
         while True:
             try:
                 chunk = yield from asyncio.wait_for(
@@ -318,15 +532,18 @@ class Channel(object):
                 raise exceptions.NetworkError('Request connection error: {}'
                                               .format(e))
             if chunk:
-                self._on_push_data(chunk)
+                if self._capture is not None:
+                    self._capture.write_channel_data(stream_id, chunk)
+                yield from self._on_push_data(chunk)
             else:
                 # Close the response to allow the connection to be reused for
                 # the next request.
                 res.close()
                 break
 
+    @asyncio.coroutine
     def _on_push_data(self, data_bytes):
-        """Parse push data and trigger event methods."""
+        """Parse push data and queue submission items for dispatch."""
         logger.debug('Received push data:\n{}'.format(data_bytes))
 
         # This method is only called when the long-polling request was
@@ -340,5 +557,24 @@ class Channel(object):
                 self._is_connected = True
                 self.on_connect.fire()
 
-        for submission in self._push_parser.get_submissions(data_bytes):
-            self.on_message.fire(submission)
+        # Split submissions into items as they arrive, so the items of a large
+        # submission are available while the rest of it is still being
+        # received. Items are left unparsed until an observer needs them.
+        parts = self._push_parser.get_submission_parts(data_bytes)
+        for text, is_last in parts:
+            items = []
+            if self._submission_parser is not None:
+                try:
+                    items = self._submission_parser.feed(text)
+                    if is_last:
+                        items.extend(self._submission_parser.close())
+                except ValueError as e:
+                    logger.warning('Failed to parse submission: {}'.format(e))
+                    self._submission_parser = None
+            if is_last:
+                self._submission_parser = javascript.IncrementalParser(
+                    raw=True
+                )
+            for item in items:
+                if item is not None:
+                    yield from self._dispatch_queue.put_item(item)
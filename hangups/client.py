@@ -3,6 +3,7 @@
 import aiohttp
 import asyncio
 import collections
+import datetime
 import hashlib
 import itertools
 import json
@@ -16,7 +17,9 @@ from hangups import (javascript, parsers, exceptions, http_utils, channel,
 
 logger = logging.getLogger(__name__)
 ORIGIN_URL = 'https://talkgadget.google.com'
-CHAT_INIT_URL = 'https://talkgadget.google.com/u/0/talkgadget/_/chat'
+API_URL = 'https://clients6.google.com'
+CHAT_INIT_PATH = '/u/0/talkgadget/_/chat'
+CHAT_INIT_URL = ORIGIN_URL + CHAT_INIT_PATH
 CHAT_INIT_PARAMS = {
     'prop': 'aChromeExtension',
     'fid': 'gtn-roster-iframe-id',
@@ -33,7 +36,7 @@ InitialData = collections.namedtuple('InitialData', [
     'self_entity',  # ClientEntity
     'entities',  # [ClientEntity]
     'conversation_participants',  # [ClientConversationParticipantData]
-    'sync_timestamp'  # datetime
+    'sync_timestamp'  # int, microseconds
 ])
 
 
@@ -43,10 +46,38 @@ class Client(object):
     Maintains a connections to the servers, emits events, and accepts commands.
     """
 
-    def __init__(self, cookies):
+    def __init__(self, cookies,
+                 dispatch_queue_size=channel.DISPATCH_QUEUE_SIZE,
+                 dispatch_policy=channel.BLOCK, parse_executor=None,
+                 capture=None, base_url=None, lazy_parsing=False,
+                 projection=None):
         """Create new client.
 
         cookies is a dictionary of authentication cookies.
+
+        dispatch_queue_size and dispatch_policy configure the queue between
+        reading the channel and firing events (see channel.DispatchQueue).
+
+        parse_executor is an optional concurrent.futures.Executor, like a
+        ProcessPoolExecutor, used to parse large responses off the event loop.
+        It may be shared between clients.
+
+        capture is an optional hangups.capture.CaptureWriter which received
+        data and response bodies are appended to, so they can be replayed.
+
+        base_url is an optional URL of a server to use in place of both
+        talkgadget.google.com and clients6.google.com, like
+        hangups.fakeserver.FakeServer.
+
+        If lazy_parsing is True, ClientStateUpdates from the channel are lazy
+        views, which only parse the fields that observers access (see
+        hangups.pblite.Message.parse). ClientStateUpdates with invalid fields
+        are logged and skipped once an observer accesses one, so observers
+        may already have handled other fields of them.
+
+        projection is an optional projection of the ClientStateUpdates from
+        the channel (see hangups.pblite). It's stored in the projection
+        attribute, which may be changed at any time.
         """
 
         # Event fired when the client connects for the first time with
@@ -66,6 +97,17 @@ class Client(object):
 
         self._cookies = cookies
         self._connector = aiohttp.TCPConnector()
+        self._dispatch_queue_size = dispatch_queue_size
+        self._dispatch_policy = dispatch_policy
+        self._parse_executor = parse_executor
+        self._capture = capture
+        self._lazy_parsing = lazy_parsing
+        # Projection of ClientStateUpdates parsed from the channel, or None to
+        # parse all of them:
+        self.projection = projection
+        # Base URLs of the talkgadget and chat API servers:
+        self._talkgadget_url = base_url or ORIGIN_URL
+        self._api_url = base_url or API_URL
 
         # hangups.channel.Channel instantiated in connect()
         self._channel = None
@@ -88,6 +130,22 @@ class Client(object):
     # Public methods
     ##########################################################################
 
+    @property
+    def dispatch_queue_depth(self):
+        """Number of channel submission items waiting to be dispatched."""
+        if self._channel is None:
+            return 0
+        return self._channel.dispatch_queue_depth
+
+    @property
+    def dispatch_lag(self):
+        """Seconds the oldest undispatched channel submission item has waited
+        for.
+        """
+        if self._channel is None:
+            return 0.0
+        return self._channel.dispatch_lag
+
     def disconnect(self):
         """Disconnect from the server and stop loop."""
         if self._channel and self._channel.is_connected:
@@ -101,7 +159,10 @@ class Client(object):
         initial_data = yield from self._initialize_chat()
         self._channel = channel.Channel(
             self._cookies, self._channel_path, self._clid,
-            self._channel_ec_param, self._channel_prop_param, self._connector
+            self._channel_ec_param, self._channel_prop_param, self._connector,
+            dispatch_queue_size=self._dispatch_queue_size,
+            dispatch_policy=self._dispatch_policy, capture=self._capture,
+            base_url=self._talkgadget_url
         )
 
         self._channel.on_connect.add_observer(
@@ -138,77 +199,26 @@ class Client(object):
         """
         try:
             res = yield from http_utils.fetch(
-                'get', CHAT_INIT_URL, cookies=self._cookies,
-                params=CHAT_INIT_PARAMS, connector=self._connector
+                'get', self._talkgadget_url + CHAT_INIT_PATH,
+                cookies=self._cookies,
+                params=CHAT_INIT_PARAMS, connector=self._connector,
+                capture=self._capture
             )
         except exceptions.NetworkError as e:
             raise exceptions.HangupsError('Initialize chat request failed: {}'
                                           .format(e))
 
-        # Parse the response by using a regex to find all the JS objects, and
-        # parsing them. Not everything will be parsable, but we don't care if
-        # an object we don't need can't be parsed.
-        data_dict = {}
-        for data in CHAT_INIT_REGEX.findall(res.body.decode()):
-            try:
-                data = javascript.loads(data)
-                # pylint: disable=invalid-sequence-index
-                data_dict[data['key']] = data['data']
-            except ValueError as e:
-                logger.debug('Failed to parse initialize chat object: {}\n{}'
-                             .format(e, data))
-
-        # Extract various values that we will need.
-        try:
-            self._api_key = data_dict['ds:7'][0][2]
-            self._header_date = data_dict['ds:2'][0][4]
-            self._header_version = data_dict['ds:2'][0][6]
-            self._header_id = data_dict['ds:4'][0][7]
-            self._channel_path = data_dict['ds:4'][0][1]
-            self._clid = data_dict['ds:4'][0][7]
-            self._channel_ec_param = data_dict['ds:4'][0][4]
-            self._channel_prop_param = data_dict['ds:4'][0][5]
-            _sync_timestamp = parsers.from_timestamp(
-                data_dict['ds:21'][0][1][4]
-            )
-        except KeyError as e:
-            raise exceptions.HangupsError('Failed to get initialize chat '
-                                          'value: {}'.format(e))
-
-        # Parse the entity representing the current user.
-        self_entity = schemas.CLIENT_GET_SELF_INFO_RESPONSE.parse(
-            data_dict['ds:20'][0]
-        ).self_entity
-
-        # Parse every existing conversation's state, including participants.
-        initial_conv_states = schemas.CLIENT_CONVERSATION_STATE_LIST.parse(
-            data_dict['ds:19'][0][3]
-        )
-        initial_conv_parts = []
-        for conv_state in initial_conv_states:
-            initial_conv_parts.extend(conv_state.conversation.participant_data)
-
-        # Parse the entities for the user's contacts (doesn't include users not
-        # in contacts). If this fails, continue without the rest of the
-        # entities.
-        initial_entities = []
-        try:
-            entities = schemas.INITIAL_CLIENT_ENTITIES.parse(
-                data_dict['ds:21'][0]
-            )
-        except ValueError as e:
-            logger.warning('Failed to parse initial client entities: {}'
-                           .format(e))
-        else:
-            initial_entities.extend(entities.entities)
-            initial_entities.extend(e.entity for e in itertools.chain(
-                entities.group1.entity, entities.group2.entity,
-                entities.group3.entity, entities.group4.entity,
-                entities.group5.entity
-            ))
-
-        return InitialData(initial_conv_states, self_entity, initial_entities,
-                           initial_conv_parts, _sync_timestamp)
+        values, initial_data = yield from self._parse(_parse_chat_init,
+                                                      res.body)
+        self._api_key = values['api_key']
+        self._header_date = values['header_date']
+        self._header_version = values['header_version']
+        self._header_id = values['header_id']
+        self._channel_path = values['channel_path']
+        self._clid = values['clid']
+        self._channel_ec_param = values['channel_ec_param']
+        self._channel_prop_param = values['channel_prop_param']
+        return initial_data
 
     def _get_authorization_header(self):
         """Return autorization header for chat API request."""
@@ -235,10 +245,35 @@ class Client(object):
             "en"
         ]
 
+    @asyncio.coroutine
+    def _parse(self, parser, *args):
+        """Return the result of parser(*args).
+
+        The parser is run in the parse executor if the client has one.
+        """
+        if self._parse_executor is None:
+            return parser(*args)
+        return (yield from asyncio.get_event_loop().run_in_executor(
+            self._parse_executor, parser, *args
+        ))
+
     def _on_push_data(self, submission):
-        """Parse ClientStateUpdate and call the appropriate events."""
-        for state_update in parsers.parse_submission(submission):
-            self.on_state_update.fire(state_update)
+        """Parse ClientStateUpdate and call the appropriate events.
+
+        Invalid lazy ClientStateUpdates raise ValueError when an observer
+        accesses an invalid field, so they're logged and skipped here, like
+        invalid ClientStateUpdates are when they're parsed.
+        """
+        for state_update in parsers.parse_submission(
+                submission, lazy=self._lazy_parsing, projection=self.projection
+        ):
+            try:
+                self.on_state_update.fire(state_update)
+            except ValueError as e:
+                if not self._lazy_parsing:
+                    raise
+                logger.warning('Failed to parse ClientStateUpdate: {}'
+                               .format(e))
 
     @asyncio.coroutine
     def _request(self, endpoint, body_json, use_json=True):
@@ -246,7 +281,7 @@ class Client(object):
 
         Raises hangups.NetworkError if the request fails.
         """
-        url = 'https://clients6.google.com/chat/v1/{}'.format(endpoint)
+        url = '{}/chat/v1/{}'.format(self._api_url, endpoint)
         headers = {
             'authorization': self._get_authorization_header(),
             'x-origin': ORIGIN_URL,
@@ -265,7 +300,8 @@ class Client(object):
 
         res = yield from http_utils.fetch(
             'post', url, headers=headers, cookies=cookies, params=params,
-            data=json.dumps(body_json), connector=self._connector
+            data=json.dumps(body_json), connector=self._connector,
+            capture=self._capture
         )
         logger.debug('Response to request for {} was {}:\n{}'
                      .format(endpoint, res.code, res.body))
@@ -276,30 +312,35 @@ class Client(object):
     ###########################################################################
 
     @asyncio.coroutine
-    def syncallnewevents(self, timestamp):
+    def syncallnewevents(self, timestamp, projection=None):
         """List all events occuring at or after timestamp.
 
         This method requests protojson rather than json so we have one chat
         message parser rather than two.
 
-        timestamp: datetime.datetime instance specifying the time after
-        which to return all events occuring in.
+        timestamp: microsecond timestamp, or datetime.datetime instance,
+        specifying the time after which to return all events occuring in.
+        It's truncated to the second.
+
+        projection is an optional projection of the response (see
+        hangups.pblite).
 
         Raises hangups.NetworkError if the request fails.
 
         Returns a ClientSyncAllNewEventsResponse.
         """
+        if isinstance(timestamp, datetime.datetime):
+            timestamp = parsers.to_timestamp(timestamp)
         res = yield from self._request('conversations/syncallnewevents', [
             self._get_request_header(),
             # last_sync_timestamp
-            int(timestamp.timestamp()) * 1000000,
+            timestamp // 1000000 * 1000000,
             [], None, [], False, [],
             1048576 # max_response_size_bytes
         ], use_json=False)
         try:
-            res = schemas.CLIENT_SYNC_ALL_NEW_EVENTS_RESPONSE.parse(
-                javascript.loads(res.body.decode())
-            )
+            res = yield from self._parse(_parse_sync_all_new_events,
+                                         res.body, projection)
         except ValueError as e:
             raise exceptions.NetworkError('Response failed to parse: {}'
                                           .format(e))
@@ -550,3 +591,98 @@ class Client(object):
                            .format(res_status))
             raise exceptions.NetworkError()
 
+
+##############################################################################
+# Response parsers
+##############################################################################
+
+# These are module-level functions of the response body, so they can be run in
+# another process by a parse executor.
+
+
+def _parse_chat_init(body):
+    """Parse the response body of the initialize chat request.
+
+    Returns (values, initial_data), where values is a dict of the request
+    parameters needed by Client, and initial_data is an InitialData instance.
+
+    Raises hangups.HangupsError if a required value is missing.
+    """
+    # Parse the response by using a regex to find all the JS objects, and
+    # parsing them. Not everything will be parsable, but we don't care if
+    # an object we don't need can't be parsed.
+    data_dict = {}
+    for data in CHAT_INIT_REGEX.findall(body.decode()):
+        try:
+            data = javascript.loads(data)
+            # pylint: disable=invalid-sequence-index
+            data_dict[data['key']] = data['data']
+        except ValueError as e:
+            logger.debug('Failed to parse initialize chat object: {}\n{}'
+                         .format(e, data))
+
+    # Extract various values that we will need.
+    try:
+        values = {
+            'api_key': data_dict['ds:7'][0][2],
+            'header_date': data_dict['ds:2'][0][4],
+            'header_version': data_dict['ds:2'][0][6],
+            'header_id': data_dict['ds:4'][0][7],
+            'channel_path': data_dict['ds:4'][0][1],
+            'clid': data_dict['ds:4'][0][7],
+            'channel_ec_param': data_dict['ds:4'][0][4],
+            'channel_prop_param': data_dict['ds:4'][0][5],
+        }
+        _sync_timestamp = data_dict['ds:21'][0][1][4]
+    except KeyError as e:
+        raise exceptions.HangupsError('Failed to get initialize chat '
+                                      'value: {}'.format(e))
+
+    # Parse the entity representing the current user.
+    self_entity = schemas.CLIENT_GET_SELF_INFO_RESPONSE.parse(
+        data_dict['ds:20'][0]
+    ).self_entity
+
+    # Parse every existing conversation's state, including participants.
+    initial_conv_states = schemas.CLIENT_CONVERSATION_STATE_LIST.parse(
+        data_dict['ds:19'][0][3]
+    )
+    initial_conv_parts = []
+    for conv_state in initial_conv_states:
+        initial_conv_parts.extend(conv_state.conversation.participant_data)
+
+    # Parse the entities for the user's contacts (doesn't include users not
+    # in contacts). If this fails, continue without the rest of the
+    # entities.
+    initial_entities = []
+    try:
+        entities = schemas.INITIAL_CLIENT_ENTITIES.parse(
+            data_dict['ds:21'][0]
+        )
+    except ValueError as e:
+        logger.warning('Failed to parse initial client entities: {}'
+                       .format(e))
+    else:
+        initial_entities.extend(entities.entities)
+        initial_entities.extend(e.entity for e in itertools.chain(
+            entities.group1.entity, entities.group2.entity,
+            entities.group3.entity, entities.group4.entity,
+            entities.group5.entity
+        ))
+
+    return values, InitialData(initial_conv_states, self_entity,
+                               initial_entities, initial_conv_parts,
+                               _sync_timestamp)
+
+
+def _parse_sync_all_new_events(body, projection=None):
+    """Parse the response body of a syncallnewevents request.
+
+    Returns a ClientSyncAllNewEventsResponse, parsed with an optional
+    projection.
+
+    Raises ValueError if the response fails to parse.
+    """
+    return schemas.CLIENT_SYNC_ALL_NEW_EVENTS_RESPONSE.parse(
+        javascript.loads(body.decode()), projection=projection
+    )
@@ -1,26 +1,76 @@
 """Conversation objects."""
 
 import asyncio
+import bisect
+import collections.abc
+import datetime
+import itertools
 import logging
 
-from hangups import parsers, event, user, conversation_event, exceptions
+from hangups import (parsers, event, user, conversation_event, exceptions,
+                     pblite, schemas, search)
 
 logger = logging.getLogger(__name__)
 
+# Projection of the ClientStateUpdate fields ConversationList always uses.
+REQUIRED_PROJECTION = {
+    'client_conversation': None,
+    'typing_notification': None,
+    'event_notification': {
+        'event': {
+            'conversation_id': None,
+            'sender_id': None,
+            'timestamp': None,
+            'event_id': None,
+            'self_event_state': {'client_generated_id'},
+        },
+    },
+}
+# Default number of recent events each Conversation remembers to drop
+# duplicates:
+DEDUP_INDEX_SIZE = 1000
+
 
 class Conversation(object):
 
     """Wrapper around Client for working with a single chat conversation."""
 
     def __init__(self, client, user_list, client_conversation,
-                 client_events=[]):
-        """Initialize a new Conversation."""
+                 client_events=[], max_events=None, max_age=None,
+                 dedup_index_size=DEDUP_INDEX_SIZE, store=None):
+        """Initialize a new Conversation.
+
+        max_events and max_age are optional limits on the events which are
+        kept: their number, and their age in seconds relative to the newest
+        event. Events beyond the limits are evicted as events are added.
+
+        dedup_index_size is the number of recent events whose IDs are
+        remembered to drop duplicates.
+
+        store is an optional EventStore which get_history loads events which
+        aren't kept from.
+        """
         self._client = client  # Client
         self._user_list = user_list  # UserList
+        self._store = store  # EventStore or None
         self._conversation = client_conversation  # ClientConversation
-        self._events = []  # [ConversationEvent]
-        for event_ in client_events:
-            self.add_event(event_)
+        self._last_modified = None  # datetime, created when first needed
+        self._max_events = max_events
+        self._max_age_us = (None if max_age is None else
+                            int(max_age * 1000000))
+        # [ConversationEvent] sorted by timestamp, from the index of the
+        # oldest event which hasn't been evicted. Evicted events are replaced
+        # by None, and removed once they make up half of the list.
+        self._events = []
+        self._timestamps = []  # [int] timestamps of _events
+        self._first = 0
+        self._dedup_index_size = dedup_index_size
+        # {event ID: timestamp} of recent events. Events are also indexed by
+        # ('client_generated_id', client_generated_id). Only IDs are kept, so
+        # evicted events aren't kept alive by the index.
+        self._dedup_index = {}
+        # Lists of the keys of each event in _dedup_index, oldest first:
+        self._dedup_keys = collections.deque()
 
         # Event fired when a user starts or stops typing with arguments
         # (typing_message).
@@ -28,27 +78,94 @@ class Conversation(object):
         # Event fired when a new ConversationEvent arrives with arguments
         # (ConversationEvent).
         self.on_event = event.Event('Conversation.on_event')
+        # Event fired when events are evicted with arguments
+        # ([ConversationEvent]).
+        self.on_evict = event.Event('Conversation.on_evict')
+
+        for event_ in client_events:
+            self.add_event(event_)
 
     def update_conversation(self, client_conversation):
         """Update the internal ClientConversation."""
         self._conversation = client_conversation
+        self._last_modified = None
 
     def add_event(self, event_):
         """Add a ClientEvent to the Conversation.
 
-        Returns an instance of ConversationEvent or subclass.
+        Returns an instance of ConversationEvent or subclass, or None if the
+        event is a duplicate of a recent event with the same event_id or
+        client_generated_id.
+
+        Events are kept sorted by timestamp. An event newer than the others
+        is appended in O(1) time. An older event's position is found in
+        O(log n) time, but inserting it moves every newer event, which is
+        O(n). Events arrive almost in order, so usually few are moved.
         """
-        if event_.chat_message is not None:
-            conv_event = conversation_event.ChatMessageEvent(event_)
-        elif event_.conversation_rename is not None:
-            conv_event = conversation_event.RenameEvent(event_)
-        elif event_.membership_change is not None:
-            conv_event = conversation_event.MembershipChangeEvent(event_)
+        keys = _get_dedup_keys(event_)
+        for key in keys:
+            if key in self._dedup_index:
+                logger.debug('Dropping duplicate event: {}'.format(key))
+                return None
+        conv_event = conversation_event.from_client_event(event_)
+        timestamp = event_.timestamp
+        if keys:
+            for key in keys:
+                self._dedup_index[key] = timestamp
+            self._dedup_keys.append(keys)
+            if len(self._dedup_keys) > self._dedup_index_size:
+                for key in self._dedup_keys.popleft():
+                    del self._dedup_index[key]
+        if not self._timestamps or timestamp >= self._timestamps[-1]:
+            self._events.append(conv_event)
+            self._timestamps.append(timestamp)
         else:
-            conv_event = conversation_event.ConversationEvent(event_)
-        self._events.append(conv_event)
+            # Events after this one, like later events from the channel, may
+            # already have been added.
+            index = bisect.bisect_right(self._timestamps, timestamp,
+                                        self._first)
+            self._events.insert(index, conv_event)
+            self._timestamps.insert(index, timestamp)
+        if self._max_events is not None or self._max_age_us is not None:
+            self._evict()
         return conv_event
 
+    def _evict(self):
+        """Evict the oldest events beyond the limits, firing on_evict."""
+        first = self._first
+        if self._max_events is not None:
+            first = max(first, len(self._events) - self._max_events)
+        if self._max_age_us is not None:
+            first = max(first, bisect.bisect_left(
+                self._timestamps, self._timestamps[-1] - self._max_age_us,
+                self._first
+            ))
+        if first > self._first:
+            evicted = self._events[self._first:first]
+            if first * 2 >= len(self._events):
+                del self._events[:first]
+                del self._timestamps[:first]
+                self._first = 0
+            else:
+                self._events[self._first:first] = [None] * len(evicted)
+                self._first = first
+            self.on_evict.fire(evicted)
+
+    def get_event(self, event_id):
+        """Return a recent ConversationEvent from its event_id.
+
+        Raises KeyError if the event ID isn't one of the recent events, or
+        the event has been evicted.
+        """
+        timestamp = self._dedup_index[event_id]
+        index = bisect.bisect_left(self._timestamps, timestamp, self._first)
+        while (index < len(self._timestamps) and
+               self._timestamps[index] == timestamp):
+            if self._events[index].id_ == event_id:
+                return self._events[index]
+            index += 1
+        raise KeyError(event_id)
+
     def get_user(self, user_id):
         """Return the User instance with the given UserID."""
         return self._user_list.get_user(user_id)
@@ -87,27 +204,181 @@ class Conversation(object):
         """The conversation's custom name, or None if it doesn't have one."""
         return self._conversation.name
 
+    @property
+    def last_modified_us(self):
+        """Microsecond timestamp of when the conversation was last modified."""
+        return self._conversation.self_conversation_state.sort_timestamp
+
     @property
     def last_modified(self):
         """datetime timestamp of when the conversation was last modified."""
-        return parsers.from_timestamp(
-            self._conversation.self_conversation_state.sort_timestamp
-        )
+        if self._last_modified is None:
+            self._last_modified = parsers.from_timestamp(
+                self.last_modified_us
+            )
+        return self._last_modified
 
     @property
     def events(self):
-        """The list of ConversationEvents, sorted oldest to newest."""
-        return list(self._events)
+        """EventsView of the ConversationEvents, sorted oldest to newest."""
+        return EventsView(self)
+
+    def events_between(self, start, end):
+        """Return an EventsView of the events from start until before end.
+
+        start and end are microsecond timestamps or datetimes.
+        """
+        return EventsView(self, start=start, end=end)
+
+    def latest(self, num_events):
+        """Return an EventsView of the newest num_events events."""
+        return EventsView(self, limit=num_events)
+
+    def before(self, timestamp, num_events):
+        """Return an EventsView of the newest num_events events before a
+        microsecond or datetime timestamp.
+        """
+        return EventsView(self, end=timestamp, limit=num_events)
+
+    @asyncio.coroutine
+    def get_history(self, timestamp, num_events):
+        """Return a list of the newest num_events ConversationEvents before
+        a microsecond or datetime timestamp, oldest first.
+
+        Events which are kept are returned from memory, and older events are
+        loaded from the store, if there is one.
+
+        Raises sqlite3.Error if loading events from the store fails.
+        """
+        if isinstance(timestamp, datetime.datetime):
+            timestamp = parsers.to_timestamp(timestamp)
+        conv_events = list(self.before(timestamp, num_events))
+        if len(conv_events) < num_events and self._store is not None:
+            client_events = yield from self._store.get_events(
+                self.id_, end=(conv_events[0].timestamp_us if conv_events
+                               else timestamp),
+                limit=num_events - len(conv_events)
+            )
+            conv_events[:0] = [conversation_event.from_client_event(event_)
+                               for event_ in client_events]
+        return conv_events
+
+
+class EventsView(collections.abc.Sequence):
+
+    """Read-only sequence of a range of a Conversation's ConversationEvents,
+    sorted oldest to newest.
+
+    The range is the events with timestamps from start until before end,
+    limited to the newest limit events, where any of these may be None. The
+    view doesn't copy the events, and reflects events being added and
+    evicted. Finding the range takes O(log n) time.
+    """
+
+    def __init__(self, conversation, start=None, end=None, limit=None):
+        if isinstance(start, datetime.datetime):
+            start = parsers.to_timestamp(start)
+        if isinstance(end, datetime.datetime):
+            end = parsers.to_timestamp(end)
+        self._conversation = conversation
+        self._start = start
+        self._end = end
+        self._limit = limit
+
+    def __len__(self):
+        lower, upper = self._get_range()
+        return upper - lower
+
+    def __getitem__(self, index):
+        lower, upper = self._get_range()
+        events = self._conversation._events
+        if isinstance(index, slice):
+            return [events[lower + i]
+                    for i in range(*index.indices(upper - lower))]
+        if index < 0:
+            index += upper - lower
+        if not 0 <= index < upper - lower:
+            raise IndexError('event index out of range')
+        return events[lower + index]
+
+    def __iter__(self):
+        lower, upper = self._get_range()
+        return itertools.islice(self._conversation._events, lower, upper)
+
+    def __reversed__(self):
+        lower, upper = self._get_range()
+        events = self._conversation._events
+        return itertools.islice(reversed(events), len(events) - upper,
+                                len(events) - lower)
+
+    def _get_range(self):
+        """Return the indexes of the events in the view in _events."""
+        timestamps = self._conversation._timestamps
+        lower = self._conversation._first
+        upper = len(timestamps)
+        if self._start is not None:
+            lower = bisect.bisect_left(timestamps, self._start, lower)
+        if self._end is not None:
+            upper = max(lower, bisect.bisect_left(timestamps, self._end,
+                                                  lower))
+        if self._limit is not None:
+            lower = max(lower, upper - self._limit)
+        return lower, upper
 
 
 class ConversationList(object):
     """Wrapper around Client that maintains a list of Conversations."""
 
-    def __init__(self, client, conv_states, user_list, sync_timestamp):
+    def __init__(self, client, conv_states, user_list, sync_timestamp,
+                 projection=None, max_events=None, max_age=None,
+                 store=None, search_index=None):
+        """Initialize a new ConversationList.
+
+        sync_timestamp is the microsecond timestamp of the conversation
+        states (a datetime is also accepted). Events after it are synced when
+        the client connects.
+
+        projection is an optional projection of ClientStateUpdates (see
+        hangups.pblite), for example to only parse chat messages and typing
+        notifications. It's merged with REQUIRED_PROJECTION and set as the
+        client's projection, and events and conversations are synced with
+        the corresponding parts of it. Fields outside the projection are None.
+
+        max_events and max_age limit the events kept by each Conversation.
+
+        store is an optional EventStore which conversations and events are
+        written to, and which Conversation.get_history loads events which
+        aren't kept from. Only the parts of them in the projection are
+        written.
+
+        search_index is an optional search.SearchIndex which chat messages
+        are added to for search, and removed from when they're evicted.
+
+        Raises ValueError if the projection is invalid.
+        """
         self._client = client  # Client
+        # Projections of ClientStateUpdate and ClientSyncAllNewEventsResponse:
+        self._projection = None
+        self._sync_projection = None
+        if projection is not None:
+            self._projection = pblite.merge_projections(projection,
+                                                        REQUIRED_PROJECTION)
+            self._sync_projection = _get_sync_projection(self._projection)
+            schemas.CLIENT_STATE_UPDATE.check_projection(self._projection)
+            self._client.projection = self._projection
         self._conv_dict = {}  # {conv_id: Conversation}
-        self._sync_timestamp = sync_timestamp  # datetime
+        if isinstance(sync_timestamp, datetime.datetime):
+            sync_timestamp = parsers.to_timestamp(sync_timestamp)
+        self._sync_timestamp = sync_timestamp  # int, microseconds
         self._user_list = user_list # UserList
+        self._max_events = max_events
+        self._max_age = max_age
+        self._store = store  # EventStore or None
+        self._search_index = search_index  # SearchIndex or None
+
+        # Event fired when a Conversation evicts events with arguments
+        # ([ConversationEvent]).
+        self.on_evict = event.Event('ConversationList.on_evict')
 
         # Initialize the list of conversations from Client's list of
         # ClientConversationStates.
@@ -127,6 +398,9 @@ class ConversationList(object):
         # Event fired when a user starts or stops typing with arguments
         # (typing_message).
         self.on_typing = event.Event('ConversationList.on_typing')
+        if search_index is not None:
+            self.on_event.add_observer(search_index.add_event)
+            self.on_evict.add_observer(search_index.remove_events)
 
     def get_all(self):
         """Return list of all Conversations."""
@@ -139,14 +413,43 @@ class ConversationList(object):
         """
         return self._conv_dict[conv_id]
 
+    @asyncio.coroutine
+    def search(self, query, conv_ids=None, limit=search.DEFAULT_LIMIT):
+        """Return a list of search.SearchResults of the newest chat messages
+        containing every word of query, newest first.
+
+        If conv_ids isn't None, only the conversations with those IDs are
+        searched. The search index is searched if there is one, otherwise the
+        store is.
+
+        Raises ValueError if there is no search index, and no store with
+        full_text enabled.
+        """
+        if self._search_index is not None:
+            return self._search_index.search(query, conv_ids=conv_ids,
+                                             limit=limit)
+        if self._store is None:
+            raise ValueError('ConversationList has no search index or store')
+        return (yield from self._store.search(query, conv_ids=conv_ids,
+                                              limit=limit))
+
     def add_conversation(self, client_conversation, client_events=[]):
         """Add new conversation from ClientConversation"""
         conv_id = client_conversation.conversation_id.id_
         logger.info('Adding new conversation: {}'.format(conv_id))
         conv = Conversation(
-            self._client, self._user_list,
-            client_conversation, client_events
+            self._client, self._user_list, client_conversation,
+            max_events=self._max_events, max_age=self._max_age,
+            store=self._store
         )
+        conv.on_evict.add_observer(self.on_evict.fire)
+        for event_ in client_events:
+            conv_event = conv.add_event(event_)
+            if conv_event is not None and self._search_index is not None:
+                self._search_index.add_event(conv_event)
+        if self._store is not None:
+            self._store.add_conversation(client_conversation)
+            self._store.add_events(client_events)
         self._conv_dict[conv_id] = conv
         return conv
 
@@ -163,7 +466,7 @@ class ConversationList(object):
 
     def _on_client_event(self, event_):
         """Receive a ClientEvent and fan out to Conversations."""
-        self._sync_timestamp = parsers.from_timestamp(event_.timestamp)
+        self._sync_timestamp = event_.timestamp
         try:
             conv = self._conv_dict[event_.conversation_id.id_]
         except KeyError:
@@ -171,8 +474,11 @@ class ConversationList(object):
                            .format(event_.conversation_id.id_))
         else:
             conv_event = conv.add_event(event_)
-            self.on_event.fire(conv_event)
-            conv.on_event.fire(conv_event)
+            if conv_event is not None:
+                if self._store is not None:
+                    self._store.add_events([event_])
+                self.on_event.fire(conv_event)
+                conv.on_event.fire(conv_event)
 
     def _handle_client_conversation(self, client_conversation):
         """Receive ClientConversation and create or update the conversation."""
@@ -180,6 +486,8 @@ class ConversationList(object):
         conv = self._conv_dict.get(conv_id, None)
         if conv is not None:
             conv.update_conversation(client_conversation)
+            if self._store is not None:
+                self._store.add_conversation(client_conversation)
         else:
             self.add_conversation(client_conversation)
 
@@ -198,9 +506,13 @@ class ConversationList(object):
     @asyncio.coroutine
     def _sync(self):
         """Sync conversation state and events that could have been missed."""
-        logger.info('Syncing events since {}'.format(self._sync_timestamp))
+        logger.info('Syncing events since {}'.format(
+            parsers.from_timestamp(self._sync_timestamp)
+        ))
         try:
-            res = yield from self._client.syncallnewevents(self._sync_timestamp)
+            res = yield from self._client.syncallnewevents(
+                self._sync_timestamp, projection=self._sync_projection
+            )
         except exceptions.NetworkError as e:
             logger.warning('Failed to sync events, some events may be lost: {}'
                            .format(e))
@@ -210,12 +522,43 @@ class ConversationList(object):
                 conv = self._conv_dict.get(conv_id, None)
                 if conv is not None:
                     conv.update_conversation(conv_state.conversation)
+                    if self._store is not None:
+                        self._store.add_conversation(conv_state.conversation)
                     for event_ in conv_state.event:
-                        timestamp = parsers.from_timestamp(event_.timestamp)
-                        if timestamp > self._sync_timestamp:
+                        if event_.timestamp > self._sync_timestamp:
                             # This updates the sync_timestamp for us, as well
                             # as triggering events.
                             self._on_client_event(event_)
                 else:
                     self.add_conversation(conv_state.conversation,
                                           conv_state.event)
+
+
+def _get_dedup_keys(client_event):
+    """Return the keys of a ClientEvent in a Conversation's dedup index."""
+    keys = []
+    if client_event.event_id is not None:
+        keys.append(client_event.event_id)
+    if (client_event.self_event_state is not None and
+            client_event.self_event_state.client_generated_id is not None):
+        keys.append(('client_generated_id',
+                     client_event.self_event_state.client_generated_id))
+    return keys
+
+
+def _get_sync_projection(projection):
+    """Return the projection of ClientSyncAllNewEventsResponse which parses
+    the same parts of conversations and events as a projection of
+    ClientStateUpdate which contains REQUIRED_PROJECTION.
+    """
+    event_notification = projection['event_notification']
+    return {
+        'response_header': None,
+        'sync_timestamp': None,
+        'conversation_state': {
+            'conversation_id': None,
+            'conversation': projection['client_conversation'],
+            'event': (None if event_notification is None else
+                      event_notification['event']),
+        },
+    }
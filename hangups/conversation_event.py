@@ -2,7 +2,8 @@
 
 These classes are wrappers for ClientEvent instances from the API. Parsing is
 done through property methods, which prefer logging warnings to raising
-exceptions.
+exceptions. Values derived from the ClientEvent are cached when they are first
+accessed.
 """
 
 import logging
@@ -21,19 +22,39 @@ class ConversationEvent(object):
     This is the base class for such events.
     """
 
+    __slots__ = ('_event', '_timestamp', '_user_id')
+
     def __init__(self, client_event):
         self._event = client_event
+        self._timestamp = None  # datetime, created when first needed
+        self._user_id = None  # UserID, created when first needed
+
+    @property
+    def id_(self):
+        """The ID of the event."""
+        return self._event.event_id
+
+    @property
+    def timestamp_us(self):
+        """A microsecond timestamp of when the event occurred."""
+        return self._event.timestamp
 
     @property
     def timestamp(self):
-        """A timestamp of when the event occurred."""
-        return parsers.from_timestamp(self._event.timestamp)
+        """A datetime timestamp of when the event occurred."""
+        if self._timestamp is None:
+            self._timestamp = parsers.from_timestamp(self._event.timestamp)
+        return self._timestamp
 
     @property
     def user_id(self):
         """A UserID indicating who created the event."""
-        return user.UserID(chat_id=self._event.sender_id.chat_id,
-                           gaia_id=self._event.sender_id.gaia_id)
+        if self._user_id is None:
+            self._user_id = user.UserID(
+                chat_id=self._event.sender_id.chat_id,
+                gaia_id=self._event.sender_id.gaia_id
+            )
+        return self._user_id
 
     @property
     def conversation_id(self):
@@ -45,6 +66,9 @@ class ChatMessageSegment(object):
 
     """A segment of a chat message."""
 
+    __slots__ = ('type_', 'text', 'is_bold', 'is_italic', 'is_strikethrough',
+                 'is_underline', 'link_target')
+
     def __init__(self, text, segment_type=None,
                  is_bold=False, is_italic=False, is_strikethrough=False,
                  is_underline=False, link_target=None):
@@ -99,32 +123,54 @@ class ChatMessageEvent(ConversationEvent):
     Corresponds to ClientChatMessage in the API.
     """
 
+    __slots__ = ('_text', '_segments', '_attachments')
+
+    def __init__(self, client_event):
+        super().__init__(client_event)
+        self._text = None
+        self._segments = None
+        self._attachments = None
+
     @property
     def text(self):
         """A textual representation of the message."""
-        lines = ['']
-        for segment in self.segments:
-            if segment.type_ == schemas.SegmentType.TEXT:
-                lines[-1] += segment.text
-            elif segment.type_ == schemas.SegmentType.LINK:
-                lines[-1] += segment.text
-            elif segment.type_ == schemas.SegmentType.LINE_BREAK:
-                lines.append('')
-            else:
-                logger.warning('Ignoring unknown chat message segment type: {}'
-                               .format(segment.type_))
-        lines.extend(self.attachments)
-        return '\n'.join(lines)
+        if self._text is None:
+            # Read the parsed segments directly rather than creating
+            # ChatMessageSegments.
+            lines = ['']
+            for segment in self._event.chat_message.message_content.segment:
+                if segment.type_ == schemas.SegmentType.TEXT:
+                    lines[-1] += segment.text
+                elif segment.type_ == schemas.SegmentType.LINK:
+                    lines[-1] += segment.text
+                elif segment.type_ == schemas.SegmentType.LINE_BREAK:
+                    lines.append('')
+                else:
+                    logger.warning('Ignoring unknown chat message segment '
+                                   'type: {}'.format(segment.type_))
+            lines.extend(self.attachments)
+            self._text = '\n'.join(lines)
+        return self._text
 
     @property
     def segments(self):
         """List of ChatMessageSegments in the message."""
-        return [ChatMessageSegment.deserialize(seg) for seg in
-                self._event.chat_message.message_content.segment]
+        if self._segments is None:
+            self._segments = [
+                ChatMessageSegment.deserialize(seg) for seg in
+                self._event.chat_message.message_content.segment
+            ]
+        return self._segments
 
     @property
     def attachments(self):
         """Attachments in the message."""
+        if self._attachments is None:
+            self._attachments = self._get_attachments()
+        return self._attachments
+
+    def _get_attachments(self):
+        """Return the attachments in the message."""
         attachments = []
         for attachment in self._event.chat_message.message_content.attachment:
             if attachment.embed_item.type_ == [249]:  # PLUS_PHOTO
@@ -155,6 +201,8 @@ class RenameEvent(ConversationEvent):
     Corresponds to ClientConversationRename in the API.
     """
 
+    __slots__ = ()
+
     @property
     def new_name(self):
         """The conversation's new name.
@@ -179,6 +227,8 @@ class MembershipChangeEvent(ConversationEvent):
     Corresponds to ClientMembershipChange in the API.
     """
 
+    __slots__ = ()
+
     @property
     def type_(self):
         """The membership change type (MembershipChangeType)."""
@@ -192,3 +242,30 @@ class MembershipChangeEvent(ConversationEvent):
         """
         return [user.UserID(chat_id=id_.chat_id, gaia_id=id_.gaia_id)
                 for id_ in self._event.membership_change.participant_ids]
+
+
+def from_client_event(client_event):
+    """Return a ConversationEvent or subclass for a ClientEvent."""
+    if client_event.chat_message is not None:
+        return ChatMessageEvent(client_event)
+    elif client_event.conversation_rename is not None:
+        return RenameEvent(client_event)
+    elif client_event.membership_change is not None:
+        return MembershipChangeEvent(client_event)
+    else:
+        return ConversationEvent(client_event)
+
+
+def from_raw(raw_event):
+    """Return a ConversationEvent or subclass for the pblite list of a
+    ClientEvent.
+
+    The ClientEvent is parsed lazily (see pblite.Message.parse), so only the
+    fields the event's properties use are ever parsed, and no records are
+    created for the rest.
+
+    Raises ValueError if the input is not a list. Invalid fields raise
+    ValueError when the properties using them are accessed.
+    """
+    return from_client_event(schemas.CLIENT_EVENT.parse(raw_event,
+                                                        lazy=True))
@@ -0,0 +1,218 @@
+"""Columnar storage of ClientEvents for history exports and analytics.
+
+Parsing a RepeatedField(CLIENT_EVENT) produces a tree of records for every
+event. EventColumns instead keeps one array per field, so millions of events
+take little memory and can be scanned quickly: timestamps, indexes of
+interned conversation and sender IDs, event type codes, and offsets into a
+single text buffer holding the text of every chat message.
+"""
+
+import array
+import bisect
+import collections
+
+from hangups import conversation_event, schemas
+
+# Event type codes:
+OTHER = 0
+CHAT_MESSAGE = 1
+RENAME = 2
+MEMBERSHIP_CHANGE = 3
+HANGOUT = 4
+OTR_MODIFICATION = 5
+
+# Minimum length of the chunks text is joined into:
+_CHUNK_SIZE = 4096
+
+# Projection of the fields of ClientEvent which are stored. Messages which
+# only decide the type of event are projected to none of their fields.
+_PROJECTION = {
+    'conversation_id': None,
+    'sender_id': None,
+    'timestamp': None,
+    'chat_message': None,
+    'conversation_rename': {},
+    'membership_change': {},
+    'hangout_event': {},
+    'otr_modification': {},
+}
+
+ConversationStats = collections.namedtuple('ConversationStats', [
+    'num_events',  # int
+    'num_chat_messages',  # int
+    'first_timestamp',  # int, microseconds
+    'last_timestamp',  # int, microseconds
+])
+
+
+class EventColumns(object):
+
+    """ClientEvents stored in parallel arrays.
+
+    Event i has timestamp timestamps[i], conversation ID
+    ids[conversation_ids[i]], sender chat ID ids[sender_ids[i]] (or None if
+    sender_ids[i] is -1), and type code types[i]. Its text, which is empty
+    unless it's a chat message, is text[text_offsets[i]:text_offsets[i + 1]].
+    """
+
+    def __init__(self):
+        self.timestamps = array.array('q')
+        self.conversation_ids = array.array('i')
+        self.sender_ids = array.array('i')
+        self.types = array.array('b')
+        self.text_offsets = array.array('q', [0])
+        self.ids = []  # [interned ID]
+        self._id_indexes = {}  # {ID: index in ids}
+        # The text is joined into chunks of at least _CHUNK_SIZE characters
+        # when it's read, which never split an event's text:
+        self._text_chunks = []
+        self._chunk_offsets = array.array('q')  # offset of each chunk
+        self._joined_length = 0  # length of the text in chunks
+        self._text_parts = []  # text appended since it was last joined
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    @property
+    def text(self):
+        """The text of every event, concatenated.
+
+        This joins all the text into one string, so use get_text to read the
+        text of single events.
+        """
+        self._join_text_parts()
+        if len(self._text_chunks) > 1:
+            self._text_chunks = [''.join(self._text_chunks)]
+            self._chunk_offsets = array.array('q', [0])
+        return self._text_chunks[0] if self._text_chunks else ''
+
+    def get_text(self, index):
+        """Return the text of an event."""
+        start = self.text_offsets[index]
+        end = self.text_offsets[index + 1]
+        if start == end:
+            return ''
+        if end > self._joined_length:
+            self._join_text_parts()
+        chunk_index = bisect.bisect_right(self._chunk_offsets, start) - 1
+        chunk_offset = self._chunk_offsets[chunk_index]
+        return self._text_chunks[chunk_index][start - chunk_offset:
+                                              end - chunk_offset]
+
+    def append(self, client_event):
+        """Append a parsed ClientEvent.
+
+        Only the fields in _PROJECTION are used, so the event may be parsed
+        with it.
+        """
+        if client_event.chat_message is not None:
+            type_ = CHAT_MESSAGE
+            text = conversation_event.ChatMessageEvent(client_event).text
+        else:
+            text = ''
+            if client_event.conversation_rename is not None:
+                type_ = RENAME
+            elif client_event.membership_change is not None:
+                type_ = MEMBERSHIP_CHANGE
+            elif client_event.hangout_event is not None:
+                type_ = HANGOUT
+            elif client_event.otr_modification is not None:
+                type_ = OTR_MODIFICATION
+            else:
+                type_ = OTHER
+        self.timestamps.append(client_event.timestamp)
+        self.conversation_ids.append(
+            self._intern(client_event.conversation_id.id_)
+        )
+        if client_event.sender_id is None:
+            self.sender_ids.append(-1)
+        else:
+            self.sender_ids.append(
+                self._intern(client_event.sender_id.chat_id)
+            )
+        self.types.append(type_)
+        self._text_parts.append(text)
+        self.text_offsets.append(self.text_offsets[-1] + len(text))
+
+    def extend_raw(self, input_):
+        """Parse and append the input of a RepeatedField(CLIENT_EVENT).
+
+        Each event is parsed with only the fields which are stored, and no
+        records are kept.
+
+        Raises ValueError if the input is not a list, or if an event fails to
+        parse.
+        """
+        if not isinstance(input_, list):
+            raise ValueError('RepeatedField expected list but got {}'
+                             .format(type(input_)))
+        for raw_event in input_:
+            try:
+                client_event = schemas.CLIENT_EVENT.parse(
+                    raw_event, projection=_PROJECTION
+                )
+            except ValueError as e:
+                raise ValueError('RepeatedField item: {}'.format(e))
+            self.append(client_event)
+
+    def get_conversation_stats(self):
+        """Return a dict of ConversationStats by conversation ID."""
+        num_events = collections.Counter(self.conversation_ids)
+        num_chat_messages = collections.Counter(
+            conv_index for conv_index, type_
+            in zip(self.conversation_ids, self.types)
+            if type_ == CHAT_MESSAGE
+        )
+        first = {}
+        last = {}
+        for conv_index, timestamp in zip(self.conversation_ids,
+                                         self.timestamps):
+            if conv_index not in first or timestamp < first[conv_index]:
+                first[conv_index] = timestamp
+            if conv_index not in last or timestamp > last[conv_index]:
+                last[conv_index] = timestamp
+        return {
+            self.ids[conv_index]: ConversationStats(
+                count, num_chat_messages[conv_index], first[conv_index],
+                last[conv_index]
+            ) for conv_index, count in num_events.items()
+        }
+
+    def _join_text_parts(self):
+        """Join the text appended since it was last joined into the chunks.
+
+        The text is added to the last chunk if it's short, so joining after
+        every append copies at most _CHUNK_SIZE characters besides the new
+        text.
+        """
+        if not self._text_parts:
+            return
+        text = ''.join(self._text_parts)
+        self._text_parts = []
+        if (self._text_chunks and
+                len(self._text_chunks[-1]) < _CHUNK_SIZE):
+            self._text_chunks[-1] += text
+        else:
+            self._chunk_offsets.append(self._joined_length)
+            self._text_chunks.append(text)
+        self._joined_length += len(text)
+
+    def _intern(self, id_):
+        """Return the index of an ID in ids, adding it if necessary."""
+        index = self._id_indexes.get(id_)
+        if index is None:
+            index = len(self.ids)
+            self.ids.append(id_)
+            self._id_indexes[id_] = index
+        return index
+
+
+def parse_events(input_):
+    """Return EventColumns from the input of a RepeatedField(CLIENT_EVENT).
+
+    Raises ValueError if the input is not a list, or if an event fails to
+    parse.
+    """
+    columns = EventColumns()
+    columns.extend_raw(input_)
+    return columns
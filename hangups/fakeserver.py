@@ -0,0 +1,384 @@
+"""Fake Hangouts server for load testing.
+
+FakeServer stands in for talkgadget.google.com and clients6.google.com. It
+serves the chat initialization page, the push channel and the chat API
+endpoints used by Client, with synthetic conversations and messages, so
+clients can be measured without connecting to Google:
+
+    server = FakeServer(num_conversations=100, message_rate=500)
+    base_url = yield from server.start()
+    client = hangups.Client(fakeserver.COOKIES, base_url=base_url)
+
+Faults can be injected to exercise error handling under load.
+"""
+
+import aiohttp
+import aiohttp.server
+import asyncio
+import json
+import logging
+import random
+import string
+import time
+import urllib.parse
+
+from hangups import client
+
+logger = logging.getLogger(__name__)
+CHANNEL_PATH = '/u/0/talkgadget/_/channel/'
+API_PATH = '/chat/v1/'
+# Cookies to create clients with, since the fake server doesn't check them:
+COOKIES = {name: 'fake' for name in ['SAPISID', 'HSID', 'SSID', 'APISID',
+                                     'SID']}
+SELF_USER = 0  # user number of the user the clients are signed in as
+
+
+class FakeServer(object):
+
+    """Fake server for the endpoints used by Client.
+
+    Conversations are numbered from 0 to num_conversations - 1, and each has
+    the self user and num_participants - 1 other users. Open long-polling
+    requests receive message_rate chat messages per second in total, in
+    submissions sent every batch_interval seconds. Each message has
+    message_size characters of text.
+
+    Faults are injected with these probabilities:
+        error_rate: a request fails with status 500.
+        unknown_sid_rate: a long-polling request fails with "Unknown SID".
+        disconnect_rate: the connection is closed instead of sending a
+            submission.
+    Every response is also delayed by latency seconds.
+    """
+
+    def __init__(self, num_conversations=10, num_participants=3,
+                 message_rate=1.0, message_size=20, batch_interval=0.1,
+                 heartbeat_interval=15, longpoll_duration=60,
+                 error_rate=0.0, unknown_sid_rate=0.0, disconnect_rate=0.0,
+                 latency=0.0, seed=None):
+        """Create a new fake server."""
+        self._num_conversations = num_conversations
+        self._num_participants = num_participants
+        self._message_rate = message_rate
+        self._message_size = message_size
+        self._batch_interval = batch_interval
+        self._heartbeat_interval = heartbeat_interval
+        self._longpoll_duration = longpoll_duration
+        self._error_rate = error_rate
+        self._unknown_sid_rate = unknown_sid_rate
+        self._disconnect_rate = disconnect_rate
+        self._latency = latency
+        self._random = random.Random(seed)
+
+        # Number of requests received, and chat messages sent:
+        self.num_requests = 0
+        self.num_messages = 0
+
+        self._server = None  # asyncio.Server
+        self._num_sids = 0  # number of SIDs given out so far
+        self._sids = set()  # valid SIDs
+        self._num_events = 0  # number of events created so far
+
+    ##########################################################################
+    # Public methods
+    ##########################################################################
+
+    @asyncio.coroutine
+    def start(self, host='127.0.0.1', port=0):
+        """Start serving, and return the base URL of the server.
+
+        If port is 0, a free port is chosen.
+        """
+        self._server = yield from asyncio.get_event_loop().create_server(
+            lambda: _FakeServerProtocol(self, keep_alive=75), host, port
+        )
+        port = self._server.sockets[0].getsockname()[1]
+        base_url = 'http://{}:{}'.format(host, port)
+        logger.info('Fake server listening on {}'.format(base_url))
+        return base_url
+
+    def close(self):
+        """Stop serving."""
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+    def expire_sessions(self):
+        """Make every channel SID invalid, so the next long-polling request
+        with each of them fails with "Unknown SID".
+        """
+        self._sids.clear()
+
+    def get_chat_init_page(self):
+        """Return the chat initialization page."""
+        timestamp = _now()
+        self_entity = _client_entity(SELF_USER)
+        data = {
+            'ds:2': [[None, None, None, None, 'fake_date', None,
+                      'fake_version']],
+            'ds:4': [[None, CHANNEL_PATH, None, None, '["ci:ec",1,1,0]',
+                      'aChromeExtension', None, 'FAKECLID']],
+            'ds:7': [[None, None, 'fake_api_key']],
+            'ds:19': [['csrcrp', _response_header(timestamp), None,
+                       [self._client_conversation_state(conv_num, timestamp)
+                        for conv_num in range(self._num_conversations)]]],
+            'ds:20': [['cgsirp', _response_header(timestamp), self_entity]],
+            'ds:21': [[
+                'cgserp', _response_header(timestamp),
+                [_client_entity(user_num)
+                 for user_num in range(1, self._num_participants)],
+                None,
+            ] + [[0, 'group{}'.format(i), []] for i in range(1, 6)]],
+        }
+        return ''.join(
+            '<script>AF_initDataCallback({});</script>\n'
+            .format(json.dumps({'key': key, 'data': value}))
+            for key, value in sorted(data.items())
+        )
+
+    def get_sid_response(self):
+        """Return a new channel session, framed as a submission."""
+        self._num_sids += 1
+        sid = 'FAKESID{}'.format(self._num_sids)
+        self._sids.add(sid)
+        return _frame([
+            [0, ['c', sid, None, 8]],
+            [1, ['b']],
+            [2, ['c', [sid, ['cfj', 'user{}@example.com/FAKECLIENT'
+                             .format(SELF_USER)]]]],
+            [3, ['c', [sid, ['ei', 'FAKEGSESSIONID', '1', 0]]]],
+        ])
+
+    def get_message_submission(self, sub_num, sid, num_messages):
+        """Return a submission of num_messages chat messages."""
+        timestamp = _now()
+        state_updates = [
+            [_state_update_header(timestamp), None, [client_event]]
+            for client_event in self.get_client_events([timestamp] *
+                                                       num_messages)
+        ]
+        self.num_messages += num_messages
+        payload = json.dumps(['cbu', state_updates])
+        return _frame([[sub_num, ['c', [sid, ['bfo', payload]]]]])
+
+    def get_client_events(self, timestamps, conv_num=None, event_ids=None):
+        """Return a list of raw ClientEvents of chat messages, one with each
+        microsecond timestamp.
+
+        The events are in conversation conv_num, or in random conversations
+        if it's None, and are sent by random users. event_ids is an optional
+        list of their event IDs, which otherwise are unique.
+        """
+        client_events = []
+        for timestamp in timestamps:
+            event_conv_num = conv_num
+            if event_conv_num is None:
+                event_conv_num = self._random.randrange(
+                    self._num_conversations
+                )
+            user_num = self._random.randrange(self._num_participants)
+            client_events.append(self._client_event(event_conv_num, user_num,
+                                                    timestamp))
+        if event_ids is not None:
+            for client_event, event_id in zip(client_events, event_ids):
+                client_event[11] = event_id
+        return client_events
+
+    def get_sync_all_new_events_response(self):
+        """Return the protojson syncallnewevents response."""
+        timestamp = _now()
+        return json.dumps([
+            'csanerp', _response_header(timestamp), timestamp,
+            [self._client_conversation_state(conv_num, timestamp)
+             for conv_num in range(self._num_conversations)],
+        ])
+
+    ##########################################################################
+    # Private methods
+    ##########################################################################
+
+    @asyncio.coroutine
+    def _handle_request(self, protocol, message, payload):
+        """Respond to a request."""
+        self.num_requests += 1
+        url = urllib.parse.urlsplit(message.path)
+        path = url.path
+        params = urllib.parse.parse_qs(url.query)
+        if self._latency:
+            yield from asyncio.sleep(self._latency)
+        if self._random.random() < self._error_rate:
+            yield from _respond(protocol, message, 500, b'Injected error')
+        elif path == client.CHAT_INIT_PATH:
+            yield from _respond(protocol, message, 200,
+                                self.get_chat_init_page().encode(),
+                                'text/html; charset=utf-8')
+        elif path == CHANNEL_PATH + 'bind' and message.method == 'POST':
+            yield from _respond(protocol, message, 200,
+                                self.get_sid_response().encode())
+        elif path == CHANNEL_PATH + 'bind':
+            yield from self._longpoll(protocol, message,
+                                      params.get('SID', [None])[0])
+        elif path == API_PATH + 'conversations/syncallnewevents':
+            yield from _respond(
+                protocol, message, 200,
+                self.get_sync_all_new_events_response().encode(),
+                'application/json+protobuf'
+            )
+        elif path.startswith(API_PATH):
+            # The other endpoints only need a successful status.
+            yield from _respond(
+                protocol, message, 200,
+                json.dumps({'response_header': {'status': 'OK'}}).encode(),
+                'application/json'
+            )
+        else:
+            yield from _respond(protocol, message, 404, b'Not found')
+
+    @asyncio.coroutine
+    def _longpoll(self, protocol, message, sid):
+        """Stream submissions for a long-polling request."""
+        if (sid not in self._sids or
+                self._random.random() < self._unknown_sid_rate):
+            self._sids.discard(sid)
+            yield from _respond(protocol, message, 400, b'Unknown SID',
+                                reason='Unknown SID')
+            return
+        response = aiohttp.Response(protocol.writer, 200,
+                                    http_version=message.version)
+        response.add_header('Content-Type', 'text/plain; charset=utf-8')
+        response.add_header('Transfer-Encoding', 'chunked')
+        response.send_headers()
+        response.write(_frame([[1, ['noop']]]).encode())
+
+        sub_num = 2
+        start = last_heartbeat = time.monotonic()
+        messages_due = 0.0  # messages to send, including a fraction
+        while time.monotonic() - start < self._longpoll_duration:
+            yield from asyncio.sleep(self._batch_interval)
+            if self._random.random() < self._disconnect_rate:
+                logger.info('Injecting disconnect')
+                protocol.transport.close()
+                return
+            messages_due += self._message_rate * self._batch_interval
+            now = time.monotonic()
+            if messages_due >= 1:
+                num_messages = int(messages_due)
+                messages_due -= num_messages
+                submission = self.get_message_submission(sub_num, sid,
+                                                         num_messages)
+            elif now - last_heartbeat >= self._heartbeat_interval:
+                submission = _frame([[sub_num, ['c', [sid, ['wh']]]]])
+            else:
+                continue
+            last_heartbeat = now
+            sub_num += 1
+            response.write(submission.encode())
+        yield from response.write_eof()
+        if response.keep_alive():
+            protocol.keep_alive(True)
+
+    def _client_conversation_state(self, conv_num, timestamp):
+        """Return a ClientConversationState with no events."""
+        conv_id = _conversation_id(conv_num)
+        return [[conv_id], self._client_conversation(conv_num, timestamp), [],
+                None, None, None, []]
+
+    def _client_conversation(self, conv_num, timestamp):
+        """Return a ClientConversation."""
+        user_ids = [_user_id(user_num)
+                    for user_num in range(self._num_participants)]
+        self_user_id = _user_id(SELF_USER)
+        self_state = ([None] * 6 +
+                      [[self_user_id, timestamp], 2, 30, [1], self_user_id,
+                       timestamp, timestamp, timestamp, None, None, 1, 1])
+        return ([[_conversation_id(conv_num)], 2,
+                 'Conversation {}'.format(conv_num), self_state, 1, 1, None,
+                 [[user_id, timestamp] for user_id in user_ids], 1, 1, 1, 1,
+                 user_ids,
+                 [[_user_id(user_num), 'User {}'.format(user_num)]
+                  for user_num in range(self._num_participants)],
+                 None, None, None, 1, 1])
+
+    def _client_event(self, conv_num, user_num, timestamp):
+        """Return a ClientEvent for a chat message."""
+        self._num_events += 1
+        text = ''.join(self._random.choice(string.ascii_letters + ' ')
+                       for _ in range(self._message_size))
+        return [
+            [_conversation_id(conv_num)], _user_id(user_num), timestamp,
+            None, None, None, [None, [], [[[0, text]], []]], None, None, None,
+            None, 'event{}'.format(self._num_events), True, None, None, 2, 1,
+        ]
+
+
+class _FakeServerProtocol(aiohttp.server.ServerHttpProtocol):
+
+    """HTTP protocol which passes requests to a FakeServer."""
+
+    def __init__(self, server, **kwargs):
+        super().__init__(**kwargs)
+        self._fake_server = server
+
+    @asyncio.coroutine
+    def handle_request(self, message, payload):
+        yield from self._fake_server._handle_request(self, message, payload)
+
+
+@asyncio.coroutine
+def _respond(protocol, message, status, body,
+             content_type='text/plain; charset=utf-8', reason=None):
+    """Send a complete response."""
+    if reason is None:
+        response = aiohttp.Response(protocol.writer, status,
+                                    http_version=message.version)
+    else:
+        response = aiohttp.Response(protocol.writer, status,
+                                    http_version=message.version,
+                                    reason=reason)
+    response.add_header('Content-Type', content_type)
+    response.add_header('Content-Length', str(len(body)))
+    response.send_headers()
+    response.write(body)
+    yield from response.write_eof()
+    if response.keep_alive():
+        protocol.keep_alive(True)
+
+
+def _frame(submission):
+    """Return a submission prefixed with its length, like the push channel."""
+    text = json.dumps(submission)
+    return '{}\n{}'.format(len(text.encode('utf-16-le')) // 2, text)
+
+
+def _now():
+    """Return the current time as a microsecond timestamp."""
+    return int(time.time() * 1000000)
+
+
+def _user_id(user_num):
+    """Return the UserID of a user, with the same chat and gaia IDs."""
+    return ['user{}'.format(user_num)] * 2
+
+
+def _conversation_id(conv_num):
+    """Return the ID of a conversation."""
+    return 'conversation{}'.format(conv_num)
+
+
+def _client_entity(user_num):
+    """Return a ClientEntity."""
+    return [None] * 8 + [
+        _user_id(user_num),
+        [0, 'User {}'.format(user_num), 'User', None,
+         ['user{}@example.com'.format(user_num)]],
+    ]
+
+
+def _response_header(timestamp):
+    """Return a successful ClientResponseHeader."""
+    return [1, None, None, 'fake_trace_id', timestamp]
+
+
+def _state_update_header(timestamp):
+    """Return a ClientStateUpdateHeader."""
+    return [1, None, 'fake_trace_id', None, timestamp]
@@ -17,12 +17,15 @@ FetchResponse = collections.namedtuple('FetchResponse', ['code', 'body'])
 
 @asyncio.coroutine
 def fetch(method, url, params=None, headers=None, cookies=None, data=None,
-          connector=None):
+          connector=None, capture=None):
     """Make an HTTP request.
 
     If the request times out or a encounters a connection issue, it will be
     retried MAX_RETRIES times before finally raising hangups.NetworkError.
 
+    If capture is a hangups.capture.CaptureWriter, the response body is
+    appended to it.
+
     Returns FetchResponse.
     """
     logger.info('Request {} {}'.format(method.upper(), url))
@@ -52,4 +55,6 @@ def fetch(method, url, params=None, headers=None, cookies=None, data=None,
         raise exceptions.NetworkError('Request return unexpected status: {}: {}'
                                       .format(res.status, res.reason))
     logger.info('Request successful')
+    if capture is not None:
+        capture.write_response(capture.new_stream(), url, body)
     return FetchResponse(res.status, body)
@@ -0,0 +1,55 @@
+"""Bounded pools of interned values.
+
+Within one account, the IDs of users and conversations come from a small set,
+but parsing creates new objects for them for every event. Interning them
+makes identical IDs share one object, which saves memory in long-lived
+processes and lets equality checks short-circuit on identity.
+"""
+
+DEFAULT_MAX_SIZE = 65536
+
+
+class InternPool(object):
+
+    """A bounded pool of interned values.
+
+    When the pool is full, it's emptied before interning the next value, so a
+    value may stop being shared, but the pool never grows without limit.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self._max_size = max_size
+        self._values = {}  # {value: interned value}
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, value):
+        """Return the interned value equal to value, or None."""
+        try:
+            return self._values.get(value)
+        except TypeError:
+            return None
+
+    def intern(self, value):
+        """Return the interned value equal to value, interning it if needed.
+
+        None and unhashable values are returned unchanged.
+        """
+        if value is None:
+            return None
+        try:
+            interned = self._values.get(value)
+        except TypeError:
+            return value
+        if interned is None:
+            if len(self._values) >= self._max_size:
+                self._values.clear()
+            self._values[value] = interned = value
+        return interned
+
+
+# Pool of the string IDs of users and conversations:
+IDS = InternPool()
+# Pool of user.UserIDs:
+USER_IDS = InternPool()
@@ -1,68 +1,610 @@
-"""Parser for a subset of JavaScript written with purplex.
+"""Parser for a subset of JavaScript.
 
 Parses a broader subset of JavaScript than just JSON, needed for parsing some
 API responses. This is only as complete as necessary to parse the responses
 we're getting.
+
+Most input is nearly JSON, so by default it is normalised into JSON and handed
+to the json module's C decoder. Input that can't be normalised falls back to a
+hand-written single-pass scanner. The original parser written with purplex is
+kept as a reference implementation.
 """
 
+import appdirs
+import hashlib
+import inspect
+import json
+import logging
+import os
+import pickle
 import purplex
+import re
+
+logger = logging.getLogger(__name__)
 
+# Parser implementations supported by loads:
+JSON = 'json'  # json module after normalisation, falling back to SCANNER
+SCANNER = 'scanner'  # single-pass hand-written parser
+PURPLEX = 'purplex'  # reference parser generated by purplex
 
-def loads(string):
+
+def loads(string, parser=JSON):
     """Parse simple JavaScript types from string into Python types.
 
+    parser selects the implementation to use, either JSON, SCANNER or
+    PURPLEX.
+
     Raises ValueError if parsing fails.
     """
-    try:
-        return _PARSER.parse(string)
-    except purplex.exception.PurplexError as e:
-        raise ValueError('Failed to load JavaScript: {}'.format(e))
+    if parser == JSON:
+        try:
+            return _JSON_DECODER.decode(_normalise(string))
+        except ValueError:
+            return _scan(string)
+    elif parser == SCANNER:
+        return _scan(string)
+    elif parser == PURPLEX:
+        try:
+            return _get_purplex_parser().parse(string)
+        except purplex.exception.PurplexError as e:
+            raise ValueError('Failed to load JavaScript: {}'.format(e))
+    else:
+        raise ValueError('Unknown JavaScript parser: {}'.format(parser))
 
 
-# TODO: there are more possible escape sequences
 _ESCAPES = {
     "'": "'",
     '"': '"',
     '\\': '\\',
+    '/': '/',
+    'b': '\b',
+    'f': '\f',
     'n': '\n',
-    't': '\t',
     'r': '\r',
-    'u': '', # unicode escapes are a special case
+    't': '\t',
+    'v': '\v',
+    '0': '\0',
+    # An escaped line terminator is a line continuation:
+    '\n': '',
+    '\r': '',
+    '\r\n': '',
+    '\u2028': '',
+    '\u2029': '',
 }
-_STRING_RE = ('(\'(([^\\\\\'])|(\\\\[{0}]))*?\')|("(([^\\\\"])|(\\\\[{0}]))*?")'
-              .format(''.join(_ESCAPES.keys()).replace('\\', '\\\\')))
+_STRING_RE = '(\'([^\\\\\']|(\\\\.))*?\')|("([^\\\\"]|(\\\\.))*?")'
+# The groups are, in order: the high and low halves of an escaped surrogate
+# pair, a 4-digit unicode escape, a code point escape, a hex escape, and any
+# other escaped character. Legacy octal escapes are not supported, so "\0"
+# may not be followed by a digit. If none of the groups match, the escape
+# sequence is invalid.
+_ESCAPE_RE = re.compile(r'''\\(?:
+    u([dD][89abAB][0-9a-fA-F]{2})\\u([dD][c-fC-F][0-9a-fA-F]{2})
+    |u([0-9a-fA-F]{4})
+    |u\{([0-9a-fA-F]{1,6})\}
+    |x([0-9a-fA-F]{2})
+    |(0(?![0-9])|\r\n|[^0-9ux])
+    |
+)''', re.VERBOSE | re.DOTALL)
 
 
 def _unescape_string(s):
-    """Unescape JavaScript escape sequences."""
-    chars = list(s)
-    unescaped_chars = []
-    while len(chars) > 0:
-        c = chars.pop(0)
-        if c != '\\':
-            unescaped_chars.append(c)
+    """Unescape JavaScript escape sequences.
+
+    Raises ValueError if s contains an invalid escape sequence.
+    """
+    if '\\' not in s:
+        return s
+    try:
+        return _ESCAPE_RE.sub(_unescape, s)
+    except ValueError as e:
+        raise ValueError('String literal contains invalid escape sequence '
+                         '{}: {}'.format(e, s))
+
+
+def _unescape(m):
+    """Return the replacement for an escape sequence matched by _ESCAPE_RE.
+
+    Raises ValueError if the escape sequence is invalid.
+    """
+    high, low, code_unit, code_point, byte, char = m.groups()
+    if char is not None:
+        return _ESCAPES.get(char, char)
+    elif code_unit is not None:
+        return chr(int(code_unit, 16))
+    elif high is not None:
+        return chr(0x10000 + ((int(high, 16) - 0xD800) << 10) +
+                   (int(low, 16) - 0xDC00))
+    elif byte is not None:
+        return chr(int(byte, 16))
+    elif code_point is not None and int(code_point, 16) <= 0x10FFFF:
+        return chr(int(code_point, 16))
+    else:
+        raise ValueError(repr(m.string[m.start():m.end() + 1]))
+
+
+##############################################################################
+# JSON normalisation
+##############################################################################
+
+def _reject_constant(name):
+    """Reject the non-standard constants accepted by the json module."""
+    raise ValueError('Invalid constant: {}'.format(name))
+
+
+_JSON_DECODER = json.JSONDecoder(strict=False, parse_constant=_reject_constant)
+# Quick check for whether a string may need normalising.
+_NEEDS_NORMALISING_RE = re.compile(
+    r"""[\[,]\s*[,\]]|'|[{,]\s*[a-zA-Z_$][a-zA-Z0-9_$]*\s*:"""
+)
+# Constructs that differ between the JavaScript we receive and JSON. The groups
+# are, in order: single-quoted string contents, a list opening or comma
+# followed by the next character when that is a comma or list end (a hole or a
+# trailing comma), and whitespace followed by an unquoted object key.
+# Double-quoted strings are matched without a group so they can be skipped.
+_NORMALISE_RE = re.compile(r'''
+    "[^"\\]*(?:\\.[^"\\]*)*"
+    |'([^'\\]*(?:\\.[^'\\]*)*)'
+    |([\[,])(?=\s*([,\]]))
+    |(?<=[{,])(\s*)(?!(?:true|false|null)\s*:)([a-zA-Z_$][a-zA-Z0-9_$]*)
+     (?=\s*:)
+''', re.VERBOSE | re.DOTALL)
+_SINGLE_QUOTED_ESCAPE_RE = re.compile(r'\\(.)|"', re.DOTALL)
+
+
+def _double_quote_escape(m):
+    """Convert an escape in a single-quoted string for double quotes."""
+    if m.group(1) is None:
+        return '\\"'
+    elif m.group(1) == "'":
+        return "'"
+    else:
+        return m.group(0)
+
+
+def _normalise(string):
+    """Return string with the JavaScript-isms we receive converted to JSON.
+
+    Holes in lists are filled with null, trailing commas in lists are dropped,
+    single-quoted strings are double-quoted and unquoted object keys are
+    quoted. The result is only equivalent to string if it is valid JSON; if it
+    isn't, string must be parsed by the scanner instead.
+    """
+    if _NEEDS_NORMALISING_RE.search(string) is None:
+        return string
+    parts = []
+    last = 0
+    for m in _NORMALISE_RE.finditer(string):
+        group = m.lastindex
+        if group is None:
+            continue  # double-quoted strings are already JSON
+        parts.append(string[last:m.start()])
+        if group == 1:
+            parts.append('"')
+            parts.append(_SINGLE_QUOTED_ESCAPE_RE.sub(_double_quote_escape,
+                                                      m.group(1)))
+            parts.append('"')
+        elif group == 3:
+            if m.group(2) == ',' and m.group(3) == ']':
+                pass  # trailing comma
+            elif m.group(3) == ',':
+                parts.append(m.group(2))
+                parts.append('null')
+            else:
+                parts.append(m.group(2))
         else:
-            try:
-                c = chars.pop(0)
-            except IndexError:
-                raise ValueError('Reached end of string literal '
-                                 'prematurely: {}'.format(s))
-            if c == 'u':
-                try:
-                    unescaped_chars.append(
-                        chr(int(''.join([chars.pop(0) for _ in range(4)]), 16))
-                    )
-                except IndexError:
-                    raise ValueError('Reached end of string literal '
-                                     'prematurely: {}'.format(s))
+            parts.append(m.group(4))
+            parts.append('"')
+            parts.append(m.group(5))
+            parts.append('"')
+        last = m.end()
+    parts.append(string[last:])
+    return ''.join(parts)
+
+
+##############################################################################
+# Scanner
+##############################################################################
+
+# Every token is matched along with the whitespace preceding it. The groups
+# are, in order: punctuation, double-quoted string contents, single-quoted
+# string contents, number, and bare word (keyword or unquoted key).
+_TOKEN_RE = re.compile(r'''
+    \s*(?:
+        ([\[\]{},:])
+        |"([^"\\]*(?:\\.[^"\\]*)*)"
+        |'([^'\\]*(?:\\.[^'\\]*)*)'
+        |([-+]?(?:[0-9]+(?:[.][0-9]+)?|[.][0-9]+)(?:[eE][-+]?[0-9]+)?)
+         (?![a-zA-Z0-9_$.])
+        |([a-zA-Z0-9_$]+)
+    )''', re.VERBOSE | re.DOTALL)
+_WHITESPACE_RE = re.compile(r'\s*')
+# Characters that may continue a number or bare word token:
+_PARTIAL_TOKEN_RE = re.compile(r'[-+.0-9a-zA-Z_$]*')
+_KEYWORDS = {'null': None, 'true': True, 'false': False}
+# Tokens that affect the structure of a list being skimmed in raw mode: the
+# opening quote of a string, or punctuation in group 1.
+_SKIM_RE = re.compile(r'''["']|([\[\]{},])''')
+# Contents of a string up to its closing quote, or up to a backslash at the
+# end of the text, by quote character:
+_STRING_CONTENTS_RES = {
+    '"': re.compile(r'[^"\\]*(?:\\.[^"\\]*)*', re.DOTALL),
+    "'": re.compile(r"[^'\\]*(?:\\.[^'\\]*)*", re.DOTALL),
+}
+
+# Scanner states:
+_VALUE = 0  # expecting a value at the top level or in an object
+_LIST_ITEM = 1  # expecting a list item, a hole or the end of the list
+_LIST_NEXT = 2  # expecting a comma or the end of the list
+_OBJECT_KEY = 3  # expecting an object key or the end of the object
+_OBJECT_COLON = 4  # expecting the colon following an object key
+_OBJECT_NEXT = 5  # expecting a comma or the end of the object
+_DONE = 6  # parsed the top-level value
+
+
+def _scan_error(string, pos, expected):
+    """Return ValueError for a scan failure at pos."""
+    if pos >= len(string):
+        found = 'end of input'
+    else:
+        found = repr(string[pos:pos + 20])
+    return ValueError('Failed to load JavaScript: expected {} at position {} '
+                      'but found {}'.format(expected, pos, found))
+
+
+def _scan(string):
+    """Parse a JavaScript value from string in a single pass.
+
+    Produces the same output as the purplex grammar: holes in lists become
+    None, trailing commas are ignored, and object keys may be strings, numbers
+    or bare words. Containers are built using an explicit stack, so the cost is
+    linear in the length of the input and deep nesting can't exhaust the
+    recursion limit.
+
+    Raises ValueError if parsing fails.
+    """
+    scanner = _Scanner()
+    scanner.scan(string)
+    return scanner.result
+
+
+class _Scanner(object):
+
+    """Resumable state of the single-pass scanner.
+
+    If stream is True, the top-level value must be a list, and rather than
+    being added to it, each of its items is appended to items as soon as it is
+    complete.
+    """
+
+    def __init__(self, stream=False):
+        self.stream = stream
+        self.items = []  # completed top-level list items when streaming
+        self.result = None  # the top-level value once state is _DONE
+        self.state = _VALUE
+        self._stack = []  # containers being built, innermost last
+        self._keys = []  # pending object keys, innermost last
+
+    def scan(self, string, pos=0, final=True):
+        """Scan string from pos and return the position scanning stopped at.
+
+        If final is False, string may end part way through a token, and
+        scanning stops before any token that could be incomplete.
+
+        Raises ValueError if parsing fails.
+        """
+        # pylint: disable=too-many-branches,too-many-statements
+        match = _TOKEN_RE.match
+        stack = self._stack
+        keys = self._keys
+        items = self.items
+        # Depth of the stack at which completed values are streamed:
+        stream_depth = 1 if self.stream else 0
+        end = len(string)
+        state = self.state
+        try:
+            while state != _DONE:
+                m = match(string, pos)
+                if m is None:
+                    pos = _WHITESPACE_RE.match(string, pos).end()
+                    if not final and (
+                            pos == end or string[pos] in '"\'' or
+                            _PARTIAL_TOKEN_RE.match(string, pos).end() == end
+                    ):
+                        break  # wait for the rest of the token
+                    raise _scan_error(string, pos, 'token')
+                token_type = m.lastindex
+                if token_type == 1:
+                    punctuation = m.group(1)
+                    if punctuation == ',':
+                        if state == _LIST_NEXT:
+                            state = _LIST_ITEM
+                            pos = m.end()
+                            continue
+                        elif state == _LIST_ITEM:
+                            if len(stack) == stream_depth:
+                                items.append(None)
+                            else:
+                                stack[-1].append(None)
+                            pos = m.end()
+                            continue
+                        elif state == _OBJECT_NEXT:
+                            state = _OBJECT_KEY
+                            pos = m.end()
+                            continue
+                    elif punctuation == '[':
+                        if state == _LIST_ITEM or state == _VALUE:
+                            stack.append([])
+                            state = _LIST_ITEM
+                            pos = m.end()
+                            continue
+                    elif punctuation == ']':
+                        if state == _LIST_NEXT or state == _LIST_ITEM:
+                            value = stack.pop()
+                            pos = m.end()
+                        else:
+                            raise _scan_error(string, m.start(1), 'value')
+                    elif punctuation == '{':
+                        if ((state == _LIST_ITEM or state == _VALUE) and
+                                (stack or not stream_depth)):
+                            stack.append({})
+                            state = _OBJECT_KEY
+                            pos = m.end()
+                            continue
+                    elif punctuation == '}':
+                        if state == _OBJECT_NEXT or state == _OBJECT_KEY:
+                            value = stack.pop()
+                            pos = m.end()
+                        else:
+                            raise _scan_error(string, m.start(1), 'value')
+                    elif punctuation == ':':
+                        if state == _OBJECT_COLON:
+                            state = _VALUE
+                            pos = m.end()
+                            continue
+                    if pos != m.end():
+                        raise _scan_error(string, m.start(1), 'value')
+                else:
+                    if (not final and token_type >= 4 and
+                            _PARTIAL_TOKEN_RE.match(
+                                string, m.start(token_type)).end() == end):
+                        break  # the number or word may continue
+                    if state == _OBJECT_KEY:
+                        if token_type == 5:
+                            word = m.group(5)
+                            keys.append(_KEYWORDS.get(word, word))
+                        else:
+                            keys.append(_scalar(m, token_type))
+                        state = _OBJECT_COLON
+                        pos = m.end()
+                        continue
+                    elif ((state != _VALUE and state != _LIST_ITEM) or
+                          (stream_depth and not stack)):
+                        raise _scan_error(string, m.start(token_type),
+                                          'punctuation')
+                    if token_type == 5:
+                        try:
+                            value = _KEYWORDS[m.group(5)]
+                        except KeyError:
+                            raise _scan_error(string, m.start(5), 'value')
+                    else:
+                        value = _scalar(m, token_type)
+                    pos = m.end()
+                # A value was completed, so add it to its parent container.
+                if not stack:
+                    self.result = value
+                    state = _DONE
+                elif len(stack) == stream_depth:
+                    items.append(value)
+                    state = _LIST_NEXT
+                else:
+                    parent = stack[-1]
+                    if parent.__class__ is list:
+                        parent.append(value)
+                        state = _LIST_NEXT
+                    else:
+                        parent[keys.pop()] = value
+                        state = _OBJECT_NEXT
+        finally:
+            self.state = state
+        if state == _DONE:
+            pos = _WHITESPACE_RE.match(string, pos).end()
+            if pos != end:
+                raise _scan_error(string, pos, 'end of input')
+        return pos
+
+
+def _find_string_end(text, pos, quote, is_escaped):
+    """Find the end of a string whose contents continue at pos in text.
+
+    quote is the string's quote character, and is_escaped is whether the
+    character at pos is escaped. Returns the position after the closing quote,
+    or None if the string continues past the end of text, and whether the
+    text following text starts escaped.
+    """
+    if is_escaped:
+        if pos == len(text):
+            return None, True
+        pos += 1
+    end = _STRING_CONTENTS_RES[quote].match(text, pos).end()
+    if end == len(text):
+        return None, False
+    elif text[end] == quote:
+        return end + 1, False
+    else:
+        return None, True  # text ends with a backslash
+
+
+def _scalar(m, token_type):
+    """Return the value of a string or number token."""
+    if token_type == 2 or token_type == 3:
+        return _unescape_string(m.group(token_type))
+    number = m.group(4)
+    if '.' in number or 'e' in number or 'E' in number:
+        return float(number)
+    else:
+        return int(number)
+
+
+class IncrementalParser(object):
+
+    """Parser for a JavaScript list whose text is received in pieces.
+
+    Text is passed to feed as it arrives, and each item of the top-level list
+    is returned as soon as it is complete. This allows parsing to overlap with
+    receiving the rest of the list, without the text or the parsed list ever
+    being held in full.
+
+    If raw is True, items are returned as their JavaScript source text rather
+    than being parsed, and holes are returned as None. Only the list structure
+    is scanned, so the items are not validated.
+
+    Each character is only scanned once, plus once more by the scanner when
+    parsing, however many pieces a long string is split across.
+    """
+
+    def __init__(self, raw=False):
+        self._raw = raw
+        self._scanner = _Scanner(stream=True)
+        # Pieces of text which haven't been parsed yet, or in raw mode, the
+        # pieces of the current item before the text being skimmed:
+        self._parts = []
+        # Quote character of the unterminated string the text ends in, or
+        # None, and whether the next character is escaped:
+        self._quote = None
+        self._is_escaped = False
+        # State of raw mode:
+        self._depth = 0  # nesting depth at the end of the text
+        self._is_done = False  # whether the top-level list was closed
+
+    def feed(self, text):
+        """Parse the next piece of text.
+
+        Returns a list of the top-level list items completed by this piece.
+
+        Raises ValueError if parsing fails.
+        """
+        if self._raw:
+            return self._skim(text, final=False)
+        self._parts.append(text)
+        if self._quote is not None:
+            # Until the string ends, the scanner can't make progress, so only
+            # look for the closing quote in the new text.
+            end, self._is_escaped = _find_string_end(
+                text, 0, self._quote, self._is_escaped
+            )
+            if end is None:
+                return []
+            self._quote = None
+        buf = ''.join(self._parts) if len(self._parts) > 1 else text
+        pos = self._scanner.scan(buf, final=False)
+        self._parts = [buf[pos:]] if pos < len(buf) else []
+        if pos < len(buf) and buf[pos] in '"\'':
+            # The scanner stopped at the opening quote of an unterminated
+            # string.
+            self._quote = buf[pos]
+            _, self._is_escaped = _find_string_end(buf, pos + 1, self._quote,
+                                                   False)
+        return self._take_items()
+
+    def close(self):
+        """Finish parsing after the last piece of text.
+
+        Returns a list of the top-level list items completed by the remaining
+        text.
+
+        Raises ValueError if the text was not a complete list.
+        """
+        if self._raw:
+            return self._skim('', final=True)
+        self._scanner.scan(''.join(self._parts))
+        self._parts = []
+        self._quote = None
+        return self._take_items()
+
+    def _take_items(self):
+        """Return and forget the completed top-level list items."""
+        items = self._scanner.items
+        self._scanner.items = []
+        return items
+
+    def _skim(self, text, final):
+        """Return the source text of the items completed by the next piece of
+        text.
+
+        Raises ValueError if the list structure is invalid.
+        """
+        # pylint: disable=too-many-branches
+        depth = self._depth
+        item_start = 0  # start of the current item's text in text
+        items = []
+        pos = 0
+        if self._quote is not None:
+            pos, self._is_escaped = _find_string_end(
+                text, 0, self._quote, self._is_escaped
+            )
+            if pos is None:
+                pos = len(text)
             else:
-                try:
-                    unescaped_chars.append(_ESCAPES[c])
-                except KeyError:
-                    raise ValueError('String literal contains invalid '
-                                     'escape sequence: {}'.format(s))
-    return "".join(unescaped_chars)
+                self._quote = None
+        while self._quote is None:
+            m = _SKIM_RE.search(text, pos)
+            if m is None:
+                break
+            punctuation = m.group(1)
+            if depth == 0:
+                if (self._is_done or punctuation != '[' or
+                        text[pos:m.start()].strip()):
+                    raise _scan_error(text, m.start(), 'start of list')
+                depth = 1
+                item_start = m.end()
+            elif punctuation is None:
+                pos, self._is_escaped = _find_string_end(
+                    text, m.end(), m.group(), False
+                )
+                if pos is None:
+                    self._quote = m.group()
+                    pos = len(text)
+                continue
+            elif depth == 1 and punctuation in ',]':
+                item = text[item_start:m.start()]
+                if self._parts:
+                    self._parts.append(item)
+                    item = ''.join(self._parts)
+                    self._parts = []
+                item = item.strip()
+                if punctuation == ',':
+                    items.append(item or None)
+                else:
+                    if item:
+                        items.append(item)
+                    depth = 0
+                    self._is_done = True
+                item_start = m.end()
+            elif punctuation in '[{':
+                depth += 1
+            elif punctuation == '}':
+                if depth == 1:
+                    raise _scan_error(text, m.start(), 'end of list')
+                depth -= 1
+            elif punctuation == ']':
+                depth -= 1
+            pos = m.end()
+        if depth == 0:
+            if text[pos:].strip():
+                raise _scan_error(text, pos, 'start of list')
+            if final and not self._is_done:
+                raise _scan_error(text, len(text), 'start of list')
+        elif final:
+            raise _scan_error(text, len(text), 'end of list')
+        else:
+            self._parts.append(text[item_start:])
+        self._depth = depth
+        return items
+
 
+##############################################################################
+# Reference purplex parser
+##############################################################################
 
 class JavaScriptLexer(purplex.Lexer):
     """Lexer for a subset of JavaScript."""
@@ -165,5 +707,80 @@ class JavaScriptParser(purplex.Parser):
         return _unescape_string(s[1:-1])
 
 
-# instantiate the parser at module-load time for better performance
-_PARSER = JavaScriptParser()
+# Directory where the purplex parser is cached between processes:
+PARSER_CACHE_DIR = appdirs.user_cache_dir('hangups', 'hangups')
+# The purplex parser is only built when it is first used, because building its
+# tables is slow and the scanner is used by default.
+_PARSER = None
+
+
+def _get_purplex_parser():
+    """Return the purplex parser, building it if necessary.
+
+    The parser is loaded from the cache in PARSER_CACHE_DIR if possible, and
+    otherwise built and written to the cache.
+    """
+    global _PARSER  # pylint: disable=global-statement
+    if _PARSER is None:
+        path = _get_parser_cache_path()
+        _PARSER = _load_cached_parser(path)
+        if _PARSER is None:
+            _PARSER = JavaScriptParser()
+            _write_cached_parser(path, _PARSER)
+    return _PARSER
+
+
+def _get_parser_cache_path():
+    """Return the cache path for the parser, or None if it can't be cached.
+
+    The file name includes a hash of the grammar, so changes to the grammar or
+    to purplex never load a stale parser.
+    """
+    try:
+        grammar = ''.join([
+            inspect.getsource(JavaScriptLexer),
+            inspect.getsource(JavaScriptParser),
+            _STRING_RE,
+            getattr(purplex, '__version__', ''),
+        ])
+    except (OSError, TypeError) as e:
+        logger.debug('Not caching JavaScript parser: {}'.format(e))
+        return None
+    digest = hashlib.sha1(grammar.encode()).hexdigest()
+    return os.path.join(PARSER_CACHE_DIR,
+                        'javascript-parser-{}.pickle'.format(digest))
+
+
+def _load_cached_parser(path):
+    """Return the parser cached at path, or None if it can't be loaded."""
+    if path is None or not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            parser = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError,
+            ImportError, IndexError, TypeError) as e:
+        logger.warning('Failed to load cached JavaScript parser: {}'.format(e))
+        return None
+    if not isinstance(parser, JavaScriptParser):
+        logger.warning('Ignoring invalid cached JavaScript parser')
+        return None
+    return parser
+
+
+def _write_cached_parser(path, parser):
+    """Cache parser at path, logging a warning if it fails."""
+    if path is None:
+        return
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(parser, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except (OSError, pickle.PicklingError, AttributeError, TypeError) as e:
+        logger.warning('Failed to cache JavaScript parser: {}'.format(e))
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
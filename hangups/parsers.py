@@ -3,6 +3,7 @@
 import logging
 from collections import namedtuple
 import datetime
+import re
 
 from hangups import javascript, exceptions, schemas, user
 
@@ -10,12 +11,42 @@ from hangups import javascript, exceptions, schemas, user
 logger = logging.getLogger(__name__)
 
 
-def parse_submission(submission):
-    """Yield ClientStateUpdate instances from a channel submission."""
+def parse_submission(submission, lazy=False, projection=None):
+    """Yield ClientStateUpdate instances from a channel submission.
+
+    submission may be the text of a submission or a list of its items, where
+    each item is either parsed or the JavaScript source text of the item.
+    Items in source text form are only parsed if they contain a payload we
+    care about, and only when the generator reaches them.
+
+    If lazy is True, the ClientStateUpdates are lazy views (see
+    pblite.Message.parse), and invalid fields raise ValueError when they are
+    accessed rather than being logged and skipped. projection is an optional
+    projection of the ClientStateUpdates (see pblite).
+    """
     # For each submission payload, yield its messages
     for payload in _get_submission_payloads(submission):
         if payload is not None:
-            yield from _parse_payload(payload)
+            yield from _parse_payload(payload, lazy, projection)
+
+
+# Payload types which are discarded:
+# tm: Payload is object format. I'm not sure what these are for, but they don't
+#     seem very important.
+# wh: Payload is null. These messages don't contain any information other than
+#     the session_id, and appear to be just heartbeats.
+# otr: Not sure what this is for, might be something to do with XMPP.
+# ho:hin: Sent when a video call starts/stops.
+_DISCARDED_PAYLOAD_TYPES = {'tm', 'wh', 'otr', 'ho:hin'}
+
+# Matches the start of a submission item's source text, capturing the
+# submission type, and the payload type for submissions of type 'c'.
+_ENVELOPE_RE = re.compile(r'''
+    \[\s*[0-9]+\s*,                         # submission number
+    \s*\[\s*(["'])([^"'\\]*)\1              # submission type
+    (?:\s*,\s*\[\s*(["'])[^"'\\]*\3          # session ID
+    \s*,\s*\[\s*(["'])([^"'\\]*)\4)?          # payload type
+''', re.VERBOSE)
 
 
 def _get_submission_payloads(submission):
@@ -25,7 +56,19 @@ def _get_submission_payloads(submission):
     connection was closed while something happened, there can be multiple
     payloads.
     """
-    for sub in javascript.loads(submission):
+    if isinstance(submission, str):
+        parser = javascript.IncrementalParser(raw=True)
+        submission = parser.feed(submission) + parser.close()
+    for sub in submission:
+
+        if isinstance(sub, str):
+            # Read the envelope before parsing the item, so items which would
+            # be discarded are never parsed.
+            if is_heartbeat(sub):
+                continue
+            sub = javascript.loads(sub)
+        elif sub is None:
+            continue
 
         # the submission number, increments with each payload
         # sub_num = sub[0]
@@ -43,20 +86,7 @@ def _get_submission_payloads(submission):
                 # Payload is submessages in the list format. These are the
                 # payloads we care about.
                 yield javascript.loads(sub[1][1][1][1])
-            elif payload_type == 'tm':
-                # Payload is object format. I'm not sure what these are for,
-                # but they don't seem very important.
-                pass
-            elif payload_type == 'wh':
-                # Payload is null. These messages don't contain any information
-                # other than the session_id, and appear to be just heartbeats.
-                pass
-            elif payload_type == 'otr':
-                # Not sure what this is for, might be something to do with
-                # XMPP.
-                pass
-            elif payload_type == 'ho:hin':
-                # Sent when a video call starts/stops.
+            elif payload_type in _DISCARDED_PAYLOAD_TYPES:
                 pass
             else:
                 logger.warning(
@@ -72,14 +102,53 @@ def _get_submission_payloads(submission):
                            .format(sub_type, sub))
 
 
-def _parse_payload(payload):
+def is_heartbeat(item):
+    """Return whether a submission item is known to contain no payload.
+
+    item is the JavaScript source text of the item. This includes heartbeats
+    and the other payload types which are discarded, and is decided without
+    parsing the item.
+    """
+    match = _ENVELOPE_RE.match(item)
+    return match is not None and (
+        match.group(2) == 'noop' or
+        match.group(2) == 'c' and match.group(5) in _DISCARDED_PAYLOAD_TYPES
+    )
+
+
+def get_typing_key(item):
+    """Return the typing notification key of a submission item.
+
+    If the item only contains typing notifications from one user in one
+    conversation, returns (conversation_id, chat_id), otherwise None. item is
+    the JavaScript source text of the item.
+    """
+    keys = set()
+    try:
+        for state_update in parse_submission([item], lazy=True):
+            notification = state_update.typing_notification
+            if notification is None:
+                return None
+            keys.add((notification.conversation_id.id_,
+                      notification.user_id.chat_id))
+    except (ValueError, IndexError, TypeError):
+        return None
+    return keys.pop() if len(keys) == 1 else None
+
+
+def _parse_payload(payload, lazy, projection):
     """Yield a list of ClientStateUpdates."""
     if payload[0] == 'cbu':
         # payload[1] is a list of state updates.
         for raw_update in payload[1]:
             try:
-                state_update = schemas.CLIENT_STATE_UPDATE.parse(raw_update)
-                logger.info('Parsed ClientStateUpdate: {}'.format(state_update))
+                state_update = schemas.CLIENT_STATE_UPDATE.parse(
+                    raw_update, lazy=lazy, projection=projection
+                )
+                # Formatting a lazy view parses all of it, so avoid it.
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info('Parsed ClientStateUpdate: {}'
+                                .format(state_update))
                 yield state_update
             except ValueError as e:
                 logger.warning('Failed to parse ClientStateUpdate: {}'
@@ -99,6 +168,15 @@ def from_timestamp(timestamp):
                                            datetime.timezone.utc)
 
 
+def to_timestamp(datetime_timestamp):
+    """Convert an aware datetime instance to a microsecond timestamp."""
+    return ((datetime_timestamp - _EPOCH) //
+            datetime.timedelta(microseconds=1))
+
+
+_EPOCH = datetime.datetime.fromtimestamp(0, datetime.timezone.utc)
+
+
 ##############################################################################
 # Message types and parsers
 ##############################################################################
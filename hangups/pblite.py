@@ -12,19 +12,38 @@ See:
 https://code.google.com/p/google-protorpc/source/browse/python/protorpc/
 protojson.py
 
+Parsing can be limited to some of the fields of a Message with a projection.
+A projection is a dict mapping field names to the projection of that field, or
+to None to parse all of it. An iterable of field names is also a projection,
+of all of each of those fields. The projection of a RepeatedField applies to
+each of its items. For example, this projection of a ClientStateUpdate only
+parses the chat message and timestamp of events:
+
+    {'event_notification': {'event': {'chat_message', 'timestamp'}}}
+
+Parsed values can also be encoded into a compact binary snapshot with encode,
+and loaded back with decode, which is much faster than parsing JavaScript.
+
 TODO: Serialization code is currently unused and doesn't have any tests.
 """
 
-import itertools
+import keyword
+import struct
 import types
+import zlib
 
 
 class Field(object):
 
-    """An untyped field, corresponding to a primitive type."""
+    """An untyped field, corresponding to a primitive type.
 
-    def __init__(self, is_optional=False):
+    If pool is an optional hangups.interning.InternPool, parsed values are
+    interned in it.
+    """
+
+    def __init__(self, is_optional=False, pool=None):
         self._is_optional = is_optional
+        self._pool = pool
 
     def parse(self, input_):
         """Parse the field.
@@ -33,6 +52,8 @@ class Field(object):
         """
         if not self._is_optional and input_ is None:
             raise ValueError('Field is not optional')
+        elif self._pool is not None:
+            return self._pool.intern(input_)
         else:
             return input_
 
@@ -78,13 +99,22 @@ class RepeatedField(object):
     def __init__(self, field, is_optional=False):
         self._field = field
         self._is_optional = is_optional
+        self._parsers = {}  # {frozen projection: compiled parse function}
 
-    def parse(self, input_, serialize=False):
+    def parse(self, input_, serialize=False, lazy=False, projection=None):
         """Parse the message.
 
+        If lazy is True, Messages in the list are parsed lazily, and
+        projection is an optional projection of the items (see
+        Message.parse).
+
         Raises ValueError if the input is None and the RepeatedField is not
         optional, or if the input is not a list.
         """
+        if projection is not None:
+            projection = _freeze_projection(projection)
+        if not serialize and not lazy:
+            return self._get_parser(projection)(input_)
         # Validate input:
         if input_ is None and not self._is_optional:
             raise ValueError('RepeatedField is not optional')
@@ -100,7 +130,8 @@ class RepeatedField(object):
                 if serialize:
                     res.append(self._field.serialize(field_input))
                 else:
-                    res.append(self._field.parse(field_input))
+                    res.append(_parse_lazy(self._field, field_input,
+                                           projection))
             except ValueError as e:
                 raise ValueError('RepeatedField item: {}'.format(e))
         return res
@@ -113,11 +144,26 @@ class RepeatedField(object):
         """
         return self.parse(input_, serialize=True)
 
+    def _get_parser(self, projection=None):
+        """Return the compiled parse function, compiling it if necessary.
+
+        Raises ValueError if the frozen projection is invalid.
+        """
+        try:
+            return self._parsers[projection]
+        except KeyError:
+            parser = _compile_repeated_field(self, projection)
+            self._parsers[projection] = parser
+            return parser
+
+
 class Message(object):
 
     """A field consisting of a collection of fields paired with a name.
 
-    Corresponds to an object (SimpleNamespace).
+    Corresponds to an object. Parsing produces a record, which behaves like a
+    SimpleNamespace, but stores the named fields in slots. Every Message with
+    the same field names produces instances of the same record class.
 
     The input may be shorter than the number of fields and the trailing fields
     will be assigned None. The input may be longer than the number of fields
@@ -129,34 +175,40 @@ class Message(object):
     def __init__(self, *args, is_optional=False):
         self._name_field_pairs = args
         self._is_optional = is_optional
+        self._parsers = {}  # {frozen projection: compiled parse function}
+        self._view_classes = {}  # {frozen projection: record class of views}
 
-    def parse(self, input_):
+    def parse(self, input_, lazy=False, projection=None):
         """Parse the message.
 
+        If lazy is True, only the input itself is checked, and the result is a
+        view of it which parses each field the first time it's accessed. Call
+        validate() on the view to parse every field.
+
+        If projection is not None, only the fields in the projection are
+        parsed, and the other fields are None without being checked.
+
         Raises ValueError if the input is None and the Message is not optional,
-        or if any of the contained Fields fail to parse.
+        if any of the contained Fields fail to parse, or if the projection
+        contains fields which don't exist.
         """
-        # Validate input:
-        if input_ is None and not self._is_optional:
+        if projection is not None:
+            projection = _freeze_projection(projection)
+        if not lazy:
+            return self._get_parser(projection)(input_)
+        elif input_ is None and not self._is_optional:
             raise ValueError('Message is not optional')
         elif input_ is None and self._is_optional:
             return None
         elif not isinstance(input_, list):
             raise ValueError('Message expected list but got {}'
                              .format(type(input_)))
-
-        # Pad input with Nones if necessary
-        input_ = itertools.chain(input_, itertools.repeat(None))
-        res = types.SimpleNamespace()
-        for (name, field), field_input in zip(self._name_field_pairs, input_):
-            if name is not None:
-                try:
-                    p = field.parse(field_input)
-                except ValueError as e:
-                    raise ValueError('Message field \'{}\': {}'.
-                                     format(name, e))
-                setattr(res, name, p)
-        return res
+        try:
+            view_class = self._view_classes[projection]
+        except KeyError:
+            view_class = _get_view_class(self, projection)
+            self._view_classes[projection] = view_class
+        return view_class(input_)
 
     def serialize(self, input_):
         """Serialize the message.
@@ -169,7 +221,7 @@ class Message(object):
             raise ValueError('Message is not optional')
         elif input_ is None and self._is_optional:
             return None
-        elif not isinstance(input_, types.SimpleNamespace):
+        elif not isinstance(input_, (types.SimpleNamespace, _Record)):
             raise ValueError('Message expected types.SimpleNamespace but got {}'
                              .format(type(input_)))
 
@@ -181,3 +233,806 @@ class Message(object):
             else:
                 res.append(None)
         return res
+
+    def check_projection(self, projection):
+        """Check a projection of the Message.
+
+        Raises ValueError if the projection contains fields which don't exist.
+        """
+        self._get_parser(_freeze_projection(projection))
+
+    def _get_parser(self, projection=None):
+        """Return the compiled parse function, compiling it if necessary.
+
+        Raises ValueError if the frozen projection is invalid.
+        """
+        try:
+            return self._parsers[projection]
+        except KeyError:
+            parser = _compile_message(self, projection)
+            self._parsers[projection] = parser
+            return parser
+
+
+def _parse_lazy(field, input_, projection=None):
+    """Parse input with a field, lazily if it's a Message or RepeatedField."""
+    if isinstance(field, (Message, RepeatedField)):
+        return field.parse(input_, lazy=True, projection=projection)
+    else:
+        return field.parse(input_)
+
+
+##############################################################################
+# Projections
+##############################################################################
+
+
+class _FrozenProjection(frozenset):
+
+    """Hashable form of a projection: a set of (name, frozen projection)."""
+
+
+def _freeze_projection(projection):
+    """Return the hashable form of a projection, so parsers can be cached."""
+    if projection is None or isinstance(projection, _FrozenProjection):
+        return projection
+    elif isinstance(projection, dict):
+        return _FrozenProjection(
+            (name, _freeze_projection(field_projection))
+            for name, field_projection in projection.items()
+        )
+    else:
+        return _FrozenProjection((name, None) for name in projection)
+
+
+def _normalise_projection(projection):
+    """Return a projection as a dict of dicts."""
+    if isinstance(projection, dict):
+        return {name: (None if field_projection is None else
+                       _normalise_projection(field_projection))
+                for name, field_projection in projection.items()}
+    else:
+        return {name: None for name in projection}
+
+
+def merge_projections(*projections):
+    """Return a projection which includes every field of the projections.
+
+    The result is a dict of dicts, or None if any projection is None.
+    """
+    res = {}
+    for projection in projections:
+        if projection is None:
+            return None
+        for name, field_projection in _normalise_projection(
+                projection
+        ).items():
+            if name not in res:
+                res[name] = field_projection
+            elif res[name] is None or field_projection is None:
+                res[name] = None
+            else:
+                res[name] = merge_projections(res[name], field_projection)
+    return res
+
+
+def _project_fields(message, projection):
+    """Return (index, name, field, field projection) for each named field.
+
+    Fields outside the frozen projection have field None.
+
+    Raises ValueError if the projection contains fields which the Message
+    doesn't have, or a projection of a field without fields.
+    """
+    projection = None if projection is None else dict(projection)
+    res = []
+    for index, (name, field) in enumerate(message._name_field_pairs):
+        if name is None:
+            continue
+        elif projection is None:
+            res.append((index, name, field, None))
+        elif name in projection:
+            field_projection = projection.pop(name)
+            item_field = field
+            while isinstance(item_field, RepeatedField):
+                item_field = item_field._field
+            if (field_projection is not None and
+                    not isinstance(item_field, Message)):
+                raise ValueError('Projection of field without fields: {!r}'
+                                 .format(name))
+            res.append((index, name, field, field_projection))
+        else:
+            res.append((index, name, None, None))
+    if projection:
+        raise ValueError('Projection of unknown fields: {}'
+                         .format(', '.join(sorted(map(repr, projection)))))
+    return res
+
+
+##############################################################################
+# Records
+##############################################################################
+
+
+class _Record(object):
+
+    """Base class of the record classes produced by parsing Messages.
+
+    Records compare equal to, and have the same repr as, a SimpleNamespace
+    with the same attributes. Subclasses are generated by _get_record_class.
+    """
+
+    __slots__ = ()
+    __hash__ = None
+    _names = ()  # names of the attributes
+
+    @property
+    def __dict__(self):
+        """Dict of the record's attributes, like SimpleNamespace.__dict__."""
+        return {name: getattr(self, name) for name in self._names}
+
+    def __repr__(self):
+        return 'namespace({})'.format(', '.join(
+            '{}={!r}'.format(name, getattr(self, name))
+            for name in self._names
+        ))
+
+    def __eq__(self, other):
+        if isinstance(other, (_Record, types.SimpleNamespace)):
+            return self.__dict__ == other.__dict__
+        return NotImplemented
+
+    def __reduce__(self):
+        return (_restore_record, (self._names, tuple(
+            getattr(self, name) for name in self._names
+        )))
+
+
+_RECORD_CLASSES = {}  # {field names: record class}
+
+
+def _get_record_class(names):
+    """Return the record class with a tuple of attribute names.
+
+    The class's constructor takes the attribute values as positional
+    arguments.
+    """
+    try:
+        return _RECORD_CLASSES[names]
+    except KeyError:
+        pass
+    args = ['v{}'.format(index) for index in range(len(names))]
+    lines = ['def __init__({}):'.format(', '.join(['self'] + args))]
+    for name, arg in zip(names, args):
+        if name.isidentifier() and not keyword.iskeyword(name):
+            lines.append('    self.{} = {}'.format(name, arg))
+        else:
+            lines.append('    setattr(self, {!r}, {})'.format(name, arg))
+    lines.append('    pass')
+    namespace = {}
+    exec(compile('\n'.join(lines), '<pblite record>', 'exec'), namespace)
+    cls = type('Record', (_Record,), {
+        '__slots__': names, '_names': names, '__init__': namespace['__init__'],
+    })
+    _RECORD_CLASSES[names] = cls
+    return cls
+
+
+def _restore_record(names, values):
+    """Return a record from its attribute names and values, for pickle."""
+    return _get_record_class(names)(*values)
+
+
+class _View(_Record):
+
+    """Base class of the lazy views produced by parsing Messages lazily.
+
+    A view keeps the input list, and parses each field into its slot the
+    first time the attribute is accessed. Pickling a view produces a record.
+    Subclasses are generated by _get_view_class.
+    """
+
+    __slots__ = ()
+    # {name: (index of the input item, field or None, projection of field)}
+    _fields = {}
+
+    def __init__(self, input_):
+        self._input = input_
+
+    def __getattr__(self, name):
+        # Only called if the slot hasn't been set yet.
+        try:
+            index, field, projection = self._fields[name]
+        except KeyError:
+            raise AttributeError('{!r} object has no attribute {!r}'
+                                 .format(type(self).__name__, name))
+        if field is None:
+            # Outside the projection.
+            setattr(self, name, None)
+            return None
+        input_ = self._input[index] if index < len(self._input) else None
+        try:
+            value = _parse_lazy(field, input_, projection)
+        except ValueError as e:
+            raise ValueError('Message field \'{}\': {}'.format(name, e))
+        setattr(self, name, value)
+        return value
+
+    def validate(self):
+        """Parse every field, including the fields of nested views.
+
+        Raises ValueError like parsing the input without lazy.
+        """
+        for name in self._names:
+            value = getattr(self, name)
+            try:
+                _validate(value)
+            except ValueError as e:
+                raise ValueError('Message field \'{}\': {}'.format(name, e))
+
+
+def _validate(value):
+    """Validate a view, or the views in a list, if value contains any."""
+    if isinstance(value, _View):
+        value.validate()
+    elif isinstance(value, list):
+        for item in value:
+            try:
+                _validate(item)
+            except ValueError as e:
+                raise ValueError('RepeatedField item: {}'.format(e))
+
+
+def _get_view_class(message, projection):
+    """Return a new view class for a Message and a frozen projection.
+
+    Raises ValueError if the projection is invalid.
+    """
+    fields = {}
+    for index, name, field, field_projection in _project_fields(message,
+                                                                 projection):
+        fields[name] = (index, field, field_projection)
+    names = tuple(name for name, _ in message._name_field_pairs
+                  if name is not None)
+    return type('View', (_View,), {
+        '__slots__': names + ('_input',), '_names': names, '_fields': fields,
+    })
+
+
+##############################################################################
+# Parser compilation
+##############################################################################
+
+# Message and RepeatedField parsers are compiled into Python functions the
+# first time they are used. The generated code indexes the input directly,
+# checks Fields and nested Messages inline, constructs records positionally,
+# and looks up EnumFields in a dict,
+# falling back to the Enum for its error message. RepeatedFields call their own
+# compiled parsers. Errors are the same as the ones raised by the parse
+# methods of the fields. A separate function is compiled for each projection,
+# which sets the fields outside the projection to None.
+
+
+class _ParserCompiler(object):
+
+    """Generates the source of a parse function."""
+
+    def __init__(self, args='input_'):
+        self.namespace = {}
+        self.lines = ['def parse({}):'.format(args)]
+        self._num_names = 0
+
+    def new_name(self, prefix):
+        """Return a new unique name."""
+        self._num_names += 1
+        return '{}{}'.format(prefix, self._num_names)
+
+    def add_input_checks(self, kind, is_optional, var, prefix, indent,
+                         none_line):
+        """Add lines validating the input of a Message or RepeatedField.
+
+        If the input is None and is_optional, none_line is added.
+        """
+        self.lines.append('{}if {} is None:'.format(indent, var))
+        if is_optional:
+            self.lines.append('{}    {}'.format(indent, none_line))
+        else:
+            self.lines.append('{}    raise ValueError({!r})'.format(
+                indent, '{}{} is not optional'.format(prefix, kind)
+            ))
+        self.lines.extend([
+            '{}elif not isinstance({}, list):'.format(indent, var),
+            '{}    raise ValueError({!r}.format(type({})))'.format(
+                indent, '{}{} expected list but got {{}}'.format(prefix, kind),
+                var
+            ),
+        ])
+
+    def add_message(self, message, var, prefix, indent, projection):
+        """Add lines parsing the list var with a Message into var.
+
+        Raises ValueError if the frozen projection is invalid.
+        """
+        num_fields = len(message._name_field_pairs)
+        self.lines.extend([
+            '{}if len({}) < {}:'.format(indent, var, num_fields),
+            '{}    {} = {} + [None] * ({} - len({}))'
+            .format(indent, var, var, num_fields, var),
+        ])
+        values = []
+        for index, name, field, field_projection in _project_fields(
+                message, projection
+        ):
+            if field is None:
+                values.append((name, 'None'))
+            else:
+                field_var = self.new_name('v')
+                self.add_field(field, field_var,
+                               '{}[{}]'.format(var, index),
+                               '{}Message field \'{}\': '.format(prefix,
+                                                                   name),
+                               indent, field_projection)
+                values.append((name, field_var))
+        record = self.new_name('_record')
+        self.namespace[record] = _get_record_class(
+            tuple(name for name, _ in values)
+        )
+        self.lines.append('{}{} = {}({})'.format(
+            indent, var, record,
+            ', '.join(field_var for _, field_var in values)
+        ))
+
+    def add_field(self, field, var, expr, prefix, indent, projection):
+        """Add lines parsing expr with field into var.
+
+        ValueErrors are raised with prefix added to their message.
+        """
+        self.lines.append('{}{} = {}'.format(indent, var, expr))
+        if type(field) is Field:
+            if not field._is_optional:
+                self.lines.extend([
+                    '{}if {} is None:'.format(indent, var),
+                    '{}    raise ValueError({!r})'
+                    .format(indent, prefix + 'Field is not optional'),
+                ])
+            if field._pool is not None:
+                self.add_intern(field, var, indent)
+        elif type(field) is EnumField:
+            name = self.new_name('_enum')
+            self.namespace[name] = field._enum
+            self.namespace[name + '_values'] = {
+                member.value: member for member in field._enum
+            }
+            self.lines.extend([
+                '{}try:'.format(indent),
+                '{}    {} = {}_values[{}]'.format(indent, var, name, var),
+                '{}except (KeyError, TypeError):'.format(indent),
+                '{}    try:'.format(indent),
+                '{}        {} = {}({})'.format(indent, var, name, var),
+                '{}    except ValueError as e:'.format(indent),
+                '{}        raise ValueError({!r} + str(e))'
+                .format(indent, prefix),
+            ])
+        elif type(field) is Message:
+            self.add_input_checks('Message', field._is_optional, var, prefix,
+                                  indent, 'pass')
+            self.lines.append('{}else:'.format(indent))
+            self.add_message(field, var, prefix, indent + '    ',
+                             projection)
+        else:
+            name = self.new_name('_parse')
+            if isinstance(field, RepeatedField):
+                self.namespace[name] = field._get_parser(projection)
+            else:
+                self.namespace[name] = field.parse
+            self.lines.extend([
+                '{}try:'.format(indent),
+                '{}    {} = {}({})'.format(indent, var, name, var),
+                '{}except ValueError as e:'.format(indent),
+                '{}    raise ValueError({!r} + str(e))'.format(indent, prefix),
+            ])
+
+    def add_intern(self, field, var, indent):
+        """Add lines interning var in the pool of a Field."""
+        name = self.new_name('_intern')
+        self.namespace[name] = field._pool.intern
+        self.lines.append('{}{} = {}({})'.format(indent, var, name, var))
+
+    def define(self):
+        """Execute the generated source and return the parse function."""
+        exec(compile('\n'.join(self.lines), '<pblite parser>', 'exec'),
+             self.namespace)
+        return self.namespace['parse']
+
+
+def _compile_message(message, projection):
+    """Return a function which parses input like message.parse.
+
+    Raises ValueError if the frozen projection is invalid.
+    """
+    compiler = _ParserCompiler()
+    compiler.add_input_checks('Message', message._is_optional, 'input_', '',
+                              '    ', 'return None')
+    compiler.add_message(message, 'input_', '', '    ', projection)
+    compiler.lines.append('    return input_')
+    return compiler.define()
+
+
+def _compile_repeated_field(repeated_field, projection):
+    """Return a function which parses input like repeated_field.parse.
+
+    Raises ValueError if the frozen projection is invalid.
+    """
+    compiler = _ParserCompiler()
+    compiler.add_input_checks('RepeatedField', repeated_field._is_optional,
+                              'input_', '', '    ', 'return None')
+    field = repeated_field._field
+    prefix = 'RepeatedField item: '
+    if projection is not None and not isinstance(field, (Message,
+                                                         RepeatedField)):
+        raise ValueError('Projection of field without fields')
+    if type(field) is Field and field._pool is None:
+        if not field._is_optional:
+            compiler.lines.extend([
+                '    if None in input_:',
+                '        raise ValueError({!r})'
+                .format(prefix + 'Field is not optional'),
+            ])
+        compiler.lines.append('    return list(input_)')
+    else:
+        compiler.lines.extend(['    res = []', '    for item in input_:'])
+        compiler.add_field(field, 'item', 'item', prefix, '        ',
+                           projection)
+        compiler.lines.extend(['        res.append(item)', '    return res'])
+    return compiler.define()
+
+
+##############################################################################
+# Binary snapshots
+##############################################################################
+
+# A snapshot is MAGIC, followed by the 4 byte little-endian CRC-32 of a
+# description of the field's schema, followed by the encoding of a value of
+# the field. Snapshots are only decoded with a field with the same schema, so
+# a snapshot written before the schema changed isn't decoded into the wrong
+# fields. The encoding is driven by the field, so only untyped Fields need
+# type tags:
+#
+# Field: a tag byte followed by the tagged value:
+#   _NONE, _FALSE, _TRUE: nothing
+#   _INT: the zigzag-encoded varint
+#   _FLOAT: a little-endian double
+#   _STRING: the varint length of the UTF-8 encoding, followed by it; the
+#            string is appended to the snapshot's string table
+#   _STRING_REF: the varint index of a string in the string table
+#   _LIST: the varint number of items, followed by the tagged items
+#   _DICT: the varint number of items, followed by tagged keys and values
+# EnumField: the varint ordinal of the member plus one, or 0 for None.
+# Message: 0 for None, otherwise 1 followed by the named fields in order.
+# RepeatedField: 0 for None, otherwise the varint number of items plus one,
+#                followed by the items.
+#
+# Varints are unsigned little-endian base 128. Decoders are compiled like
+# parsers.
+
+MAGIC = b'PBLITE\x00\x02'
+_NONE, _FALSE, _TRUE, _INT, _FLOAT, _STRING, _STRING_REF, _LIST, _DICT = (
+    range(9)
+)
+_DOUBLE = struct.Struct('<d')
+_DECODERS = {}  # {field: compiled decode function}
+_HEADERS = {}  # {field: MAGIC followed by the schema fingerprint}
+# Exceptions decoding an invalid snapshot may raise. Nesting too deeply
+# raises RuntimeError.
+_DECODE_ERRORS = (IndexError, KeyError, TypeError, ValueError, RuntimeError,
+                  struct.error)
+
+
+def encode(field, value):
+    """Return the binary snapshot of a parsed value of a field.
+
+    Raises ValueError if the value can't be encoded with the field.
+    """
+    encoder = _Encoder(_get_header(field))
+    encoder.write_field(field, value)
+    return bytes(encoder.buf)
+
+
+def decode(field, data):
+    """Return the value of a field from a binary snapshot.
+
+    data is a bytes-like object. Messages are decoded into the same record
+    classes as parsing produces.
+
+    Raises ValueError if data isn't a valid snapshot, or was encoded with a
+    field with a different schema.
+    """
+    header = _get_header(field)
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError('Not a pblite snapshot')
+    if data[:len(header)] != header:
+        raise ValueError('pblite snapshot was encoded with a different '
+                         'schema')
+    try:
+        decoder = _DECODERS[field]
+    except KeyError:
+        decoder = _compile_decoder(field)
+        _DECODERS[field] = decoder
+    try:
+        value, pos = decoder(data, len(header), [])
+    except _DECODE_ERRORS as e:
+        raise ValueError('Invalid pblite snapshot: {}'.format(e))
+    if pos != len(data):
+        raise ValueError('Invalid pblite snapshot: trailing data')
+    return value
+
+
+def _get_header(field):
+    """Return the header of snapshots of a field."""
+    header = _HEADERS.get(field)
+    if header is None:
+        fingerprint = zlib.crc32(_describe_schema(field).encode())
+        header = MAGIC + struct.pack('<I', fingerprint)
+        _HEADERS[field] = header
+    return header
+
+
+def _describe_schema(field):
+    """Return a description of everything about a field's schema which
+    affects the encoding of its values.
+    """
+    if isinstance(field, Message):
+        return 'Message({})'.format(', '.join(
+            '{}={}'.format(name, _describe_schema(item_field))
+            for name, item_field in field._name_field_pairs
+            if name is not None
+        ))
+    elif isinstance(field, RepeatedField):
+        return 'RepeatedField({})'.format(_describe_schema(field._field))
+    elif isinstance(field, EnumField):
+        return 'EnumField({})'.format(', '.join(
+            '{}={!r}'.format(member.name, member.value)
+            for member in field._enum
+        ))
+    else:
+        return 'Field'
+
+
+class _Encoder(object):
+
+    """Writes a binary snapshot after a header."""
+
+    def __init__(self, header):
+        self.buf = bytearray(header)
+        self._strings = {}  # {string: index in the string table}
+        self._ordinals = {}  # {Enum: {member: ordinal}}
+
+    def write_varint(self, value):
+        """Write an unsigned varint."""
+        while value >= 0x80:
+            self.buf.append(value & 0x7f | 0x80)
+            value >>= 7
+        self.buf.append(value)
+
+    def write_value(self, value):
+        """Write a tagged value.
+
+        Raises ValueError if the value is of a type which can't be encoded.
+        """
+        if value is None:
+            self.buf.append(_NONE)
+        elif value is False:
+            self.buf.append(_FALSE)
+        elif value is True:
+            self.buf.append(_TRUE)
+        elif isinstance(value, int):
+            self.buf.append(_INT)
+            self.write_varint(value << 1 if value >= 0 else
+                              (-value - 1) << 1 | 1)
+        elif isinstance(value, float):
+            self.buf.append(_FLOAT)
+            self.buf.extend(_DOUBLE.pack(value))
+        elif isinstance(value, str):
+            index = self._strings.get(value)
+            if index is None:
+                self._strings[value] = len(self._strings)
+                encoded = value.encode('utf-8', 'surrogatepass')
+                self.buf.append(_STRING)
+                self.write_varint(len(encoded))
+                self.buf.extend(encoded)
+            else:
+                self.buf.append(_STRING_REF)
+                self.write_varint(index)
+        elif isinstance(value, list):
+            self.buf.append(_LIST)
+            self.write_varint(len(value))
+            for item in value:
+                self.write_value(item)
+        elif isinstance(value, dict):
+            self.buf.append(_DICT)
+            self.write_varint(len(value))
+            for key, item in value.items():
+                self.write_value(key)
+                self.write_value(item)
+        else:
+            raise ValueError('Can\'t encode {}'.format(type(value)))
+
+    def write_field(self, field, value):
+        """Write the value of a field.
+
+        Raises ValueError if the value can't be encoded with the field.
+        """
+        if isinstance(field, Message):
+            if value is None:
+                self.buf.append(0)
+            elif isinstance(value, (types.SimpleNamespace, _Record)):
+                self.buf.append(1)
+                for name, item_field in field._name_field_pairs:
+                    if name is not None:
+                        self.write_field(item_field, getattr(value, name))
+            else:
+                raise ValueError('Message expected record but got {}'
+                                 .format(type(value)))
+        elif isinstance(field, RepeatedField):
+            if value is None:
+                self.buf.append(0)
+            elif isinstance(value, list):
+                self.write_varint(len(value) + 1)
+                for item in value:
+                    self.write_field(field._field, item)
+            else:
+                raise ValueError('RepeatedField expected list but got {}'
+                                 .format(type(value)))
+        elif isinstance(field, EnumField):
+            ordinals = self._ordinals.get(field._enum)
+            if ordinals is None:
+                ordinals = {member: ordinal for ordinal, member
+                            in enumerate(field._enum, 1)}
+                self._ordinals[field._enum] = ordinals
+            if value is None:
+                self.buf.append(0)
+            elif value in ordinals:
+                self.write_varint(ordinals[value])
+            else:
+                raise ValueError('{!r} is not a member of {}'
+                                 .format(value, field._enum))
+        else:
+            self.write_value(value)
+
+
+def _read_varint(data, pos):
+    """Return an unsigned varint and the position after it."""
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def _read_value(data, pos, strings):
+    """Return a tagged value and the position after it."""
+    tag = data[pos]
+    pos += 1
+    if tag == _STRING_REF:
+        index = data[pos]
+        if index < 0x80:
+            return strings[index], pos + 1
+        index, pos = _read_varint(data, pos)
+        return strings[index], pos
+    elif tag == _STRING:
+        length, pos = _read_varint(data, pos)
+        value = str(data[pos:pos + length], 'utf-8', 'surrogatepass')
+        strings.append(value)
+        return value, pos + length
+    elif tag == _INT:
+        value, pos = _read_varint(data, pos)
+        return (-(value >> 1) - 1 if value & 1 else value >> 1), pos
+    elif tag == _NONE:
+        return None, pos
+    elif tag == _FALSE:
+        return False, pos
+    elif tag == _TRUE:
+        return True, pos
+    elif tag == _FLOAT:
+        return _DOUBLE.unpack_from(data, pos)[0], pos + _DOUBLE.size
+    elif tag == _LIST:
+        length, pos = _read_varint(data, pos)
+        value = []
+        for _ in range(length):
+            item, pos = _read_value(data, pos, strings)
+            value.append(item)
+        return value, pos
+    elif tag == _DICT:
+        length, pos = _read_varint(data, pos)
+        value = {}
+        for _ in range(length):
+            key, pos = _read_value(data, pos, strings)
+            value[key], pos = _read_value(data, pos, strings)
+        return value, pos
+    else:
+        raise IndexError('unknown tag {}'.format(tag))
+
+
+class _DecoderCompiler(_ParserCompiler):
+
+    """Generates the source of a snapshot decode function."""
+
+    def __init__(self):
+        super().__init__('data, pos, strings')
+        self.namespace.update(_read_varint=_read_varint,
+                              _read_value=_read_value)
+
+    def add_varint(self, var, indent):
+        """Add lines reading a varint into var."""
+        self.lines.extend([
+            '{}{} = data[pos]'.format(indent, var),
+            '{}if {} < 0x80:'.format(indent, var),
+            '{}    pos += 1'.format(indent),
+            '{}else:'.format(indent),
+            '{}    {}, pos = _read_varint(data, pos)'.format(indent, var),
+        ])
+
+    def add_decode(self, field, var, indent):
+        """Add lines decoding the value of field into var."""
+        if isinstance(field, Message):
+            self.lines.extend([
+                '{}pos += 1'.format(indent),
+                '{}if data[pos - 1] == 0:'.format(indent),
+                '{}    {} = None'.format(indent, var),
+                '{}else:'.format(indent),
+            ])
+            values = []
+            for name, item_field in field._name_field_pairs:
+                if name is not None:
+                    item_var = self.new_name('v')
+                    self.add_decode(item_field, item_var, indent + '    ')
+                    values.append((name, item_var))
+            record = self.new_name('_record')
+            self.namespace[record] = _get_record_class(
+                tuple(name for name, _ in values)
+            )
+            self.lines.append('{}    {} = {}({})'.format(
+                indent, var, record,
+                ', '.join(item_var for _, item_var in values)
+            ))
+        elif isinstance(field, RepeatedField):
+            length = self.new_name('n')
+            item_var = self.new_name('item')
+            self.add_varint(length, indent)
+            self.lines.extend([
+                '{}if {} == 0:'.format(indent, length),
+                '{}    {} = None'.format(indent, var),
+                '{}else:'.format(indent),
+                '{}    {} = []'.format(indent, var),
+                '{}    for _ in range({} - 1):'.format(indent, length),
+            ])
+            self.add_decode(field._field, item_var, indent + '        ')
+            self.lines.append('{}        {}.append({})'.format(indent, var,
+                                                              item_var))
+        elif isinstance(field, EnumField):
+            members = self.new_name('_members')
+            self.namespace[members] = (None,) + tuple(field._enum)
+            self.add_varint(var, indent)
+            self.lines.append('{}{} = {}[{}]'.format(indent, var, members,
+                                                     var))
+        else:
+            self.lines.append('{}{}, pos = _read_value(data, pos, strings)'
+                              .format(indent, var))
+            if isinstance(field, Field) and field._pool is not None:
+                self.add_intern(field, var, indent)
+
+
+def _compile_decoder(field):
+    """Return a function which decodes the value of field at a position.
+
+    The function takes the snapshot, the position and the string table, and
+    returns the value and the position after it.
+    """
+    compiler = _DecoderCompiler()
+    compiler.add_decode(field, 'value', '    ')
+    compiler.lines.append('    return value, pos')
+    return compiler.define()
@@ -5,6 +5,7 @@
 
 import enum
 
+from hangups.interning import IDS
 from hangups.pblite import Message, Field, RepeatedField, EnumField
 
 
@@ -134,17 +135,17 @@ class ActiveClientState(enum.Enum):
 ##############################################################################
 
 CONVERSATION_ID = Message(
-    ('id_', Field()),
+    ('id_', Field(pool=IDS)),
 )
 
 USER_ID = Message(
-    ('gaia_id', Field()),
-    ('chat_id', Field()),
+    ('gaia_id', Field(pool=IDS)),
+    ('chat_id', Field(pool=IDS)),
 )
 
 OPTIONAL_USER_ID = Message(
-    ('gaia_id', Field()),
-    ('chat_id', Field()),
+    ('gaia_id', Field(pool=IDS)),
+    ('chat_id', Field(pool=IDS)),
     is_optional=True,
 )
 
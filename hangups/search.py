@@ -0,0 +1,191 @@
+"""Full-text search of chat messages.
+
+SearchIndex is an in-memory inverted index: every word of a message's text
+is mapped to posting lists of the messages containing it, kept separately for
+each conversation. Searching for a query intersects the posting lists of its
+words from the newest message backwards, so it only visits messages
+containing the rarest word, and stops once it has enough matches.
+
+For histories too large to index in memory, EventStore can keep an on-disk
+index instead (see hangups.store).
+"""
+
+import array
+import bisect
+import collections
+import heapq
+import itertools
+import re
+
+from hangups import conversation_event
+
+DEFAULT_LIMIT = 50
+_WORD_RE = re.compile(r'\w+')
+
+SearchResult = collections.namedtuple('SearchResult', [
+    'conversation_id',  # str
+    'event_id',  # str
+    'timestamp',  # int, microseconds
+])
+
+
+def tokenize(text):
+    """Return a list of the case-folded words in text."""
+    return _WORD_RE.findall(text.casefold())
+
+
+class SearchIndex(object):
+
+    """In-memory inverted index of chat messages.
+
+    Messages are numbered in the order they're added, and each posting list
+    is an array of message numbers in ascending order. Removed messages are
+    left in the posting lists until more than half of the messages have been
+    removed, when the remaining messages are renumbered.
+    """
+
+    def __init__(self):
+        self._conv_ids = []  # [conversation ID]
+        self._conv_indexes = {}  # {conversation ID: index in _conv_ids}
+        # Event IDs and timestamps of the messages, by message number. The
+        # event IDs of removed messages are None.
+        self._event_ids = []
+        self._timestamps = array.array('q')
+        self._numbers = {}  # {event ID: message number}
+        # {word: {conversation index: array of message numbers}}
+        self._postings = {}
+
+    def __len__(self):
+        return len(self._numbers)
+
+    def add(self, conv_id, event_id, timestamp, text):
+        """Index the text of a message.
+
+        Messages with the same event ID as an indexed message are ignored.
+        """
+        if event_id in self._numbers:
+            return
+        conv_index = self._conv_indexes.get(conv_id)
+        if conv_index is None:
+            conv_index = len(self._conv_ids)
+            self._conv_ids.append(conv_id)
+            self._conv_indexes[conv_id] = conv_index
+        number = len(self._event_ids)
+        self._event_ids.append(event_id)
+        self._timestamps.append(timestamp)
+        self._numbers[event_id] = number
+        for word in set(tokenize(text)):
+            conv_postings = self._postings.get(word)
+            if conv_postings is None:
+                conv_postings = self._postings[word] = {}
+            postings = conv_postings.get(conv_index)
+            if postings is None:
+                postings = conv_postings[conv_index] = array.array('i')
+            postings.append(number)
+
+    def add_event(self, conv_event):
+        """Index a ConversationEvent if it's a ChatMessageEvent."""
+        if isinstance(conv_event, conversation_event.ChatMessageEvent):
+            self.add(conv_event.conversation_id, conv_event.id_,
+                     conv_event.timestamp_us, conv_event.text)
+
+    def remove(self, event_id):
+        """Remove a message from the index, if it's indexed."""
+        number = self._numbers.pop(event_id, None)
+        if number is None:
+            return
+        self._event_ids[number] = None
+        if len(self._numbers) * 2 < len(self._event_ids):
+            self._compact()
+
+    def remove_events(self, conv_events):
+        """Remove a list of ConversationEvents from the index, like the
+        events evicted by a Conversation.
+        """
+        for conv_event in conv_events:
+            self.remove(conv_event.id_)
+
+    def search(self, query, conv_ids=None, limit=DEFAULT_LIMIT):
+        """Return a list of SearchResults of the newest messages containing
+        every word of query, newest first.
+
+        Messages are ordered by when they were added, which is the order of
+        their timestamps unless they arrived out of order. If conv_ids isn't
+        None, only the conversations with those IDs are searched.
+        """
+        words = set(tokenize(query))
+        if not words:
+            return []
+        word_postings = [self._postings.get(word, {}) for word in words]
+        # Only conversations containing the rarest word can match.
+        rarest = min(word_postings, key=len)
+        if conv_ids is None:
+            conv_indexes = list(rarest)
+        else:
+            conv_indexes = [self._conv_indexes[conv_id]
+                            for conv_id in conv_ids
+                            if self._conv_indexes.get(conv_id) in rarest]
+        matches = []
+        for conv_index in conv_indexes:
+            postings = [conv_postings.get(conv_index)
+                        for conv_postings in word_postings]
+            if None not in postings:
+                matches.append(_get_matches(conv_index, postings,
+                                            self._event_ids))
+        # Merge the matches of each conversation, newest first, until there
+        # are enough.
+        return [
+            SearchResult(self._conv_ids[conv_index], self._event_ids[-key],
+                         self._timestamps[-key])
+            for key, conv_index in itertools.islice(heapq.merge(*matches),
+                                                    limit)
+        ]
+
+    def _compact(self):
+        """Renumber the remaining messages, dropping the removed ones."""
+        new_numbers = array.array('i')
+        event_ids = []
+        timestamps = array.array('q')
+        for event_id, timestamp in zip(self._event_ids, self._timestamps):
+            new_numbers.append(len(event_ids))
+            if event_id is not None:
+                self._numbers[event_id] = len(event_ids)
+                event_ids.append(event_id)
+                timestamps.append(timestamp)
+        for word, conv_postings in list(self._postings.items()):
+            for conv_index, postings in list(conv_postings.items()):
+                postings = array.array('i', [
+                    new_numbers[number] for number in postings
+                    if self._event_ids[number] is not None
+                ])
+                if postings:
+                    conv_postings[conv_index] = postings
+                else:
+                    del conv_postings[conv_index]
+            if not conv_postings:
+                del self._postings[word]
+        self._event_ids = event_ids
+        self._timestamps = timestamps
+
+
+def _get_matches(conv_index, postings, event_ids):
+    """Yield (-message number, conversation index) of the messages in every
+    one of a list of posting lists which haven't been removed, newest first.
+    """
+    for number in _intersect(postings):
+        if event_ids[number] is not None:
+            yield -number, conv_index
+
+
+def _intersect(postings):
+    """Yield the message numbers in every one of a list of posting lists, in
+    descending order.
+    """
+    postings = sorted(postings, key=len)
+    for number in reversed(postings[0]):
+        for other in postings[1:]:
+            index = bisect.bisect_left(other, number)
+            if index == len(other) or other[index] != number:
+                break
+        else:
+            yield number
@@ -0,0 +1,398 @@
+"""Persistent storage of conversations, events and entities in SQLite.
+
+EventStore keeps ClientEvents, ClientConversations and ClientEntities in a
+SQLite database in WAL mode, so history survives restarts and old events can
+be served from disk instead of being kept in memory or fetched again.
+
+With full_text enabled, the text of chat messages is also indexed in an FTS5
+table for searching large histories (see hangups.search).
+
+Values are stored as pblite binary snapshots (see hangups.pblite.encode), so
+they are decoded into the same records as parsing produces. Values parsed
+with a projection are stored with only the projected fields. Snapshots
+written before a schema change can't be decoded, and reading them raises
+ValueError.
+
+The event loop never waits for the disk: writes are queued for a dedicated
+writer thread, which inserts them in one transaction per flush interval, and
+reads run in a separate reader thread. In WAL mode, reads don't wait for the
+writer.
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+from hangups import conversation_event, pblite, schemas, search
+
+logger = logging.getLogger(__name__)
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS events (
+    event_id TEXT,
+    conversation_id TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    text TEXT  -- text of chat messages if full_text is enabled, or NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS events_event_id ON events (event_id);
+CREATE INDEX IF NOT EXISTS events_conversation_id_timestamp
+    ON events (conversation_id, timestamp);
+CREATE TABLE IF NOT EXISTS conversations (
+    conversation_id TEXT PRIMARY KEY,
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entities (
+    chat_id TEXT PRIMARY KEY,
+    data BLOB NOT NULL
+);
+'''
+# Index of the text column of events, which is updated as events are inserted.
+# Duplicate events are ignored before the trigger.
+_FULL_TEXT_SCHEMA = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5(
+    text, content='events', content_rowid='rowid'
+);
+CREATE TRIGGER IF NOT EXISTS events_insert_message AFTER INSERT ON events
+WHEN new.text IS NOT NULL BEGIN
+    INSERT INTO messages (rowid, text) VALUES (new.rowid, new.text);
+END;
+'''
+_INSERT_EVENT = ('INSERT OR IGNORE INTO events (event_id, conversation_id, '
+                 'timestamp, data, text) VALUES (?, ?, ?, ?, ?)')
+_INSERT_CONVERSATION = ('INSERT OR REPLACE INTO conversations '
+                        '(conversation_id, data) VALUES (?, ?)')
+_INSERT_ENTITY = ('INSERT OR REPLACE INTO entities (chat_id, data) '
+                  'VALUES (?, ?)')
+
+
+class EventStore(object):
+
+    """SQLite database of ClientEvents, ClientConversations and
+    ClientEntities.
+
+    The add_ methods queue values to be written and return immediately.
+    Queued values are written by the writer thread within flush_interval
+    seconds, and aren't returned by the get_ coroutines until then. Events
+    are ignored if an event with the same ID is already stored.
+    """
+
+    def __init__(self, path, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 full_text=False):
+        """Open a store, creating the database at path if necessary.
+
+        If full_text is True, the text of chat messages is indexed for
+        search, which requires SQLite to support FTS5. Messages which were
+        added without full_text aren't indexed.
+
+        The database is opened by the writer thread, so errors opening it
+        are raised by the first read or flush.
+        """
+        self._path = path
+        self._flush_interval = flush_interval
+        self._full_text = full_text
+        # Queue of (SQL, parameters) to write, concurrent.futures.Futures to
+        # resolve once everything before them is written, and None to stop.
+        self._queue = queue.Queue()
+        self._is_closed = False
+        # Set by the writer thread once the schema exists:
+        self._is_ready = threading.Event()
+        self._open_error = None  # exception opening the database
+        # Connection only used by the reader thread:
+        self._read_conn = None
+        self._reader = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._writer = threading.Thread(target=self._write_loop,
+                                        name='EventStore writer', daemon=True)
+        self._writer.start()
+
+    ##########################################################################
+    # Writing
+    ##########################################################################
+
+    def add_events(self, client_events):
+        """Queue ClientEvents to be written.
+
+        Raises ValueError if the store is closed.
+        """
+        for client_event in client_events:
+            text = None
+            if self._full_text and client_event.chat_message is not None:
+                text = conversation_event.ChatMessageEvent(client_event).text
+            self._put(_INSERT_EVENT, (
+                client_event.event_id, client_event.conversation_id.id_,
+                client_event.timestamp,
+                pblite.encode(schemas.CLIENT_EVENT, client_event), text
+            ))
+
+    def add_conversation(self, client_conversation):
+        """Queue a ClientConversation to be written, replacing any stored
+        version of it.
+
+        Raises ValueError if the store is closed.
+        """
+        self._put(_INSERT_CONVERSATION, (
+            client_conversation.conversation_id.id_,
+            pblite.encode(schemas.CLIENT_CONVERSATION, client_conversation)
+        ))
+
+    def add_entities(self, entities):
+        """Queue ClientEntities to be written, replacing any stored versions
+        of them.
+
+        Raises ValueError if the store is closed.
+        """
+        for entity in entities:
+            self._put(_INSERT_ENTITY, (
+                entity.id_.chat_id,
+                pblite.encode(schemas.CLIENT_ENTITY, entity)
+            ))
+
+    @asyncio.coroutine
+    def flush(self):
+        """Write the queued values now.
+
+        Raises ValueError if the store is closed, or sqlite3.Error if writing
+        fails.
+        """
+        if self._is_closed:
+            raise ValueError('EventStore is closed')
+        future = concurrent.futures.Future()
+        self._queue.put(future)
+        yield from asyncio.wrap_future(future)
+
+    @asyncio.coroutine
+    def close(self):
+        """Write the queued values and close the database."""
+        if self._is_closed:
+            return
+        self._is_closed = True
+        future = concurrent.futures.Future()
+        self._queue.put(future)
+        self._queue.put(None)
+        try:
+            yield from asyncio.wrap_future(future)
+        except (sqlite3.Error, ValueError) as e:
+            logger.warning('Failed to write EventStore before closing: {}'
+                           .format(e))
+        yield from asyncio.get_event_loop().run_in_executor(
+            self._reader, self._close_reader
+        )
+        self._reader.shutdown(wait=False)
+
+    def _put(self, sql, params):
+        """Queue a statement for the writer thread."""
+        if self._is_closed:
+            raise ValueError('EventStore is closed')
+        self._queue.put((sql, params))
+
+    def _write_loop(self):
+        """Write queued statements in batches until None is queued."""
+        try:
+            conn = _connect(self._path)
+            conn.executescript(_SCHEMA)
+            if self._full_text:
+                conn.executescript(_FULL_TEXT_SCHEMA)
+        except sqlite3.Error as e:
+            logger.error('Failed to open EventStore: {}'.format(e))
+            self._open_error = e
+            conn = None
+        self._is_ready.set()
+        is_stopping = False
+        while not is_stopping:
+            batch = [self._queue.get()]
+            # Keep collecting statements until the flush interval has passed,
+            # or a flush or close is requested.
+            deadline = time.monotonic() + self._flush_interval
+            while isinstance(batch[-1], tuple):
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            futures = [item for item in batch
+                       if isinstance(item, concurrent.futures.Future)]
+            is_stopping = None in batch
+            error = self._open_error
+            if conn is not None:
+                error = _write_batch(conn, [item for item in batch
+                                            if isinstance(item, tuple)])
+            for future in futures:
+                if error is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(error)
+        if conn is not None:
+            conn.close()
+
+    ##########################################################################
+    # Reading
+    ##########################################################################
+
+    @asyncio.coroutine
+    def get_events(self, conv_id, start=None, end=None, limit=None):
+        """Return a list of the stored ClientEvents of a conversation, oldest
+        first.
+
+        start and end are optional microsecond timestamps: only events from
+        start until before end are returned. If limit isn't None, only the
+        newest limit of those events are returned.
+
+        Raises sqlite3.Error if reading fails, or ValueError if a stored
+        value can't be decoded.
+        """
+        sql = 'SELECT data FROM events WHERE conversation_id = ?'
+        params = [conv_id]
+        if start is not None:
+            sql += ' AND timestamp >= ?'
+            params.append(start)
+        if end is not None:
+            sql += ' AND timestamp < ?'
+            params.append(end)
+        sql += ' ORDER BY timestamp DESC'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        rows = yield from self._read(self._select, schemas.CLIENT_EVENT, sql,
+                                     params)
+        rows.reverse()
+        return rows
+
+    @asyncio.coroutine
+    def get_conversations(self):
+        """Return a list of the stored ClientConversations.
+
+        Raises sqlite3.Error if reading fails, or ValueError if a stored
+        value can't be decoded.
+        """
+        return (yield from self._read(
+            self._select, schemas.CLIENT_CONVERSATION,
+            'SELECT data FROM conversations', ()
+        ))
+
+    @asyncio.coroutine
+    def get_entities(self):
+        """Return a list of the stored ClientEntities.
+
+        Raises sqlite3.Error if reading fails, or ValueError if a stored
+        value can't be decoded.
+        """
+        return (yield from self._read(
+            self._select, schemas.CLIENT_ENTITY, 'SELECT data FROM entities',
+            ()
+        ))
+
+    @asyncio.coroutine
+    def get_sync_timestamp(self):
+        """Return the microsecond timestamp of the newest stored event, or
+        None if there are no events.
+
+        Events after it can be synced with Client.syncallnewevents.
+
+        Raises sqlite3.Error if reading fails.
+        """
+        rows = yield from self._read(self._execute,
+                                     'SELECT MAX(timestamp) FROM events', ())
+        return rows[0][0]
+
+    @asyncio.coroutine
+    def search(self, query, conv_ids=None, limit=search.DEFAULT_LIMIT):
+        """Return a list of SearchResults of the newest chat messages
+        containing every word of query, newest first.
+
+        If conv_ids isn't None, only the conversations with those IDs are
+        searched.
+
+        Raises ValueError if full_text isn't enabled, or sqlite3.Error if
+        reading fails.
+        """
+        if not self._full_text:
+            raise ValueError('EventStore full_text is not enabled')
+        words = search.tokenize(query)
+        if not words or conv_ids == []:
+            return []
+        # Quote every word so it can't be parsed as FTS5 query syntax.
+        sql = ('SELECT events.conversation_id, events.event_id, '
+               'events.timestamp FROM messages JOIN events '
+               'ON events.rowid = messages.rowid WHERE messages MATCH ?')
+        params = [' '.join('"{}"'.format(word) for word in words)]
+        if conv_ids is not None:
+            sql += ' AND events.conversation_id IN ({})'.format(
+                ', '.join('?' * len(conv_ids))
+            )
+            params.extend(conv_ids)
+        sql += ' ORDER BY events.timestamp DESC LIMIT ?'
+        params.append(limit)
+        rows = yield from self._read(self._execute, sql, params)
+        return [search.SearchResult(*row) for row in rows]
+
+    @asyncio.coroutine
+    def _read(self, func, *args):
+        """Call a function in the reader thread and return its result."""
+        if self._is_closed:
+            raise ValueError('EventStore is closed')
+        return (yield from asyncio.get_event_loop().run_in_executor(
+            self._reader, func, *args
+        ))
+
+    def _execute(self, sql, params):
+        """Return the rows of a query. Called in the reader thread."""
+        if self._read_conn is None:
+            self._is_ready.wait()
+            if self._open_error is not None:
+                raise self._open_error
+            self._read_conn = _connect(self._path)
+        return self._read_conn.execute(sql, params).fetchall()
+
+    def _select(self, field, sql, params):
+        """Return the values decoded from a query of snapshots. Called in the
+        reader thread.
+        """
+        return [pblite.decode(field, data)
+                for data, in self._execute(sql, params)]
+
+    def _close_reader(self):
+        """Close the reader's connection. Called in the reader thread."""
+        if self._read_conn is not None:
+            self._read_conn.close()
+            self._read_conn = None
+
+
+def _connect(path):
+    """Return a connection to a database in WAL mode."""
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    # In WAL mode, the database can't be corrupted by a crash with
+    # synchronous=NORMAL, only the most recent transactions can be lost.
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+def _write_batch(conn, statements):
+    """Execute statements in one transaction, and return the exception if it
+    fails, or None.
+    """
+    if not statements:
+        return None
+    try:
+        with conn:
+            # Consecutive statements with the same SQL are executed together.
+            start = 0
+            for index in range(1, len(statements) + 1):
+                if (index == len(statements) or
+                        statements[index][0] != statements[start][0]):
+                    conn.executemany(statements[start][0], [
+                        params for _, params in statements[start:index]
+                    ])
+                    start = index
+    except sqlite3.Error as e:
+        logger.error('Failed to write {} statements to EventStore: {}'
+                     .format(len(statements), e))
+        return e
+    return None
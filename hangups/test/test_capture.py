@@ -0,0 +1,138 @@
+"""Tests for recording and replaying captures."""
+
+import asyncio
+import json
+import pytest
+
+from hangups import capture, client, fakeserver
+
+
+def _channel_chunk(state_updates):
+    payload = json.dumps(['cbu', state_updates])
+    submission = json.dumps([[1, ['c', ['SID', ['bfo', payload]]]]])
+    return '{}\n{}'.format(len(submission), submission).encode()
+
+
+def test_read_capture(tmpdir):
+    path = str(tmpdir.join('capture'))
+    writer = capture.CaptureWriter(path)
+    writer.write_channel_data(writer.new_stream(), b'abc')
+    writer.close()
+    writer = capture.CaptureWriter(path)
+    writer.write_response(writer.new_stream(), 'http://foo', b'bar')
+    writer.close()
+    with open(path, 'ab') as f:
+        f.write(b'truncated')
+    records = [(r.kind, r.stream_id, bytes(r.data))
+               for r in capture.read_capture(path)]
+    assert records == [
+        (capture.CHANNEL_DATA, 1, b'abc'),
+        (capture.RESPONSE, 2, b'http://foo\nbar'),
+    ]
+
+
+def test_capture_buffered(tmpdir):
+    """Test records are only written when they're flushed."""
+    path = str(tmpdir.join('capture'))
+    writer = capture.CaptureWriter(path, flush_interval=0)
+    writer.write_channel_data(writer.new_stream(), b'abc')
+    assert list(capture.read_capture(path)) == []
+    # The writer flushes the record once flush_interval has passed.
+    asyncio.get_event_loop().run_until_complete(asyncio.sleep(0.01))
+    assert len(list(capture.read_capture(path))) == 1
+    writer.write_channel_data(1, b'd' * capture.MAX_BUFFER_SIZE)
+    assert len(list(capture.read_capture(path))) == 2
+    writer.write_channel_data(1, b'e')
+    writer.flush()
+    assert len(list(capture.read_capture(path))) == 3
+    writer.close()
+
+
+def test_read_capture_invalid(tmpdir):
+    path = tmpdir.join('capture')
+    path.write('invalid')
+    with pytest.raises(ValueError):
+        list(capture.read_capture(str(path)))
+
+
+def test_replay_channel_data(tmpdir):
+    path = str(tmpdir.join('capture'))
+    state_update = [[1, None, 'trace', None, 1], None, None, None,
+                    [['c'], ['u', 'u'], 1, 1]]
+    chunk = _channel_chunk([state_update, state_update])
+    writer = capture.CaptureWriter(path)
+    stream_id = writer.new_stream()
+    writer.write_channel_data(stream_id, chunk[:20])
+    writer.write_channel_data(stream_id, chunk[20:])
+    writer.write_channel_data(writer.new_stream(), chunk)
+    writer.write_response(writer.new_stream(), client.ORIGIN_URL, b'')
+    writer.close()
+    replay_client = capture.ReplayClient()
+    received = []
+    replay_client.on_state_update.add_observer(received.append)
+    asyncio.get_event_loop().run_until_complete(replay_client.replay(path))
+    assert replay_client.num_records == 4
+    assert replay_client.num_state_updates == 4
+    assert [su.typing_notification.user_id.chat_id for su in received] == [
+        'u', 'u', 'u', 'u'
+    ]
+
+
+def test_replay_errors(tmpdir):
+    """Test invalid submissions and observer exceptions don't stop the rest
+    of a capture from being replayed.
+    """
+    path = str(tmpdir.join('capture'))
+    state_update = [[1, None, 'trace', None, 1], None, None, None,
+                    [['c'], ['u', 'u'], 1, 1]]
+    writer = capture.CaptureWriter(path)
+    stream_id = writer.new_stream()
+    writer.write_channel_data(stream_id, b'3\n[}]')
+    writer.write_channel_data(stream_id,
+                              _channel_chunk([state_update, state_update]))
+    writer.close()
+    replay_client = capture.ReplayClient()
+    received = []
+
+    def on_state_update(state_update):
+        received.append(state_update)
+        raise ValueError('observer failed')
+    replay_client.on_state_update.add_observer(on_state_update)
+    asyncio.get_event_loop().run_until_complete(replay_client.replay(path))
+    assert len(received) == 2
+
+
+def test_replay_appended_streams(tmpdir):
+    """Test streams appended by separate writers are replayed separately."""
+    path = str(tmpdir.join('capture'))
+    state_update = [[1, None, 'trace', None, 1], None, None, None,
+                    [['c'], ['u', 'u'], 1, 1]]
+    chunk = _channel_chunk([state_update])
+    # The first session is interrupted part way through a chunk.
+    writer = capture.CaptureWriter(path)
+    writer.write_channel_data(writer.new_stream(), chunk[:20])
+    writer.close()
+    writer = capture.CaptureWriter(path)
+    writer.write_channel_data(writer.new_stream(), chunk)
+    writer.close()
+    assert [r.stream_id for r in capture.read_capture(path)] == [1, 2]
+    replay_client = capture.ReplayClient()
+    asyncio.get_event_loop().run_until_complete(replay_client.replay(path))
+    assert replay_client.num_state_updates == 1
+
+
+def test_replay_chat_init_again(tmpdir):
+    """Test the lists from a previous chat init response stop observing."""
+    path = str(tmpdir.join('capture'))
+    body = fakeserver.FakeServer().get_chat_init_page().encode()
+    url = client.ORIGIN_URL + client.CHAT_INIT_PATH
+    writer = capture.CaptureWriter(path)
+    writer.write_response(writer.new_stream(), url, body)
+    writer.write_response(writer.new_stream(), url, body)
+    writer.close()
+    replay_client = capture.ReplayClient()
+    asyncio.get_event_loop().run_until_complete(replay_client.replay(path))
+    assert replay_client.on_state_update._observers == [
+        replay_client.user_list._on_state_update,
+        replay_client.conv_list._on_state_update,
+    ]
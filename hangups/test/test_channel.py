@@ -1,6 +1,8 @@
+import asyncio
+import json
 import pytest
 
-from hangups import channel
+from hangups import channel, javascript, parsers
 
 
 # [(test, (SID, header_client, gsessionid))]
@@ -24,20 +26,6 @@ def test_parse_sid_response(input_, expected):
     assert channel._parse_sid_response(input_) == expected
 
 
-@pytest.mark.parametrize('input_,expected', [
-    # '€' is 3 bytes in UTF-8.
-    ('€€'.encode()[:6], '€€'),
-    ('€€'.encode()[:5], '€'),
-    ('€€'.encode()[:4], '€'),
-    ('€€'.encode()[:3], '€'),
-    ('€€'.encode()[:2], ''),
-    ('€€'.encode()[:1], ''),
-    ('€€'.encode()[:0], ''),
-])
-def test_best_effort_decode(input_, expected):
-    assert channel._best_effort_decode(input_) == expected
-
-
 def test_simple():
     p = channel.PushDataParser()
     assert list(p.get_submissions('10\n01234567893\nabc'.encode())) == [
@@ -84,3 +72,178 @@ def test_split_characters():
     p = channel.PushDataParser()
     assert list(p.get_submissions(b'1\n\xe2\x82')) == []
     assert list(p.get_submissions(b'\xac')) == ['€']
+
+
+def test_parts_simple():
+    p = channel.PushDataParser()
+    assert list(p.get_submission_parts('10\n01234567893\nabc'.encode())) == [
+        ('0123456789', True),
+        ('abc', True),
+    ]
+
+
+def test_parts_incremental():
+    p = channel.PushDataParser()
+    assert list(p.get_submission_parts(''.encode())) == []
+    assert list(p.get_submission_parts('5'.encode())) == []
+    assert list(p.get_submission_parts('\n'.encode())) == []
+    assert list(p.get_submission_parts('abc'.encode())) == [('abc', False)]
+    assert list(p.get_submission_parts('de2\nf'.encode())) == [
+        ('de', True), ('f', False)
+    ]
+    assert list(p.get_submission_parts('g'.encode())) == [('g', True)]
+
+
+def test_parts_unicode():
+    p = channel.PushDataParser()
+    # smile is actually 2 code units
+    assert list(p.get_submission_parts('3\na😀1\nb'.encode())) == [
+        ('a😀', True), ('b', True)
+    ]
+
+
+def test_parts_split_characters():
+    p = channel.PushDataParser()
+    assert list(p.get_submission_parts(b'2\n\xe2\x82')) == []
+    assert list(p.get_submission_parts(b'\xac\xe2')) == [('€', False)]
+    assert list(p.get_submission_parts(b'\x82\xac')) == [('€', True)]
+
+
+@pytest.mark.parametrize('input_,expected', [
+    (b'', 0),
+    ('abc'.encode(), 3),
+    ('é€'.encode(), 2),
+    ('😀a😀'.encode(), 5),
+])
+def test_utf16_length(input_, expected):
+    assert channel._utf16_length(input_) == expected
+
+
+def test_empty_submission():
+    p = channel.PushDataParser()
+    assert list(p.get_submissions('0\n1\na'.encode())) == ['', 'a']
+
+
+def test_many_submissions():
+    submissions = ['a€😀' * i for i in range(200)]
+    data = ''.join('{}\n{}'.format(len(s.encode('utf-16-le')) // 2, s)
+                   for s in submissions).encode()
+    p = channel.PushDataParser()
+    assert list(p.get_submissions(data)) == submissions
+    p = channel.PushDataParser()
+    res = []
+    for i in range(0, len(data), 7):
+        res.extend(p.get_submissions(data[i:i + 7]))
+    assert res == submissions
+
+
+def _typing_item(conv_id, chat_id, status):
+    state_update = [[1, None, 'trace', None, 1], None, None, None,
+                    [[conv_id], [chat_id, chat_id], 1, status]]
+    payload = json.dumps(['cbu', [state_update]])
+    return json.dumps([5, ['c', ['SID', ['bfo', payload]]]])
+
+
+HEARTBEAT = '[6,["c",["SID",["wh"]\n]\n]\n]'
+
+
+def _run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+def test_get_typing_key():
+    assert parsers.get_typing_key(_typing_item('c', 'u', 1)) == ('c', 'u')
+    assert parsers.get_typing_key(HEARTBEAT) is None
+
+
+def test_dispatch_queue_block():
+    queue = channel.DispatchQueue(1, channel.BLOCK)
+    _run(queue.put_item('1'))
+    with pytest.raises(asyncio.TimeoutError):
+        _run(asyncio.wait_for(queue.put_item(HEARTBEAT), 0.01))
+    assert queue.qsize() == 1
+    assert queue.lag > 0
+    assert _run(queue.get()) == '1'
+    assert queue.lag == 0
+
+
+def test_dispatch_queue_drop_heartbeats():
+    queue = channel.DispatchQueue(1, channel.DROP_HEARTBEATS)
+    _run(queue.put_item(HEARTBEAT))
+    _run(queue.put_item(HEARTBEAT))
+    assert queue.qsize() == 1
+    assert queue.dropped == 1
+
+
+def test_dispatch_queue_coalesce_typing():
+    queue = channel.DispatchQueue(2, channel.COALESCE_TYPING)
+    _run(queue.put_item(_typing_item('c', 'u', 1)))
+    _run(queue.put_item(_typing_item('c', 'v', 1)))
+    _run(queue.put_item(_typing_item('c', 'u', 3)))
+    assert queue.dropped == 1
+    assert [_run(queue.get()), _run(queue.get())] == [
+        _typing_item('c', 'u', 3), _typing_item('c', 'v', 1)
+    ]
+
+
+def test_dispatch_queue_unknown_policy():
+    with pytest.raises(ValueError):
+        channel.DispatchQueue(1, 'foo')
+
+
+def _get_dispatch_channel():
+    chan = channel.Channel({}, '/', None, None, None, None,
+                           dispatch_queue_size=10)
+    chan._push_parser = channel.PushDataParser()
+    chan._submission_parser = javascript.IncrementalParser(raw=True)
+    return chan
+
+
+def test_channel_dispatch():
+    chan = _get_dispatch_channel()
+    received = []
+    chan.on_message.add_observer(received.append)
+    data = '{}\n[{},[7]]'.format(len(HEARTBEAT) + 6, HEARTBEAT).encode()
+    _run(chan._on_push_data(data))
+    assert chan.dispatch_queue_depth == 2
+    assert received == []
+    task = asyncio.get_event_loop().create_task(chan._dispatch())
+    while chan.dispatch_queue_depth > 0:
+        _run(asyncio.sleep(0))
+    task.cancel()
+    assert received == [[HEARTBEAT], ['[7]']]
+
+
+def test_channel_dispatch_observer_error():
+    """Test items after one an observer fails on are still dispatched."""
+    chan = _get_dispatch_channel()
+    received = []
+
+    def on_message(submission):
+        received.extend(submission)
+        if submission == ['[1]']:
+            raise ValueError('bad item')
+    chan.on_message.add_observer(on_message)
+    data = '13\n[[1],[2],[3]]'.encode()
+    _run(chan._on_push_data(data))
+    task = asyncio.get_event_loop().create_task(chan._dispatch())
+    while chan.dispatch_queue_depth > 0:
+        _run(asyncio.sleep(0))
+    task.cancel()
+    assert received == ['[1]', '[2]', '[3]']
+
+
+def test_channel_listen_dispatches_queued_items():
+    """Test items still queued when listen returns are dispatched."""
+    chan = _get_dispatch_channel()
+    received = []
+    chan.on_message.add_observer(received.extend)
+
+    @asyncio.coroutine
+    def _listen():
+        # Return without letting the dispatch task run.
+        yield from chan._on_push_data('9\n[[1],[2]]'.encode())
+    chan._listen = _listen
+    _run(chan.listen())
+    assert received == ['[1]', '[2]']
+    assert chan.dispatch_queue_depth == 0
@@ -0,0 +1,102 @@
+"""Tests for Client."""
+
+import asyncio
+import concurrent.futures
+import json
+import pytest
+
+from hangups import client, exceptions, fakeserver
+
+
+@pytest.fixture(scope='module')
+def parse_executor(request):
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=1)
+    request.addfinalizer(executor.shutdown)
+    return executor
+
+
+@pytest.fixture
+def server():
+    return fakeserver.FakeServer(num_conversations=2, seed=1)
+
+
+def run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+def test_parse_chat_init_in_executor(parse_executor, server):
+    """Test the chat init page parses in another process, and the records
+    are pickled back unchanged.
+    """
+    body = server.get_chat_init_page().encode()
+    hangups_client = client.Client({}, parse_executor=parse_executor)
+    values, initial_data = run(
+        hangups_client._parse(client._parse_chat_init, body)
+    )
+    assert (values, initial_data) == client._parse_chat_init(body)
+    assert initial_data.self_entity.id_.chat_id == 'user0'
+
+
+def test_parse_sync_all_new_events_in_executor(parse_executor, server):
+    """Test a syncallnewevents response parses in another process."""
+    body = server.get_sync_all_new_events_response().encode()
+    hangups_client = client.Client({}, parse_executor=parse_executor)
+    res = run(hangups_client._parse(client._parse_sync_all_new_events, body,
+                                    {'response_header': None}))
+    assert res == client._parse_sync_all_new_events(
+        body, {'response_header': None}
+    )
+    assert res.response_header.status == 1
+    assert res.conversation_state is None
+
+
+@pytest.mark.parametrize('parser,body,exception', [
+    (client._parse_chat_init, b'', exceptions.HangupsError),
+    (client._parse_sync_all_new_events, b'[1]', ValueError),
+])
+def test_parse_error_in_executor(parse_executor, parser, body, exception):
+    """Test exceptions raised by a parser in another process reach the
+    caller unchanged.
+    """
+    hangups_client = client.Client({}, parse_executor=parse_executor)
+    with pytest.raises(exception) as local_error:
+        parser(body)
+    with pytest.raises(exception) as executor_error:
+        run(hangups_client._parse(parser, body))
+    assert type(executor_error.value) is type(local_error.value)
+    assert str(executor_error.value) == str(local_error.value)
+
+
+def test_parse_without_executor():
+    """Test parsers are called directly by default."""
+    hangups_client = client.Client({})
+    result = object()
+    # A lambda can't be pickled, so this only works if it's called directly.
+    assert run(hangups_client._parse(lambda: result)) is result
+
+
+def test_dispatch_metrics_before_connecting():
+    """Test the dispatch queue metrics are zero without a channel."""
+    hangups_client = client.Client({})
+    assert hangups_client.dispatch_queue_depth == 0
+    assert hangups_client.dispatch_lag == 0.0
+
+
+@pytest.mark.parametrize('lazy_parsing', [False, True])
+def test_push_data_invalid_update(server, lazy_parsing):
+    """Test an invalid ClientStateUpdate is skipped without losing the next
+    one, whether it's parsed eagerly or lazily.
+    """
+    hangups_client = client.Client({}, lazy_parsing=lazy_parsing)
+    events = []
+    hangups_client.on_state_update.add_observer(
+        lambda state_update: events.append(state_update.event_notification)
+    )
+    submission = server.get_message_submission(1, 'SID', 2)
+    item = json.loads(submission.split('\n', 1)[1])[0]
+    payload = json.loads(item[1][1][1][1])
+    payload[1][0][2] = 'invalid'
+    item[1][1][1][1] = json.dumps(payload)
+    hangups_client._on_push_data([json.dumps(item)])
+    assert len(events) == 1
+    assert events[0].event.event_id == payload[1][1][2][0][11]
@@ -0,0 +1,167 @@
+"""Tests for Conversation and ConversationList."""
+
+import asyncio
+import pytest
+
+from hangups import (capture, client, conversation, fakeserver, schemas,
+                     search)
+
+
+@pytest.fixture
+def server():
+    return fakeserver.FakeServer(num_conversations=2, seed=1)
+
+
+def get_client_events(server, timestamps, event_ids=None):
+    """Return ClientEvents in the first conversation with the given
+    timestamps.
+    """
+    return [schemas.CLIENT_EVENT.parse(raw_event) for raw_event
+            in server.get_client_events(timestamps, 0, event_ids)]
+
+
+def get_conversation(server, client_events=[], **kwargs):
+    """Return a Conversation of the conversation of the first event."""
+    _, initial_data = client._parse_chat_init(
+        server.get_chat_init_page().encode()
+    )
+    conv_state = initial_data.conversation_states[0]
+    if client_events:
+        conv_state.conversation.conversation_id = (
+            client_events[0].conversation_id
+        )
+    return conversation.Conversation(None, None, conv_state.conversation,
+                                     client_events, **kwargs)
+
+
+def test_events_view(server):
+    client_events = get_client_events(server, [1, 2, 3])
+    conv = get_conversation(server, client_events)
+    events = conv.events
+    assert len(events) == 3
+    assert [e.timestamp_us for e in events] == [1, 2, 3]
+    assert [e.timestamp_us for e in reversed(events)] == [3, 2, 1]
+    assert events[-1].timestamp_us == 3
+    assert [e.timestamp_us for e in events[1:]] == [2, 3]
+    with pytest.raises(IndexError):
+        events[3]
+    conv.add_event(get_client_events(server, [4])[0])
+    assert len(events) == 4
+
+
+@pytest.mark.parametrize('kwargs,expected', [
+    ({'max_events': 2}, [4, 5]),
+    ({'max_age': 0.000002}, [3, 4, 5]),
+    ({'max_events': 4, 'max_age': 0.000001}, [4, 5]),
+])
+def test_retention(server, kwargs, expected):
+    evicted = []
+    conv = get_conversation(server, **kwargs)
+    conv.on_evict.add_observer(evicted.extend)
+    for client_event in get_client_events(server, [1, 2, 3, 4, 5]):
+        conv.add_event(client_event)
+    assert [e.timestamp_us for e in conv.events] == expected
+    assert [e.timestamp_us for e in reversed(conv.events)] == expected[::-1]
+    assert ([e.timestamp_us for e in evicted] ==
+            [t for t in [1, 2, 3, 4, 5] if t not in expected])
+    assert None not in conv.events[:]
+
+
+def test_conversation_list_retention(server):
+    replay_client = capture.ReplayClient()
+    conv_list = conversation.ConversationList(replay_client, [], None, 0,
+                                              max_events=1)
+    evicted = []
+    conv_list.on_evict.add_observer(evicted.extend)
+    conv = get_conversation(server)
+    client_events = get_client_events(server, [1, 2])
+    conv_list.add_conversation(conv._conversation, client_events)
+    assert len(evicted) == 1
+    assert evicted[0].timestamp_us == 1
+
+
+def test_duplicate_events(server):
+    client_events = get_client_events(server, [1, 2, 1, 3],
+                                      ['e1', 'e2', 'e1', 'e3'])
+    client_events[3].self_event_state = schemas.CLIENT_EVENT.parse(
+        [None, None, None, [None, 123]],
+        projection={'self_event_state': {'client_generated_id'}}
+    ).self_event_state
+    conv = get_conversation(server, dedup_index_size=2)
+    assert conv.add_event(client_events[0]) is not None
+    assert conv.add_event(client_events[1]) is not None
+    assert conv.add_event(client_events[2]) is None
+    assert conv.add_event(client_events[3]) is not None
+    assert conv.add_event(client_events[3]) is None
+    assert [e.timestamp_us for e in conv.events] == [1, 2, 3]
+    assert conv.get_event('e2') is conv.events[1]
+    assert conv.get_event('e3') is conv.events[2]
+    # The index is bounded by events, so the oldest event is forgotten, but
+    # not the event before the one with two IDs.
+    assert conv.add_event(client_events[1]) is None
+    with pytest.raises(KeyError):
+        conv.get_event('e1')
+
+
+def test_duplicate_events_evicted(server):
+    client_events = get_client_events(server, [1, 2])
+    conv = get_conversation(server, max_events=1)
+    conv.add_event(client_events[0])
+    conv.add_event(client_events[1])
+    # Evicted events are still recognised as duplicates, but aren't kept.
+    assert conv.add_event(client_events[0]) is None
+    with pytest.raises(KeyError):
+        conv.get_event('event1')
+    assert conv.get_event('event2') is conv.events[0]
+
+
+def test_events_sorted(server):
+    conv = get_conversation(server, get_client_events(server, [3, 1, 4, 2]))
+    assert [e.timestamp_us for e in conv.events] == [1, 2, 3, 4]
+    conv.add_event(get_client_events(server, [0])[0])
+    assert [e.timestamp_us for e in conv.events] == [0, 1, 2, 3, 4]
+
+
+def test_event_range_queries(server):
+    conv = get_conversation(server, get_client_events(server, range(10)),
+                            max_events=8)
+    assert [e.timestamp_us for e in conv.events_between(1, 5)] == [2, 3, 4]
+    assert [e.timestamp_us for e in conv.latest(3)] == [7, 8, 9]
+    assert [e.timestamp_us for e in conv.latest(20)] == list(range(2, 10))
+    before = conv.before(5, 2)
+    assert [e.timestamp_us for e in before] == [3, 4]
+    assert [e.timestamp_us for e in reversed(before)] == [4, 3]
+    assert before[-1].timestamp_us == 4
+    assert len(conv.events_between(6, 6)) == 0
+    assert len(conv.events_between(9, 2)) == 0
+    # Views reflect events being added.
+    conv.add_event(get_client_events(server, [4], ['other'])[0])
+    assert [e.timestamp_us for e in before] == [4, 4]
+
+
+def test_conversation_list_search(server):
+    conv_list = conversation.ConversationList(
+        capture.ReplayClient(), [], None, 0, max_events=2,
+        search_index=search.SearchIndex()
+    )
+    conv = get_conversation(server)
+    client_events = get_client_events(server, [1, 2, 3])
+    for client_event, text in zip(client_events,
+                                  ['hello', 'hello world', 'hello again']):
+        client_event.chat_message.message_content.segment[0].text = text
+    conv_list.add_conversation(conv._conversation, client_events[:2])
+    results = asyncio.get_event_loop().run_until_complete(
+        conv_list.search('Hello')
+    )
+    assert [r.event_id for r in results] == ['event2', 'event1']
+    # Evicted messages are removed from the search index.
+    conv_list._on_client_event(client_events[2])
+    results = asyncio.get_event_loop().run_until_complete(
+        conv_list.search('Hello')
+    )
+    assert [r.event_id for r in results] == ['event3', 'event2']
+
+    conv_list = conversation.ConversationList(capture.ReplayClient(), [],
+                                              None, 0)
+    with pytest.raises(ValueError):
+        asyncio.get_event_loop().run_until_complete(conv_list.search('hello'))
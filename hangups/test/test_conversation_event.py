@@ -0,0 +1,46 @@
+"""Tests for ConversationEvent classes."""
+
+import pytest
+
+from hangups import conversation_event, fakeserver, schemas
+
+
+@pytest.fixture
+def raw_event():
+    """Return a raw ClientEvent containing a chat message."""
+    server = fakeserver.FakeServer(seed=1)
+    return server.get_client_events([1])[0]
+
+
+def test_chat_message_event(raw_event):
+    client_event = schemas.CLIENT_EVENT.parse(raw_event)
+    conv_event = conversation_event.from_client_event(client_event)
+    assert isinstance(conv_event, conversation_event.ChatMessageEvent)
+    assert not hasattr(conv_event, '__dict__')
+    assert conv_event.text == ''.join(
+        segment.text for segment
+        in client_event.chat_message.message_content.segment
+    )
+    assert conv_event.text is conv_event.text
+    assert conv_event.segments is conv_event.segments
+    assert conv_event.user_id is conv_event.user_id
+    assert conv_event.timestamp is conv_event.timestamp
+    assert conv_event.timestamp_us == client_event.timestamp
+
+
+def test_from_raw(raw_event):
+    conv_event = conversation_event.from_raw(raw_event)
+    expected = conversation_event.from_client_event(
+        schemas.CLIENT_EVENT.parse(raw_event)
+    )
+    assert type(conv_event) is type(expected)
+    assert conv_event.text == expected.text
+    assert conv_event.user_id == expected.user_id
+    assert conv_event.conversation_id == expected.conversation_id
+
+
+def test_from_raw_rename(raw_event):
+    raw_event = raw_event[:6] + [None, None, None, ['new', 'old']]
+    conv_event = conversation_event.from_raw(raw_event)
+    assert isinstance(conv_event, conversation_event.RenameEvent)
+    assert conv_event.new_name == 'new'
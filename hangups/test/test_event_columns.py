@@ -0,0 +1,76 @@
+"""Tests for columnar event storage."""
+
+import pytest
+
+from hangups import conversation_event, event_columns, fakeserver, schemas
+
+
+def get_raw_events(num_messages):
+    """Return raw ClientEvents from the fake server."""
+    server = fakeserver.FakeServer(num_conversations=3, seed=1)
+    return server.get_client_events(range(num_messages))
+
+
+def test_parse_events():
+    """Test each event's columns match the parsed event."""
+    raw_events = get_raw_events(10)
+    raw_events.append(raw_events[0][:6] + [None, None, None, ['new', 'old']])
+    columns = event_columns.parse_events(raw_events)
+    assert len(columns) == 11
+    for index, raw_event in enumerate(raw_events[:10]):
+        client_event = schemas.CLIENT_EVENT.parse(raw_event)
+        assert columns.timestamps[index] == client_event.timestamp
+        assert (columns.ids[columns.conversation_ids[index]] ==
+                client_event.conversation_id.id_)
+        assert (columns.ids[columns.sender_ids[index]] ==
+                client_event.sender_id.chat_id)
+        assert columns.types[index] == event_columns.CHAT_MESSAGE
+        assert (columns.get_text(index) ==
+                conversation_event.ChatMessageEvent(client_event).text)
+    assert columns.types[10] == event_columns.RENAME
+    assert columns.get_text(10) == ''
+    # 3 conversations and 3 participants:
+    assert len(columns.ids) <= 6
+
+
+def test_get_text_interleaved(monkeypatch):
+    """Test reading text between appends joins it into few chunks."""
+    monkeypatch.setattr(event_columns, '_CHUNK_SIZE', 250)
+    raw_events = get_raw_events(20)
+    columns = event_columns.EventColumns()
+    texts = []
+    for raw_event in raw_events:
+        columns.extend_raw([raw_event])
+        texts.append(columns.get_text(len(columns) - 1))
+        assert columns.get_text(0) == texts[0]
+    assert texts == [
+        conversation_event.ChatMessageEvent(
+            schemas.CLIENT_EVENT.parse(raw_event)
+        ).text for raw_event in raw_events
+    ]
+    assert len(columns._text_chunks) < len(raw_events)
+    assert columns.text == ''.join(texts)
+    assert columns.get_text(19) == texts[19]
+
+
+def test_conversation_stats():
+    """Test the statistics of each conversation."""
+    raw_events = get_raw_events(20)
+    columns = event_columns.parse_events(raw_events)
+    stats = columns.get_conversation_stats()
+    assert sum(conv.num_events for conv in stats.values()) == 20
+    for conv_id, conv in stats.items():
+        timestamps = [raw_event[2] for raw_event in raw_events
+                      if raw_event[0][0] == conv_id]
+        assert conv.num_chat_messages == len(timestamps)
+        assert conv.first_timestamp == min(timestamps)
+        assert conv.last_timestamp == max(timestamps)
+
+
+@pytest.mark.parametrize('input_', [
+    None, [None], [[None]], [[['id'], None, 1, None, None, None, 'x']],
+])
+def test_parse_events_error(input_):
+    """Test invalid input raises ValueError."""
+    with pytest.raises(ValueError):
+        event_columns.parse_events(input_)
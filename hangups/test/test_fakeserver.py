@@ -0,0 +1,120 @@
+"""Tests for the fake server."""
+
+import asyncio
+
+from hangups import (channel, client, conversation, fakeserver, parsers,
+                     pblite)
+
+
+def test_chat_init_page():
+    server = fakeserver.FakeServer(num_conversations=3, num_participants=4)
+    values, initial_data = client._parse_chat_init(
+        server.get_chat_init_page().encode()
+    )
+    assert values['channel_path'] == fakeserver.CHANNEL_PATH
+    assert len(initial_data.conversation_states) == 3
+    assert len(initial_data.entities) == 3
+    assert initial_data.self_entity.id_.chat_id == 'user0'
+
+
+def test_sid_response():
+    server = fakeserver.FakeServer()
+    sid, email, header_client, gsessionid = channel._parse_sid_response(
+        server.get_sid_response().encode()
+    )
+    assert sid == 'FAKESID1'
+    assert header_client == 'FAKECLIENT'
+    assert gsessionid == 'FAKEGSESSIONID'
+
+
+def test_message_submission():
+    server = fakeserver.FakeServer(message_size=100, seed=1)
+    data = server.get_message_submission(2, 'SID', 5).encode()
+    submissions = list(channel.PushDataParser().get_submissions(data))
+    assert len(submissions) == 1
+    state_updates = list(parsers.parse_submission(submissions[0]))
+    assert len(state_updates) == 5
+    segment = (state_updates[0].event_notification.event.chat_message
+               .message_content.segment[0])
+    assert len(segment.text) == 100
+    assert server.num_messages == 5
+
+
+def test_client_events():
+    server = fakeserver.FakeServer(num_conversations=3, seed=1)
+    client_events = server.get_client_events([1, 2], 2, ['a', 'b'])
+    assert [e[2] for e in client_events] == [1, 2]
+    assert [e[0][0] for e in client_events] == ['conversation2'] * 2
+    assert [e[11] for e in client_events] == ['a', 'b']
+    client_events = server.get_client_events([3, 3])
+    assert client_events[0][11] != client_events[1][11]
+
+
+def test_sync_all_new_events_response():
+    server = fakeserver.FakeServer(num_conversations=2)
+    res = client._parse_sync_all_new_events(
+        server.get_sync_all_new_events_response().encode()
+    )
+    assert res.response_header.status == 1
+    assert len(res.conversation_state) == 2
+
+
+def test_sync_all_new_events_response_projection():
+    server = fakeserver.FakeServer(num_conversations=2)
+    projection = conversation._get_sync_projection(
+        pblite.merge_projections({'typing_notification'},
+                                 conversation.REQUIRED_PROJECTION)
+    )
+    res = client._parse_sync_all_new_events(
+        server.get_sync_all_new_events_response().encode(), projection
+    )
+    assert res.response_header.status == 1
+    conv_state = res.conversation_state[0]
+    conv_id = conv_state.conversation_id
+    assert conv_state.conversation.conversation_id == conv_id
+    assert conv_state.event == []
+
+
+def test_client_connects():
+    """Test a Client connects to a running FakeServer, receives chat
+    messages, and reconnects after its channel session expires.
+    """
+    loop = asyncio.get_event_loop()
+    server = fakeserver.FakeServer(num_conversations=2, message_rate=100,
+                                   batch_interval=0.01, longpoll_duration=0.2,
+                                   seed=1)
+    base_url = loop.run_until_complete(server.start())
+    hangups_client = client.Client(fakeserver.COOKIES, base_url=base_url)
+    initial_data = []
+    hangups_client.on_connect.add_observer(initial_data.append)
+    reconnected = asyncio.Future()
+    hangups_client.on_reconnect.add_observer(
+        lambda: reconnected.done() or reconnected.set_result(None)
+    )
+    state_updates = []
+    received = asyncio.Future()
+
+    def on_state_update(state_update):
+        state_updates.append(state_update)
+        if len(state_updates) == 5:
+            server.expire_sessions()
+        elif reconnected.done() and initial_data and not received.done():
+            received.set_result(None)
+    hangups_client.on_state_update.add_observer(on_state_update)
+    connect_task = loop.create_task(hangups_client.connect())
+    try:
+        loop.run_until_complete(asyncio.wait(
+            [received, connect_task], timeout=10,
+            return_when=asyncio.FIRST_COMPLETED
+        ))
+        if connect_task.done():
+            # Raise the exception connecting failed with.
+            connect_task.result()
+        assert received.done()
+    finally:
+        connect_task.cancel()
+        loop.run_until_complete(asyncio.wait([connect_task]))
+        server.close()
+    assert len(initial_data[0].conversation_states) == 2
+    assert state_updates[0].event_notification.event.chat_message is not None
+    assert server.num_messages >= len(state_updates)
@@ -0,0 +1,47 @@
+"""Tests for interning pools."""
+
+from hangups import interning, pblite, schemas, user
+
+
+def test_intern_pool():
+    pool = interning.InternPool(max_size=2)
+    first = ''.join(['a', 'b'])
+    assert pool.intern(first) is first
+    assert pool.intern(''.join(['a', 'b'])) is first
+    assert pool.get('ab') is first
+    assert pool.intern(None) is None
+    assert pool.intern([1]) == [1]
+    assert pool.get([1]) is None
+    pool.intern('c')
+    pool.intern('d')
+    assert len(pool) == 1
+
+
+def test_field_pool():
+    pool = interning.InternPool()
+    field = pblite.Field(pool=pool)
+    message = pblite.Message(('id_', field))
+    first = message.parse([''.join(['a', 'b'])])
+    second = message.parse([''.join(['a', 'b'])])
+    assert first.id_ is second.id_
+    assert field.parse(''.join(['a', 'b'])) is first.id_
+    repeated = pblite.RepeatedField(field).parse([''.join(['a', 'b'])])
+    assert repeated[0] is first.id_
+    decoded = pblite.decode(message, pblite.encode(message, first))
+    assert decoded.id_ is first.id_
+
+
+def test_schema_ids_interned():
+    first = schemas.CONVERSATION_ID.parse([''.join(['c', '1'])])
+    second = schemas.CONVERSATION_ID.parse([''.join(['c', '1'])])
+    assert first.id_ is second.id_
+    first = schemas.USER_ID.parse([''.join(['1', '2']), '12'])
+    assert first.gaia_id is first.chat_id
+
+
+def test_user_id_interned():
+    user_id = user.UserID(chat_id=''.join(['1', '2']), gaia_id='12')
+    assert user.UserID(''.join(['1', '2']), '12') is user_id
+    assert user_id == ('12', '12')
+    assert user_id.chat_id == '12'
+    assert user.UserID(chat_id=[1], gaia_id=None).chat_id == [1]
@@ -1,10 +1,16 @@
 """Tests for the JavaScript parser."""
 
+import os
+import pickle
 import pytest
 
 from hangups import javascript
 
 
+PARSERS = [javascript.JSON, javascript.SCANNER, javascript.PURPLEX]
+
+
+@pytest.mark.parametrize('parser', PARSERS)
 @pytest.mark.parametrize('input_,expected', [
     # simple types
     ('12', 12),
@@ -46,20 +52,278 @@ from hangups import javascript
     ('"\\""', '"'),
     ("'\\''", "'"),
     (r'"[\"foo\"]"', '["foo"]'),
+    (r'"\ud83d\ude00"', '😀'),
+    (r'"\u{1F600}"', '😀'),
+    (r'"\x41\/\b\f\v\0"', 'A/\b\f\v\0'),
+    ('"a\\\nb"', 'ab'),
 
 ])
-def test_loads(input_, expected):
+def test_loads(input_, expected, parser):
     """Test loading JS from a string."""
-    assert javascript.loads(input_) == expected
+    assert javascript.loads(input_, parser=parser) == expected
 
 
-def test_loads_lex_error():
+@pytest.mark.parametrize('parser', PARSERS)
+def test_loads_lex_error(parser):
     """Test loading invalid JS that fails lexing."""
     with pytest.raises(ValueError):
-        javascript.loads('{""": 1}')
+        javascript.loads('{""": 1}', parser=parser)
 
 
-def test_loads_parse_error():
+@pytest.mark.parametrize('parser', PARSERS)
+def test_loads_parse_error(parser):
     """Test loading invalid JS that fails parsing."""
     with pytest.raises(ValueError):
-        javascript.loads('{"foo": 1}}')
+        javascript.loads('{"foo": 1}}', parser=parser)
+
+
+@pytest.mark.parametrize('input_', [
+    '',
+    '   ',
+    '[',
+    '[1 2]',
+    '{"foo" 1}',
+    '{"foo": 1 "bar": 2}',
+    '{,}',
+    '1 2',
+    'undefined',
+    '"foo',
+])
+def test_scanner_error(input_):
+    """Test the scanner rejects invalid JS."""
+    with pytest.raises(ValueError):
+        javascript.loads(input_, parser=javascript.SCANNER)
+
+
+@pytest.mark.parametrize('input_,expected', [
+    ('', ''),
+    ('foo', 'foo'),
+    (r'\t\\t', '\t\\t'),
+    (r'\u00e9\xe9\u{e9}', 'ééé'),
+    (r'\uD83D\uDE00', '😀'),
+    (r'\ud83d', '\ud83d'),
+    (r'\q\'', 'q\''),
+])
+def test_unescape_string(input_, expected):
+    """Test unescaping string literals."""
+    assert javascript._unescape_string(input_) == expected
+
+
+@pytest.mark.parametrize('input_', [
+    '\\',
+    r'\1',
+    r'\01',
+    r'\x4',
+    r'\u12',
+    r'\u{110000}',
+    r'\u{}',
+])
+def test_unescape_string_invalid(input_):
+    """Test unescaping invalid string literals."""
+    with pytest.raises(ValueError):
+        javascript._unescape_string(input_)
+
+
+def test_scanner_long_list():
+    """Test the scanner parses long sparse lists."""
+    input_ = '[' + ',,1,'.join(['"x"'] * 100000) + ',]'
+    expected = ['x', None, 1] * 99999 + ['x']
+    assert javascript.loads(input_, parser=javascript.SCANNER) == expected
+
+
+def test_scanner_deep_nesting():
+    """Test the scanner is not limited by the recursion limit."""
+    input_ = '[' * 10000 + ']' * 10000
+    res = javascript.loads(input_, parser=javascript.SCANNER)
+    for _ in range(9999):
+        res = res[0]
+    assert res == []
+
+
+@pytest.mark.parametrize('input_,expected', [
+    ('[1,2]', '[1,2]'),
+    ('[,1]', '[null,1]'),
+    ('[1,,2]', '[1,null,2]'),
+    ('[1, ,2]', '[1,null ,2]'),
+    ('[1,]', '[1]'),
+    ('[1,,]', '[1,null]'),
+    ('[ ]', '[ ]'),
+    ('["a,,b",,]', '["a,,b",null]'),
+    ('["a\\",,"]', '["a\\",,"]'),
+    ("'a'", '"a"'),
+    ("'say \"hi\"'", '"say \\"hi\\""'),
+    ("'it\\'s'", '"it\'s"'),
+    ("['\\u003d',,]", '["\\u003d",null]'),
+    ('{foo: 1, bar: [,]}', '{"foo": 1, "bar": [null]}'),
+    ('{null: 1}', '{null: 1}'),
+    ('{"foo:": 1}', '{"foo:": 1}'),
+])
+def test_normalise(input_, expected):
+    """Test normalising JS into JSON."""
+    assert javascript._normalise(input_) == expected
+
+
+@pytest.mark.parametrize('input_,expected', [
+    ('{null: 1}', {None: 1}),
+    ('{1: 2}', {1: 2}),
+    ("['\\x']", None),
+    ('NaN', None),
+    ('[Infinity]', None),
+    ('[.5,+1,01]', [0.5, 1, 1]),
+])
+def test_json_fallback(input_, expected):
+    """Test input that isn't JSON after normalisation uses the scanner."""
+    if expected is None:
+        with pytest.raises(ValueError):
+            javascript.loads(input_, parser=javascript.JSON)
+    else:
+        assert javascript.loads(input_, parser=javascript.JSON) == expected
+
+
+def test_unknown_parser():
+    """Test requesting a parser that doesn't exist."""
+    with pytest.raises(ValueError):
+        javascript.loads('1', parser='foo')
+
+
+def test_incremental_parser():
+    """Test items are returned as soon as they are complete."""
+    parser = javascript.IncrementalParser()
+    assert parser.feed(' [[1,') == []
+    assert parser.feed('2],,"a') == [[1, 2], None]
+    assert parser.feed('b",tr') == ['ab']
+    assert parser.feed('ue,1') == [True]
+    assert parser.feed('2,{"c": [3]') == [12]
+    assert parser.feed('}]\n') == [{'c': [3]}]
+    assert parser.close() == []
+
+
+def test_incremental_parser_close():
+    """Test items are returned when the parser is closed."""
+    parser = javascript.IncrementalParser()
+    assert parser.feed('[1,2') == [1]
+    with pytest.raises(ValueError):
+        parser.close()
+    parser = javascript.IncrementalParser()
+    assert parser.feed('[1,2]') == [1, 2]
+    assert parser.close() == []
+
+
+@pytest.mark.parametrize('input_', [
+    '[["foo","bar"],,,1232]',
+    '[[0,["c","A5CFCC4C27DB0410",,8]\n]\n,[1,["b"]\n]\n]\n',
+    '[{foo: \'b\\\'ar\'}, "\\u003d", -1.5e3, null, false]',
+])
+def test_incremental_parser_characters(input_):
+    """Test feeding one character at a time gives the same items as loads."""
+    parser = javascript.IncrementalParser()
+    items = []
+    for char in input_:
+        items.extend(parser.feed(char))
+    items.extend(parser.close())
+    assert items == javascript.loads(input_)
+
+
+@pytest.mark.parametrize('input_', ['1', '{}', '[1]]', '[1 2]', '[@]'])
+def test_incremental_parser_error(input_):
+    """Test invalid input raises ValueError."""
+    parser = javascript.IncrementalParser()
+    with pytest.raises(ValueError):
+        parser.feed(input_)
+        parser.close()
+
+
+@pytest.mark.parametrize('input_', [
+    '[]',
+    '[1,,2,]',
+    '[,1]',
+    '[["foo","bar"],,,1232]',
+    '[[0,["c","A5CFCC4C27DB0410",,8]\n]\n,[1,["b"]\n]\n]\n',
+    '[{foo: \'b\\\'a]r\'}, "\\"[", -1.5e3, null, false]',
+])
+def test_incremental_parser_raw(input_):
+    """Test raw mode returns the source text of each item."""
+    parser = javascript.IncrementalParser(raw=True)
+    items = []
+    for char in input_:
+        items.extend(parser.feed(char))
+    items.extend(parser.close())
+    assert all(item is None or item.strip() == item for item in items)
+    assert [None if item is None else javascript.loads(item)
+            for item in items] == javascript.loads(input_)
+
+
+@pytest.mark.parametrize('raw', [False, True])
+def test_incremental_parser_long_string(monkeypatch, raw):
+    """Test a long string fed in small pieces is scanned in linear time."""
+    steps = [0]  # number of characters scanned
+    scan = javascript._Scanner.scan
+    find_string_end = javascript._find_string_end
+
+    def counting_scan(self, string, pos=0, final=True):
+        steps[0] += len(string) - pos
+        return scan(self, string, pos, final)
+
+    def counting_find_string_end(text, pos, quote, is_escaped):
+        steps[0] += len(text) - pos
+        return find_string_end(text, pos, quote, is_escaped)
+
+    monkeypatch.setattr(javascript._Scanner, 'scan', counting_scan)
+    monkeypatch.setattr(javascript, '_find_string_end',
+                        counting_find_string_end)
+    string = 'a\\"' * 100000
+    input_ = '[1,"{}"]'.format(string)
+    parser = javascript.IncrementalParser(raw=raw)
+    items = []
+    for pos in range(0, len(input_), 100):
+        items.extend(parser.feed(input_[pos:pos + 100]))
+    items.extend(parser.close())
+    assert items == (['1', '"{}"'.format(string)] if raw else
+                     [1, 'a"' * 100000])
+    assert steps[0] <= 3 * len(input_)
+
+
+@pytest.mark.parametrize('input_', [
+    '1', '{}', '[1]]', '[1]2', '[1}', '[1,[2]', '["a]', 'x[1]',
+])
+def test_incremental_parser_raw_error(input_):
+    """Test raw mode rejects input without valid list structure."""
+    parser = javascript.IncrementalParser(raw=True)
+    with pytest.raises(ValueError):
+        parser.feed(input_)
+        parser.close()
+
+
+def test_purplex_parser_is_lazy(monkeypatch):
+    """Test the purplex parser isn't built unless it's used."""
+    monkeypatch.setattr(javascript, '_PARSER', None)
+    assert javascript.loads('[1]') == [1]
+    assert javascript._PARSER is None
+
+
+def test_purplex_parser_cache(monkeypatch, tmpdir):
+    """Test the purplex parser is cached and loaded from the cache."""
+    monkeypatch.setattr(javascript, 'PARSER_CACHE_DIR', str(tmpdir))
+    monkeypatch.setattr(javascript, '_PARSER', None)
+    parser = javascript._get_purplex_parser()
+    assert isinstance(parser, javascript.JavaScriptParser)
+    assert javascript._get_purplex_parser() is parser
+    try:
+        pickle.dumps(parser, pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, AttributeError, TypeError) as e:
+        pytest.skip('purplex parser can\'t be pickled: {}'.format(e))
+    assert os.path.exists(javascript._get_parser_cache_path())
+    monkeypatch.setattr(javascript, '_PARSER', None)
+    assert javascript._get_purplex_parser() is not parser
+    assert isinstance(javascript._PARSER, javascript.JavaScriptParser)
+    assert javascript.loads('[1]', parser=javascript.PURPLEX) == [1]
+
+
+def test_purplex_parser_invalid_cache(monkeypatch, tmpdir):
+    """Test an invalid cached parser is replaced."""
+    monkeypatch.setattr(javascript, 'PARSER_CACHE_DIR', str(tmpdir))
+    monkeypatch.setattr(javascript, '_PARSER', None)
+    with open(javascript._get_parser_cache_path(), 'wb') as f:
+        f.write(b'invalid')
+    parser = javascript._get_purplex_parser()
+    assert isinstance(parser, javascript.JavaScriptParser)
@@ -0,0 +1,71 @@
+"""Tests for the long-polling response parsers."""
+
+import pytest
+
+from hangups import fakeserver, javascript, parsers
+
+
+SUBMISSION = '''[
+[1,["noop"]
+]
+,[2,["c",["SID",["wh"]
+]
+]
+]
+,[3,["c",['SID',["bfo","[\\"cbu\\",[]\\n]\\n"]
+]
+]
+]
+,[4,["c",["SID",["tm",{"a": 1}]
+]
+]
+]
+]
+'''
+
+
+@pytest.mark.parametrize('raw', [False, True])
+def test_get_submission_payloads(raw):
+    """Test payloads are found in parsed and source text items."""
+    parser = javascript.IncrementalParser(raw=raw)
+    items = parser.feed(SUBMISSION) + parser.close()
+    expected = [['cbu', []]]
+    assert list(parsers._get_submission_payloads(items)) == expected
+    assert list(parsers._get_submission_payloads(SUBMISSION)) == expected
+
+
+def test_get_submission_payloads_lazy(monkeypatch):
+    """Test items with discarded payloads are not parsed."""
+    parsed = []
+    loads = javascript.loads
+
+    def loads_spy(string):
+        parsed.append(string)
+        return loads(string)
+    monkeypatch.setattr(javascript, 'loads', loads_spy)
+    payloads = parsers._get_submission_payloads(SUBMISSION)
+    assert parsed == []
+    assert next(payloads) == ['cbu', []]
+    assert len(parsed) == 2
+    assert parsed[0].startswith('[3,')
+    assert list(payloads) == []
+    assert len(parsed) == 2
+
+
+def test_parse_submission_projection():
+    """Test fields outside the projection are not parsed."""
+    server = fakeserver.FakeServer(seed=1)
+    submission = server.get_message_submission(1, 'SID', 1).split('\n', 1)[1]
+    projection = {'event_notification': {'event': {'chat_message'}}}
+    state_update, = parsers.parse_submission(submission,
+                                             projection=projection)
+    assert state_update.state_update_header is None
+    assert state_update.event_notification.event.timestamp is None
+    assert state_update.event_notification.event.chat_message is not None
+
+
+@pytest.mark.parametrize('timestamp', [0, 1, 1420070400123456, -1000001])
+def test_to_timestamp(timestamp):
+    """Test converting microsecond timestamps to datetimes and back."""
+    datetime_timestamp = parsers.from_timestamp(timestamp)
+    assert parsers.to_timestamp(datetime_timestamp) == timestamp
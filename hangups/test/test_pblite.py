@@ -1,6 +1,7 @@
 """Tests for hangups.pblite."""
 
 import enum
+import pickle
 import pytest
 import types
 
@@ -110,3 +111,208 @@ def test_message_not_list():
         message.parse(123)
     assert e.value.args[0] == ('Message expected list but got '
                                '<class \'int\'>')
+
+
+nested_message = pblite.Message(
+    ('colour', pblite.EnumField(Colour)),
+    ('inner', pblite.Message(
+        ('item', pblite.Field()),
+        is_optional=True,
+    )),
+    ('items', pblite.RepeatedField(message)),
+)
+
+
+def test_nested_message():
+    res = nested_message.parse([1, ['rose'], [['tulip', None, 2]]])
+    assert res.colour == Colour.RED
+    assert res.inner.__dict__ == {'item': 'rose'}
+    assert res.items[0].__dict__ == {'item': 'tulip', 'count': 2}
+
+
+def test_nested_message_optional_none():
+    assert nested_message.parse([2, None, []]).inner is None
+
+
+@pytest.mark.parametrize('input_,error', [
+    ([3, None, []], 'Message field \'colour\': 3 is not a valid Colour'),
+    ([[], None, []],
+     'Message field \'colour\': [] is not a valid Colour'),
+    ([1, 'rose', []], ('Message field \'inner\': Message expected list but '
+                       'got <class \'str\'>')),
+    ([1, [None], []], ('Message field \'inner\': Message field \'item\': '
+                       'Field is not optional')),
+    ([1, None, [[]]], ('Message field \'items\': RepeatedField item: '
+                       'Message field \'item\': Field is not optional')),
+])
+def test_nested_message_error(input_, error):
+    with pytest.raises(ValueError) as e:
+        nested_message.parse(input_)
+    assert e.value.args[0] == error
+
+
+def test_message_keyword_name():
+    res = pblite.Message(('class', pblite.Field())).parse([1])
+    assert getattr(res, 'class') == 1
+
+
+def test_message_record():
+    res = message.parse(['foo', None, 1])
+    assert not hasattr(res, '__weakref__')
+    with pytest.raises(AttributeError):
+        res.other = 1
+    assert res == types.SimpleNamespace(item='foo', count=1)
+    assert res != types.SimpleNamespace(item='foo', count=2)
+    assert repr(res) == repr(types.SimpleNamespace(item='foo', count=1))
+    assert type(message.parse(['bar', None, None])) is type(res)
+
+
+def test_message_record_pickle():
+    res = nested_message.parse([1, ['rose'], [['tulip', None, 2]]])
+    assert pickle.loads(pickle.dumps(res)) == res
+
+
+def test_message_serialize_record():
+    res = message.parse(['foo', None, 1])
+    assert message.serialize(res) == ['foo', None, 1]
+
+
+def test_message_lazy():
+    input_ = [1, ['rose'], [['tulip', None, 2]]]
+    res = nested_message.parse(input_, lazy=True)
+    assert res.colour == Colour.RED
+    assert res.inner.item == 'rose'
+    assert res.items[0].count == 2
+    assert res == nested_message.parse(input_)
+    assert pickle.loads(pickle.dumps(res)) == res
+    with pytest.raises(AttributeError):
+        res.other
+
+
+def test_message_lazy_field_error():
+    res = nested_message.parse([1, 'rose', []], lazy=True)
+    assert res.colour == Colour.RED
+    with pytest.raises(ValueError):
+        res.inner
+    with pytest.raises(ValueError):
+        nested_message.parse('rose', lazy=True)
+
+
+@pytest.mark.parametrize('input_,error', [
+    ([3, None, []], 'Message field \'colour\': 3 is not a valid Colour'),
+    ([1, [None], []], ('Message field \'inner\': Message field \'item\': '
+                       'Field is not optional')),
+    ([1, None, [[]]], ('Message field \'items\': RepeatedField item: '
+                       'Message field \'item\': Field is not optional')),
+])
+def test_message_lazy_validate(input_, error):
+    res = nested_message.parse(input_, lazy=True)
+    with pytest.raises(ValueError) as e:
+        res.validate()
+    assert e.value.args[0] == error
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_message_projection(lazy):
+    input_ = [3, ['rose'], [['tulip', None, 2], [None]]]
+    res = nested_message.parse(input_, lazy=lazy,
+                               projection={'items': ['count']})
+    assert res.colour is None
+    assert res.inner is None
+    assert [item.count for item in res.items] == [2, None]
+    assert [item.item for item in res.items] == [None, None]
+
+
+@pytest.mark.parametrize('projection', [
+    {'size'},
+    {'colour': {'value'}},
+    {'items': {'item', 'size'}},
+])
+def test_message_projection_invalid(projection):
+    with pytest.raises(ValueError):
+        nested_message.parse([1, None, []], projection=projection)
+    with pytest.raises(ValueError):
+        nested_message.check_projection(projection)
+
+
+def test_merge_projections():
+    assert pblite.merge_projections(
+        {'a': {'b'}, 'c': {'d': None}}, {'a': {'e'}, 'c': None}, ['f'],
+    ) == {'a': {'b': None, 'e': None}, 'c': None, 'f': None}
+    assert pblite.merge_projections({'a'}, None) is None
+
+
+@pytest.mark.parametrize('field,value', [
+    (nested_message,
+     nested_message.parse([1, ['rose'], [['tulip', None, 2]]])),
+    (nested_message,
+     nested_message.parse([2, None, []], projection={'colour'})),
+    (message, types.SimpleNamespace(item='rose', count=None)),
+    (pblite.RepeatedField(field), [
+        None, True, False, 0, -1, 2**70, -2**70, 1.5, '', 'rose', 'rose',
+        '\U0001f600', [1, ['a']], {'a': 1, 2: None},
+    ]),
+    (pblite.RepeatedField(enum_field, is_optional=True), None),
+    (enum_field, Colour.BLUE),
+])
+def test_snapshot(field, value):
+    data = pblite.encode(field, value)
+    assert data.startswith(pblite.MAGIC)
+    res = pblite.decode(field, data)
+    assert res == value
+    assert type(res) is type(value) or isinstance(value, types.SimpleNamespace)
+    assert pblite.decode(field, memoryview(data)) == value
+
+
+def test_snapshot_strings_interned():
+    data = pblite.encode(repeated_field, ['rose'] * 3)
+    assert data.count(b'rose') == 1
+    res = pblite.decode(repeated_field, data)
+    assert res[0] is res[2]
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    b'foo',
+    pblite.MAGIC,
+    pblite.encode(repeated_field, ['rose'])[:-1],
+    pblite.encode(repeated_field, ['rose']) + b'\x00',
+    pblite._get_header(repeated_field) + b'\x02\x09',
+    # An unhashable dict key:
+    pblite._get_header(repeated_field) + b'\x02\x08\x01\x07\x00\x00',
+])
+def test_snapshot_invalid(data):
+    with pytest.raises(ValueError):
+        pblite.decode(repeated_field, data)
+
+
+def test_snapshot_invalid_enum():
+    data = pblite.encode(enum_field, Colour.BLUE)
+    with pytest.raises(ValueError):
+        pblite.decode(enum_field, data[:-1] + b'\x7f')
+
+
+def test_snapshot_schema_changed():
+    data = pblite.encode(nested_message,
+                         nested_message.parse([1, ['rose'], []]))
+    # A field inserted into nested_message:
+    changed_message = pblite.Message(
+        ('colour', pblite.EnumField(Colour)),
+        ('size', pblite.Field(is_optional=True)),
+        ('inner', pblite.Message(
+            ('item', pblite.Field()),
+            is_optional=True,
+        )),
+        ('items', pblite.RepeatedField(message)),
+    )
+    with pytest.raises(ValueError):
+        pblite.decode(changed_message, data)
+    with pytest.raises(ValueError):
+        pblite.decode(enum_field, pblite.encode(field, 1))
+
+
+def test_snapshot_encode_error():
+    with pytest.raises(ValueError):
+        pblite.encode(field, object())
+    with pytest.raises(ValueError):
+        pblite.encode(nested_message, [1])
@@ -0,0 +1,58 @@
+"""Tests for full-text search."""
+
+from hangups import search
+
+
+def test_tokenize():
+    assert search.tokenize('Hello, WORLD! Ça va? foo_bar 42') == [
+        'hello', 'world', 'ça', 'va', 'foo_bar', '42'
+    ]
+    assert search.tokenize(' !? ') == []
+
+
+def test_search_index():
+    index = search.SearchIndex()
+    index.add('c1', 'e1', 1, 'hello world')
+    index.add('c2', 'e2', 2, 'Hello there')
+    index.add('c1', 'e3', 3, 'hello again, world')
+    index.add('c2', 'e4', 0, 'world hello hello')
+    index.add('c2', 'e4', 0, 'duplicate')
+    assert len(index) == 4
+    results = index.search('HELLO')
+    # Messages are ranked in the order they were added.
+    assert [r.event_id for r in results] == ['e4', 'e3', 'e2', 'e1']
+    assert results[0] == search.SearchResult('c2', 'e4', 0)
+    assert [r.event_id for r in index.search('world hello')] == [
+        'e4', 'e3', 'e1'
+    ]
+    assert [r.event_id for r in index.search('hello', limit=2)] == [
+        'e4', 'e3'
+    ]
+    assert [r.event_id for r in index.search('hello', conv_ids=['c2'])] == [
+        'e4', 'e2'
+    ]
+    assert index.search('hello', conv_ids=['unknown']) == []
+    assert index.search('hello missing') == []
+    assert index.search('duplicate') == []
+    assert index.search('...') == []
+
+
+def test_search_index_remove():
+    index = search.SearchIndex()
+    for i in range(4):
+        index.add('c{}'.format(i % 2), 'e{}'.format(i), i,
+                  'hello {}'.format(i))
+    index.remove('e2')
+    index.remove('unknown')
+    assert len(index) == 3
+    assert [r.event_id for r in index.search('hello')] == ['e3', 'e1', 'e0']
+    assert index.search('2') == []
+    # Removing more than half of the messages compacts the index.
+    index.remove('e0')
+    index.remove('e3')
+    assert len(index) == 1
+    assert len(index._event_ids) == 1
+    assert index.search('3') == []
+    assert index.search('hello') == [search.SearchResult('c1', 'e1', 1)]
+    index.add('c0', 'e4', 4, 'hello')
+    assert [r.event_id for r in index.search('hello')] == ['e4', 'e1']
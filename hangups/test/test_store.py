@@ -0,0 +1,130 @@
+"""Tests for EventStore."""
+
+import asyncio
+import pytest
+
+from hangups import (capture, client, conversation, fakeserver, pblite,
+                     schemas, search, store)
+
+
+@pytest.fixture
+def server():
+    return fakeserver.FakeServer(num_conversations=2, seed=1)
+
+
+@pytest.fixture
+def initial_data(server):
+    _, initial_data = client._parse_chat_init(
+        server.get_chat_init_page().encode()
+    )
+    return initial_data
+
+
+def run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+def test_store(tmpdir, server, initial_data):
+    path = str(tmpdir.join('store.db'))
+    conv = initial_data.conversation_states[0].conversation
+    conv_id = conv.conversation_id.id_
+    client_events = [schemas.CLIENT_EVENT.parse(raw_event) for raw_event
+                     in server.get_client_events([3, 1, 2, 3], 0)]
+    client_events[3].event_id = client_events[0].event_id
+    event_store = store.EventStore(path, flush_interval=60)
+    event_store.add_conversation(conv)
+    event_store.add_events(client_events)
+    event_store.add_entities(initial_data.entities)
+    run(event_store.flush())
+    events = run(event_store.get_events(conv_id))
+    assert [e.timestamp for e in events] == [1, 2, 3]
+    assert events[0] == client_events[1]
+    events = run(event_store.get_events(conv_id, start=2, end=3))
+    assert [e.timestamp for e in events] == [2]
+    events = run(event_store.get_events(conv_id, limit=2))
+    assert [e.timestamp for e in events] == [2, 3]
+    assert run(event_store.get_events('unknown')) == []
+    assert run(event_store.get_sync_timestamp()) == 3
+    run(event_store.close())
+    with pytest.raises(ValueError):
+        event_store.add_events(client_events)
+
+    # The values are read back after reopening the store.
+    event_store = store.EventStore(path)
+    assert run(event_store.get_conversations()) == [conv]
+    assert (sorted(e.id_.chat_id for e in run(event_store.get_entities())) ==
+            sorted(e.id_.chat_id for e in initial_data.entities))
+    assert len(run(event_store.get_events(conv_id))) == 3
+    run(event_store.close())
+
+
+def test_store_search(tmpdir, server):
+    event_store = store.EventStore(str(tmpdir.join('store.db')),
+                                   full_text=True)
+    client_events = [schemas.CLIENT_EVENT.parse(raw_event) for raw_event
+                     in server.get_client_events(range(3), 0)]
+    conv_id = client_events[0].conversation_id.id_
+    for client_event, text in zip(client_events,
+                                  ['hello world', 'Hello', '"or" NEAR(x)']):
+        client_event.chat_message.message_content.segment[0].text = text
+    event_store.add_events(client_events + client_events[:1])
+    run(event_store.flush())
+    results = run(event_store.search('hello'))
+    assert results == [search.SearchResult(conv_id, 'event2', 1),
+                       search.SearchResult(conv_id, 'event1', 0)]
+    assert len(run(event_store.search('hello', limit=1))) == 1
+    assert len(run(event_store.search('hello world'))) == 1
+    assert len(run(event_store.search('hello', conv_ids=['unknown']))) == 0
+    assert len(run(event_store.search('"or" near'))) == 1
+    run(event_store.close())
+
+    event_store = store.EventStore(str(tmpdir.join('other.db')))
+    with pytest.raises(ValueError):
+        run(event_store.search('hello'))
+    run(event_store.close())
+
+
+def test_open_error(tmpdir):
+    event_store = store.EventStore(str(tmpdir))
+    with pytest.raises(store.sqlite3.Error):
+        run(event_store.get_sync_timestamp())
+    run(event_store.close())
+
+
+def test_conversation_list_store(tmpdir, server, initial_data):
+    event_store = store.EventStore(str(tmpdir.join('store.db')))
+    conv_list = conversation.ConversationList(
+        capture.ReplayClient(), [], None, 0, max_events=2, store=event_store
+    )
+    client_conversation = initial_data.conversation_states[0].conversation
+    client_events = [schemas.CLIENT_EVENT.parse(raw_event) for raw_event
+                     in server.get_client_events(range(5), 0)]
+    conv = conv_list.add_conversation(client_conversation, client_events[:4])
+    conv_list._on_client_event(client_events[4])
+    run(event_store.flush())
+    assert [e.timestamp_us for e in conv.events] == [3, 4]
+    # Evicted events are loaded from the store.
+    history = run(conv.get_history(4, 3))
+    assert [e.timestamp_us for e in history] == [1, 2, 3]
+    assert history[0].id_ == 'event2'
+    assert run(event_store.get_sync_timestamp()) == 4
+    run(event_store.close())
+
+
+def test_store_schema_changed(tmpdir, initial_data):
+    """Test values stored with a different schema aren't decoded."""
+    path = str(tmpdir.join('store.db'))
+    conv = initial_data.conversation_states[0].conversation
+    event_store = store.EventStore(path)
+    event_store.add_conversation(conv)
+    run(event_store.close())
+    conn = store.sqlite3.connect(path)
+    with conn:
+        conn.execute('UPDATE conversations SET data = ?', (
+            pblite.encode(schemas.CLIENT_ENTITY, initial_data.entities[0]),
+        ))
+    conn.close()
+    event_store = store.EventStore(path)
+    with pytest.raises(ValueError):
+        run(event_store.get_conversations())
+    run(event_store.close())
@@ -3,10 +3,29 @@
 import logging
 from collections import namedtuple
 
+from hangups import interning
+
 logger = logging.getLogger(__name__)
 DEFAULT_NAME = 'Unknown'
 
-UserID = namedtuple('UserID', ['chat_id', 'gaia_id'])
+
+class UserID(namedtuple('UserID', ['chat_id', 'gaia_id'])):
+
+    """A user's ID.
+
+    UserIDs are interned in interning.USER_IDS, so constructing an ID which
+    already exists returns the existing instance.
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, chat_id, gaia_id):
+        user_id = interning.USER_IDS.get((chat_id, gaia_id))
+        if user_id is None:
+            user_id = interning.USER_IDS.intern(
+                super().__new__(cls, chat_id, gaia_id)
+            )
+        return user_id
 
 
 class User(object):
@@ -61,12 +80,14 @@ class UserList(object):
 
     """Collection of User instances."""
 
-    def __init__(self, client, self_entity, entities, conv_parts):
+    def __init__(self, client, self_entity, entities, conv_parts, store=None):
         """Initialize the list of Users.
 
         Creates users from the given ClientEntity and
         ClientConversationParticipantData instances. The latter is used only as
         a fallback, because it doesn't include a real first_name.
+
+        store is an optional EventStore which the entities are written to.
         """
         self._client = client
         self._self_user = User.from_entity(self_entity, None)
@@ -79,6 +100,8 @@ class UserList(object):
         # add them from an entity.
         for participant in conv_parts:
             self.add_user_from_conv_part(participant)
+        if store is not None:
+            store.add_entities([self_entity] + list(entities))
         logger.info('UserList initialized with {} user(s)'
                     .format(len(self._user_dict)))
 